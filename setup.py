@@ -23,11 +23,18 @@ setup(
     long_description_content_type="text/markdown",
     long_description=long_description,
     packages=find_packages(),
-    install_requires=['pysam'],
+    # the scripts import the modules next to them by their names, they are installed as top-level modules
+    package_dir={'': 'src/STRcount'},
+    py_modules=['STRcount', 'alignment_store', 'checkpoint', 'columnar_output', 'compressed_io', 'defaults',
+                'fast_count', 'genome_str_graph_generator', 'genotype', 'graph_cache', 'job_server', 'parse_gaf',
+                'parse_gaf_columnar', 'parse_gaf_external', 'parse_gaf_mmap', 'read_prefilter', 'shard_alignment',
+                'stage_metrics'],
+    install_requires=['pysam', 'numpy', 'pandas'],
+    extras_require={'columnar': ['pyarrow']},
     keywords=['python', 'STR', 'Repeats', 'Tandem Repeats'],
     entry_points ={
             'console_scripts': [
-                'STRcount = STRcount.STRcount:main'
+                'STRcount = STRcount:main'
             ]
         },
     classifiers=[
@@ -36,5 +43,6 @@ setup(
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
     ],
-    scripts=['src/STRcount/STRcount.py','src/STRcount/genome_str_graph_generator.py','src/STRcount/parse_gaf.py']
+    scripts=['src/STRcount/STRcount.py','src/STRcount/genome_str_graph_generator.py','src/STRcount/parse_gaf.py',
+             'src/STRcount/genotype.py', 'src/STRcount/compressed_io.py', 'src/STRcount/job_server.py']
 )
\ No newline at end of file
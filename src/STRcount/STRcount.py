@@ -1,155 +1,891 @@
 #! /usr/bin/env python
 
 import argparse
+import concurrent.futures
 import os
 import logging
+import shutil
+import subprocess
+import sys
+import threading
+
+from genome_str_graph_generator import DEFAULT_BEFORE_AND_AFTER_FIXES_LEN, iter_genome_str_graph, load_config, \
+    write_genome_str_graph
+from compressed_io import EXTENSIONS, GAF_COMPRESSIONS, NO_COMPRESSION, ZSTD, detect_compression, open_text, \
+    write_gaf
+from columnar_output import DEFAULT_COMPRESSION, COMPRESSIONS, FILE_EXTENSIONS, OUTPUT_FORMATS, TSV_FORMAT, \
+    check_output_format, write_output
+from alignment_store import AlignmentStore
+# checkpoint imports pysam only to align in chunks, fast_count, genotype, read_prefilter and shard_alignment import
+# numpy or pysam and are imported when they are used, so STRcount starts without them
+from checkpoint import Checkpoints, align_in_chunks, clear_chunks, file_signature, inputs_key, iter_gaf_files
+from defaults import DEFAULT_ANCHOR_K, DEFAULT_CHUNK_READS, DEFAULT_K, MAX_K
+from graph_cache import DEFAULT_MAX_CACHE_BYTES, GraphCache, graph_cache_key
+from parse_gaf import add_alignment, get_locus_names, parse_gaf, parse_gaf_parallel, read_graph_nodes
+from parse_gaf_external import SpilledAlignments, parse_gaf_external
+from stage_metrics import StageMetrics, count_records
 
-parser = argparse.ArgumentParser(description='Software tool to analyse STR loci from long read data. STRcount can count the number of repeats in a repeat expansion and give you the count in a tabular format for further downstream analysis.')
-parser.add_argument('--reference', help='the reference from which the STR Graph will be generated', required=True)
-parser.add_argument('--fastq', help='the baseaclled reads in fastq format', required=True)
-parser.add_argument('--config', help='the config file', required=True)
-parser.add_argument('--output', help='the output file', required=True)
-parser.add_argument('--min-identity', type=float, default=0.50, help='only use reads with identity greater than this', required=False)
-parser.add_argument('--min-aligned-fraction', type=float, default=0.8, help='require alignments cover this proportion of the query sequence', required=False)
-parser.add_argument('--write-non-spanned', action='store_true', default=False, help='do not require the reads to span the prefix/suffix region', required=False)
-parser.add_argument('--repeat_orientation', help='the orientation of the repeat string. + or -', required=False, default="+")
-parser.add_argument('--prefix_orientation', help='the orientation of the prefix, + or -', required=False, default="+")
-parser.add_argument('--suffix_orientation', help='the orientation of the suffix, + or -', required=False, default="+")
-parser.add_argument('--cleanup', help='do you want to clean up the temporary file?', required=False, default="yes")
-parser.add_argument('--output_directory', help='the output directory for all output and temporary files', required=False, default="./")
-parser.add_argument('--multiseed-DP', help='Aligner option', required=False, default="")
-parser.add_argument('--precise-clipping', help='Aligner option: use arg as the identity threshold for a valid alignment.', required=False, default="")
-parser.add_argument('-t', '--threads', type=int, default=1, help='Number of threads for GraphAligner (default: 1)')
-parser.add_argument('--verbose', action='store_true', help='verbose')
-parser.add_argument('--only_use_provided_fixes', action='store_true', help='only use the provided suffixes and prefixes, not the complete reference sequence.')
-parser.add_argument('--use_fixed_len_before_and_after_fixes', action='store_true', help='Use a fixed length for the before or after prefix or suffix sequences and not using the complete reference sequence.')
-parser.add_argument('--ucsc_browser_coords', action='store_true',
-                        help='use UCSC browser coordinates, i.e. start counting at 1 and end is inclusive.')
-
-
-args = parser.parse_args()
-
-ref = args.reference
-reads = args.fastq
-config_file = args.config
-min_id = args.min_identity
-min_align = args.min_aligned_fraction
-span = args.write_non_spanned
-rep_orientation = args.repeat_orientation
-pre_orientation = args.prefix_orientation
-suf_orientation = args.suffix_orientation
-cleanup_flag = 0 if args.cleanup == "no" else 1
-out_dir = args.output_directory
-out_file = args.output
-seed = args.multiseed_DP
-id_thres = args.precise_clipping
-threads = args.threads
-verbose = args.verbose
-only_use_provided_fixes = args.only_use_provided_fixes
-use_fixed_len_before_and_after_fixes = args.use_fixed_len_before_and_after_fixes
-ucsc_browser_coords = args.ucsc_browser_coords
-
-if use_fixed_len_before_and_after_fixes:
-    print("Error: --use_fixed_len_before_and_after_fixes is not implemented yet. Please remove this flag and try again.")
-    exit(1)
-
-#cwd = os.getcwd()
 
 def print_red(s):
     print("\033[31m" + s + "\033[0m")
 
-def main():
-    if min_id:
-        min_id_arg = f"--min-identity {min_id}"
-    else:
-        min_id_arg = ""
 
-    if span:
-        span_arg = f"--write-non-spanned {span}"
-    else:
-        span_arg = ""
+def get_graphaligner_command(graph_file, reads, alignment_file, multiseed_dp="", precise_clipping="", threads=1,
+                             verbose=False):
+    command = ["GraphAligner"]
+    if multiseed_dp:
+        command += ["--multiseed-DP", str(multiseed_dp)]
+    if precise_clipping:
+        command += ["--precise-clipping", str(precise_clipping)]
+    command += ["-g", graph_file, "-f", reads, "-a", alignment_file, "-x", "vg"]
+    if threads:
+        command += ["-t", str(threads)]
+    if verbose:
+        command += ["--verbose"]
+    return command
 
-    if min_align:
-        min_align_arg = f"--min-aligned-fraction {min_align}"
-    else:
-        min_align_arg = ""
 
-    if rep_orientation:
-        rep_orientation_arg = f"--repeat_orientation {rep_orientation}"
-    else:
-        rep_orientation_arg = ""
+def stream_graphaligner(command, alignment_fifo):
+    """Run GraphAligner with its alignments written to the named pipe alignment_fifo and yield the GAF lines while
+    it is still aligning. Raises subprocess.CalledProcessError after the last line if GraphAligner failed."""
+    if os.path.exists(alignment_fifo):
+        os.remove(alignment_fifo)
+    os.mkfifo(alignment_fifo)
+    process = subprocess.Popen(command)
 
-    if pre_orientation:
-        pre_orientation_arg = f"--prefix_orientation {pre_orientation}"
-    else:
-        pre_orientation_arg = ""
+    reader_done = threading.Event()
 
-    if suf_orientation:
-        suf_orientation_arg = f"--suffix_orientation {suf_orientation}"
-    else:
-        suf_orientation_arg = ""
+    def unblock_reader():
+        # opening the reading end blocks until a writer connects, if GraphAligner exits before it opened the pipe
+        # connect and disconnect a writer so the reader sees the end of the file instead of waiting forever. Opening
+        # the writing end fails until the reader has opened the pipe, so keep trying until it did or is done.
+        process.wait()
+        while not reader_done.is_set():
+            try:
+                os.close(os.open(alignment_fifo, os.O_WRONLY | os.O_NONBLOCK))
+                return
+            except OSError:
+                reader_done.wait(0.01)
 
-    if seed:
-        seed_arg = f"--multiseed-DP {seed}"
-    else:
-        seed_arg = ""
+    watcher = threading.Thread(target=unblock_reader, daemon=True)
+    watcher.start()
+    try:
+        with open(alignment_fifo) as f:
+            for record in f:
+                yield record
+        process.wait()
+    finally:
+        if process.returncode is None:
+            # the consumer stopped early
+            process.kill()
+            process.wait()
+        reader_done.set()
+        watcher.join()
+        os.remove(alignment_fifo)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
 
-    if id_thres:
-        id_thres_arg = f"--precise-clipping {id_thres}"
-    else:
-        id_thres_arg = ""
 
-    if threads:
-        threads_arg = f"-t {threads}"
-    else:
-        threads_arg = ""
+# the keyword arguments of run_pipeline() that are passed to generate_graph()
+GRAPH_OPTIONS = ["repeat_orientation", "prefix_orientation", "suffix_orientation", "only_use_provided_fixes",
+                 "ucsc_browser_coords", "use_fixed_len_before_and_after_fixes", "before_and_after_fixes_len",
+                 "graph_cache_dir", "graph_cache_max_bytes"]
 
-    if verbose:
-        verbose_arg = "--verbose"
-    else:
-        verbose_arg = ""
 
-    if only_use_provided_fixes:
-        only_use_provided_fixes_arg = "--only_use_provided_fixes"
-    else:
-        only_use_provided_fixes_arg = ""
+# the engines that count the repeats, GraphAligner aligns the reads to the STR graph, fast_count.fast_count() anchors
+# the flanks of the loci in the reads without aligning them
+GRAPHALIGNER_ENGINE = "graphaligner"
+FAST_ENGINE = "fast"
+COUNT_ENGINES = [GRAPHALIGNER_ENGINE, FAST_ENGINE]
+FAST_COUNT_VALIDATION_FILE = "fast_count_validation.tsv"
 
-    if ucsc_browser_coords:
-        ucsc_browser_coords_arg = "--ucsc_browser_coords"
-    else:
-        ucsc_browser_coords_arg = ""
 
-    create_tmp_folder = os.system(f"mkdir {out_dir}tmp")
+def check_parse_options(stream_alignments=False, columnar_parser=False, workers=1, max_alignments_in_memory=None,
+                        resume=False, shards=1, gaf_compression=NO_COMPRESSION, gaf_index=False, mmap_parser=False):
+    """Raise a ValueError for the options of align_and_count() that can not be combined."""
+    if mmap_parser and (stream_alignments or columnar_parser or max_alignments_in_memory is not None or shards > 1
+                        or gaf_compression != NO_COMPRESSION):
+        raise ValueError("the memory mapped parser only parses plain alignment files and can not be combined with "
+                         "streamed alignments, the columnar parser, spilling the alignments or shards")
+    if (gaf_compression != NO_COMPRESSION or gaf_index) and (stream_alignments or resume or shards > 1 or workers > 1):
+        raise ValueError("a compressed or indexed alignment file can not be combined with streamed alignments, resume, "
+                         "shards or workers")
+    if gaf_index and gaf_compression == ZSTD:
+        raise ValueError("zstd compressed alignment files can not be indexed")
+    if shards > 1 and (stream_alignments or resume or workers > 1):
+        raise ValueError("sharded alignment can not be combined with streamed alignments, resume or workers")
+    if stream_alignments and workers > 1:
+        raise ValueError("the alignments of a stream can not be parsed by several workers")
+    if stream_alignments and resume:
+        raise ValueError("the alignments of a stream are not kept and can not be resumed")
+    if max_alignments_in_memory is not None and (columnar_parser or workers > 1):
+        raise ValueError("spilling the alignments to disk can not be combined with the columnar parser or workers")
+
 
-    optional_path_prefix = ""
-    optional_path_prefix = "./src/STRcount/" # If you dont want to install to run the tool
+def count_with_engine(align, reads, loci, count_engine=GRAPHALIGNER_ENGINE, validate_fast_count=False,
+                      validation_file=None, min_identity=0.50, threads=1, fast_count_k=DEFAULT_ANCHOR_K, metrics=None):
+    """Count the repeats of the reads with count_engine, align() runs GraphAligner and returns its alignments.
 
-    command = f"{optional_path_prefix}genome_str_graph_generator.py --ref {ref} --config {config_file} {rep_orientation_arg} {pre_orientation_arg} {suf_orientation_arg} {verbose_arg} {only_use_provided_fixes_arg} {ucsc_browser_coords_arg} > {out_dir}tmp/genome_str_graph.gfa"
-    print_red(command)
-    str_graph_generator = os.system(command)
+    With validate_fast_count both engines are run and their counts per read and locus are written to
+    validation_file, see fast_count.compare_counts(). The fast engine is measured in metrics, a
+    stage_metrics.StageMetrics. Returns the alignments of count_engine.
+    """
+    if count_engine not in COUNT_ENGINES:
+        raise ValueError(f"unknown count engine {count_engine}")
+    if metrics is None:
+        metrics = StageMetrics()
 
-    if str_graph_generator == 0:
+    def count_fast():
+        from fast_count import fast_count
+        with metrics.stage("fast_count") as counts:
+            fast_alignments = fast_count(reads, loci, min_identity, fast_count_k, processes=threads)
+            counts["kept_alignments"] = len(fast_alignments)
+        return fast_alignments
+
+    if count_engine == FAST_ENGINE and not validate_fast_count:
+        alignments = count_fast()
+        logging.info("A read wise count has been generated without aligning the reads")
+        return alignments
+    alignments = align()
+    if not validate_fast_count:
+        return alignments
+    fast_alignments = count_fast()
+    from fast_count import compare_counts
+    with open(validation_file, "w") as out:
+        n_both, n_equal, n_only_graphaligner, n_only_fast = compare_counts(alignments, fast_alignments, out)
+    logging.info(f"{n_equal} of {n_both} reads have the same count with both engines, {n_only_graphaligner} reads "
+                 f"were only counted with GraphAligner and {n_only_fast} only with the fast engine, see "
+                 f"{validation_file}")
+    if count_engine == FAST_ENGINE:
+        if isinstance(alignments, SpilledAlignments):
+            alignments.close()
+        return fast_alignments
+    return alignments
+
+
+def generate_graph(config,
+                   reference,
+                   tmp_dir,
+                   repeat_orientation="+",
+                   prefix_orientation="+",
+                   suffix_orientation="+",
+                   only_use_provided_fixes=False,
+                   ucsc_browser_coords=False,
+                   use_fixed_len_before_and_after_fixes=False,
+                   before_and_after_fixes_len=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN,
+                   graph_cache_dir=None,
+                   graph_cache_max_bytes=DEFAULT_MAX_CACHE_BYTES,
+                   resume=False,
+                   verbose=False):
+    """Write the STR graph to tmp_dir, or with graph_cache_dir take it from a GraphCache in that directory, and
+    return the path of the graph. With resume a graph in tmp_dir that was generated from the same inputs, see
+    checkpoint.Checkpoints, is used instead of generating it again."""
+    if graph_cache_dir:
+        graph_file = GraphCache(graph_cache_dir, graph_cache_max_bytes).get_graph(
+            config, reference, repeat_orientation, prefix_orientation, suffix_orientation, only_use_provided_fixes,
+            ucsc_browser_coords, verbose, use_fixed_len_before_and_after_fixes, before_and_after_fixes_len)
         logging.info("STR Reference Graph has been generated")
-    else:
-        logging.error("Error while Generating STR genome graph")
+        return graph_file
 
-    command = f"GraphAligner {seed_arg} {id_thres_arg} -g {out_dir}tmp/genome_str_graph.gfa -f {reads} -a {out_dir}tmp/alignment.gaf -x vg {threads_arg} {verbose_arg}"
-    print_red(command)
-    ga_align = os.system(command)
+    graph_file = os.path.join(tmp_dir, "genome_str_graph.gfa")
+    if resume:
+        checkpoints = Checkpoints(tmp_dir)
+        key = graph_cache_key(config, reference, repeat_orientation, prefix_orientation, suffix_orientation,
+                              only_use_provided_fixes, ucsc_browser_coords, use_fixed_len_before_and_after_fixes,
+                              before_and_after_fixes_len)
+        if checkpoints.is_done("graph", key):
+            logging.info(f"Using the graph {graph_file} of the previous run")
+            return graph_file
+    # the graph is renamed when it is complete, so an interrupted run never leaves a partial graph behind
+    with open(graph_file + ".part", "w") as out:
+        write_genome_str_graph(iter_genome_str_graph(config, reference, repeat_orientation, prefix_orientation,
+                                                     suffix_orientation, only_use_provided_fixes,
+                                                     ucsc_browser_coords, verbose,
+                                                     use_fixed_len_before_and_after_fixes,
+                                                     before_and_after_fixes_len), out)
+    os.replace(graph_file + ".part", graph_file)
+    if resume:
+        checkpoints.done("graph", key, [graph_file])
+    logging.info("STR Reference Graph has been generated")
+    return graph_file
 
-    if ga_align == 0:
-        logging.info("Reads aligned to Reference Graph")
-    else:
-        logging.error("Error in aligning the reads to the reference graph")
 
-    command = f"{optional_path_prefix}parse_gaf.py --input {out_dir}tmp/alignment.gaf {min_id_arg} {min_align_arg} {span_arg} {verbose_arg} > {out_dir}{out_file}"
-    print_red(command)
-    parse_gaf = os.system(command)
+def align_and_count(graph_file,
+                    graph_nodes,
+                    locus_names,
+                    reads,
+                    tmp_dir,
+                    min_identity=0.50,
+                    min_aligned_fraction=0.8,
+                    write_non_spanned=False,
+                    multiseed_dp="",
+                    precise_clipping="",
+                    threads=1,
+                    stream_alignments=False,
+                    columnar_parser=False,
+                    workers=1,
+                    max_alignments_in_memory=None,
+                    prefilter_loci=None,
+                    prefilter_k=DEFAULT_K,
+                    resume=False,
+                    chunk_reads=DEFAULT_CHUNK_READS,
+                    shards=1,
+                    gaf_compression=NO_COMPRESSION,
+                    gaf_index=False,
+                    mmap_parser=False,
+                    metrics=None,
+                    verbose=False):
+    """Align the reads to the graph with GraphAligner and count the repeats, see run_pipeline().
+
+    graph_nodes and locus_names are the ones of the graph, see read_graph_nodes() and get_locus_names(). The
+    alignments are written to tmp_dir. With prefilter_loci only the reads that share k-mers with these loci, see
+    read_prefilter.prefilter_reads(), are aligned. With resume the reads are aligned in chunks of chunk_reads reads,
+    see checkpoint.align_in_chunks(), and the chunks that were aligned by a previous run with the same inputs are
+    not aligned again. With more than one shard the reads are aligned in shards by several GraphAligner processes
+    that share the threads, see shard_alignment.align_in_shards(). With gaf_compression the alignments are written
+    compressed to alignment.gaf.gz or .zst, and with gaf_index they are indexed by read name, see
+    compressed_io.write_gaf(). With mmap_parser the alignment files are parsed by parse_gaf_mmap.parse_gaf_mmap().
+    The stages are measured in metrics, a stage_metrics.StageMetrics.
+    """
+    check_parse_options(stream_alignments, columnar_parser, workers, max_alignments_in_memory, resume, shards,
+                        gaf_compression, gaf_index, mmap_parser)
+    if metrics is None:
+        metrics = StageMetrics()
+    alignment_file = os.path.join(tmp_dir, "alignment.gaf")
+    compressed_alignment_file = alignment_file + EXTENSIONS[gaf_compression]
+
+    def parse(records, counts):
+        records = count_records(records, counts)
+        if max_alignments_in_memory is not None:
+            return parse_gaf_external(records, min_identity, min_aligned_fraction, write_non_spanned, locus_names,
+                                      max_alignments_in_memory, tmp_dir, graph_nodes)
+        if columnar_parser:
+            from parse_gaf_columnar import parse_gaf_columnar
+            alignments = parse_gaf_columnar(records, min_identity, min_aligned_fraction, write_non_spanned,
+                                            locus_names, graph_nodes=graph_nodes)
+        else:
+            alignments = parse_gaf(records, min_identity, min_aligned_fraction, write_non_spanned, locus_names,
+                                   verbose, graph_nodes)
+        counts["kept_alignments"] = len(alignments)
+        return alignments
+
+    def parse_mmap(gaf_files, counts):
+        from parse_gaf_mmap import parse_gaf_mmap
+        alignments = dict()
+        for gaf_file in gaf_files:
+            file_alignments = parse_gaf_mmap(gaf_file, min_identity, min_aligned_fraction, write_non_spanned,
+                                             locus_names, graph_nodes, counts=counts)
+            if not alignments:
+                alignments = file_alignments
+                continue
+            for ga in file_alignments.values():
+                add_alignment(alignments, ga)
+        counts["kept_alignments"] = len(alignments)
+        return alignments
 
-    if parse_gaf == 0:
-        logging.info("A read wise count has been generated")
+    def get_command(reads, alignment_file, threads=threads):
+        command = get_graphaligner_command(graph_file, reads, alignment_file, multiseed_dp, precise_clipping,
+                                           threads, verbose)
+        print_red(" ".join(command))
+        return command
+
+    def prefilter(reads):
+        if prefilter_loci is None:
+            return reads
+        # GraphAligner tells FASTA and FASTQ apart by the file extension
+        filtered_reads = os.path.join(tmp_dir, "prefiltered_" + os.path.basename(reads).replace(".gz", ""))
+        from read_prefilter import prefilter_reads
+        with metrics.stage("prefilter") as counts:
+            n_reads, n_kept = prefilter_reads(reads, filtered_reads, prefilter_loci, prefilter_k, processes=threads)
+            counts.update(reads=n_reads, kept_reads=n_kept)
+        logging.info(f"{n_kept} of {n_reads} reads share k-mers with the loci and are aligned")
+        return filtered_reads
+
+    if shards > 1:
+        from shard_alignment import align_in_shards
+        reads = prefilter(reads)
+        with metrics.stage("alignment_and_parse") as counts:
+            alignments = parse(align_in_shards(get_command, reads, os.path.join(tmp_dir, "shards"), shards, threads),
+                               counts)
+        logging.info("Reads aligned to Reference Graph in shards and a read wise count has been generated")
+        return alignments
+
+    if resume:
+        checkpoints = Checkpoints(tmp_dir)
+        key = inputs_key({"graph": file_signature(graph_file), "reads": file_signature(reads),
+                          "multiseed_dp": multiseed_dp, "precise_clipping": precise_clipping,
+                          "prefilter": [prefilter_loci, prefilter_k] if prefilter_loci is not None else None,
+                          "chunk_reads": chunk_reads})
+        chunk_dir = os.path.join(tmp_dir, "alignment_chunks")
+        if checkpoints.is_done("alignment", key):
+            gaf_files = checkpoints.stages["alignment"]["outputs"]
+            logging.info("Using the alignments of the previous run")
+        else:
+            if checkpoints.key("alignment") != key:
+                clear_chunks(chunk_dir)
+                checkpoints.start("alignment", key)
+            reads = prefilter(reads)
+            with metrics.stage("alignment"):
+                gaf_files = align_in_chunks(get_command, reads, chunk_dir, chunk_reads)
+            checkpoints.done("alignment", key, gaf_files)
+            logging.info("Reads aligned to Reference Graph")
+        if workers <= 1:
+            with metrics.stage("parse") as counts:
+                if mmap_parser:
+                    alignments = parse_mmap(gaf_files, counts)
+                else:
+                    alignments = parse(iter_gaf_files(gaf_files), counts)
+            logging.info("A read wise count has been generated")
+            return alignments
+        with open(alignment_file, "w") as out:
+            for gaf_file in gaf_files:
+                with open(gaf_file) as f:
+                    shutil.copyfileobj(f, out)
     else:
-        logging.error("Error in parsing the alignments")
+        alignment_output = alignment_file
+        if gaf_compression != NO_COMPRESSION or gaf_index:
+            # GraphAligner writes plain GAF, it is compressed and indexed on its way from a named pipe to disk
+            alignment_output = os.path.join(tmp_dir, "alignment_fifo.gaf")
+        command = get_command(prefilter(reads), alignment_output)
+        if stream_alignments:
+            with metrics.stage("alignment_and_parse") as counts:
+                alignments = parse(stream_graphaligner(command, alignment_file), counts)
+            logging.info("Reads aligned to Reference Graph and a read wise count has been generated")
+            return alignments
+
+        with metrics.stage("alignment"):
+            if alignment_output != alignment_file:
+                write_gaf(stream_graphaligner(command, alignment_output), compressed_alignment_file, gaf_compression,
+                          gaf_index, threads)
+                alignment_file = compressed_alignment_file
+            else:
+                subprocess.run(command, check=True)
+        logging.info("Reads aligned to Reference Graph")
+
+    with metrics.stage("parse") as counts:
+        if workers > 1:
+            alignments = parse_gaf_parallel(alignment_file, workers, min_identity, min_aligned_fraction,
+                                            write_non_spanned, locus_names, columnar_parser, graph_nodes)
+            counts["kept_alignments"] = len(alignments)
+        elif mmap_parser:
+            alignments = parse_mmap([alignment_file], counts)
+        else:
+            with open_text(alignment_file, threads) as f:
+                alignments = parse(f, counts)
+    logging.info("A read wise count has been generated")
+    return alignments
+
+
+def run_pipeline(config,
+                 reference,
+                 reads,
+                 out_dir="./",
+                 min_identity=0.50,
+                 min_aligned_fraction=0.8,
+                 write_non_spanned=False,
+                 repeat_orientation="+",
+                 prefix_orientation="+",
+                 suffix_orientation="+",
+                 only_use_provided_fixes=False,
+                 ucsc_browser_coords=False,
+                 use_fixed_len_before_and_after_fixes=False,
+                 before_and_after_fixes_len=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN,
+                 multiseed_dp="",
+                 precise_clipping="",
+                 threads=1,
+                 stream_alignments=False,
+                 columnar_parser=False,
+                 workers=1,
+                 max_alignments_in_memory=None,
+                 graph_cache_dir=None,
+                 graph_cache_max_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 prefilter=False,
+                 prefilter_k=DEFAULT_K,
+                 count_engine=GRAPHALIGNER_ENGINE,
+                 validate_fast_count=False,
+                 fast_count_k=DEFAULT_ANCHOR_K,
+                 resume=False,
+                 chunk_reads=DEFAULT_CHUNK_READS,
+                 shards=1,
+                 gaf_compression=NO_COMPRESSION,
+                 gaf_index=False,
+                 mmap_parser=False,
+                 metrics=None,
+                 verbose=False):
+    """Generate the STR graph, align the reads to it with GraphAligner and count the repeats.
+
+    Only GraphAligner is run as a separate process, it reads the graph from and writes the alignments to the tmp
+    folder in out_dir. With stream_alignments the alignments are written to a named pipe instead and counted while
+    GraphAligner is still running, so they never hit the disk. With columnar_parser the alignments are parsed with
+    parse_gaf_columnar() instead of parse_gaf(). With more than one worker the alignment file is parsed in parallel
+    by parse_gaf_parallel(), this can not be combined with stream_alignments.
+    Returns the best alignment per (read name, locus) as returned by parse_gaf(). With max_alignments_in_memory the
+    alignments are parsed by parse_gaf_external() and a SpilledAlignments is returned instead, which has to be closed.
+    With graph_cache_dir the graph is taken from a GraphCache in that directory and only generated if it is missing.
+    With prefilter only the reads that share k-mers of length prefilter_k with the prefix, repeat or suffix of a
+    locus are aligned, the reads are checked by as many processes as GraphAligner has threads.
+    With count_engine "fast" the repeats are counted by fast_count.fast_count() with threads processes and flank
+    anchors of length fast_count_k instead, no graph is generated and GraphAligner is not needed. With
+    validate_fast_count both engines are run and their counts are compared in fast_count_validation.tsv in out_dir.
+    With resume the graph and the alignments of a previous run in out_dir with the same inputs are used, and the
+    reads are aligned in chunks of chunk_reads reads so an interrupted alignment only aligns the chunks that are
+    missing, see checkpoint.Checkpoints.
+    With more than one shard the reads are split into shards that are aligned by several GraphAligner processes at
+    the same time, threads is then the number of threads of all of them, at most the number of cores.
+    With gaf_compression "gzip" or "zstd" the alignments are written compressed to the tmp folder and with gaf_index
+    indexed by read name, see compressed_io.write_gaf(). With mmap_parser the plain alignment files are parsed on
+    a memory mapped file by parse_gaf_mmap.parse_gaf_mmap().
+    The wall time, CPU time, memory and throughput of the stages are recorded in metrics, a
+    stage_metrics.StageMetrics.
+    Raises subprocess.CalledProcessError if GraphAligner fails.
+    """
+    check_parse_options(stream_alignments, columnar_parser, workers, max_alignments_in_memory, resume, shards,
+                        gaf_compression, gaf_index, mmap_parser)
+    if metrics is None:
+        metrics = StageMetrics()
+    tmp_dir = os.path.join(out_dir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    loci = load_config(config, ucsc_browser_coords)
+
+    def align():
+        with metrics.stage("graph"):
+            graph_file = generate_graph(config, reference, tmp_dir, repeat_orientation, prefix_orientation,
+                                        suffix_orientation, only_use_provided_fixes, ucsc_browser_coords,
+                                        use_fixed_len_before_and_after_fixes, before_and_after_fixes_len,
+                                        graph_cache_dir, graph_cache_max_bytes, resume, verbose)
+        locus_names = get_locus_names(config)
+        # look the nodes of the alignment paths up in the graph instead of guessing their role from their names
+        graph_nodes = read_graph_nodes(graph_file)
+
+        return align_and_count(graph_file, graph_nodes, locus_names, reads, tmp_dir, min_identity,
+                               min_aligned_fraction, write_non_spanned, multiseed_dp, precise_clipping, threads,
+                               stream_alignments, columnar_parser, workers, max_alignments_in_memory,
+                               loci if prefilter else None, prefilter_k, resume, chunk_reads, shards,
+                               gaf_compression, gaf_index, mmap_parser, metrics, verbose)
+
+    return count_with_engine(align, reads, loci, count_engine, validate_fast_count,
+                             os.path.join(out_dir, FAST_COUNT_VALIDATION_FILE), min_identity, threads, fast_count_k,
+                             metrics)
+
+
+def count_key(config, reference, reads, output, options):
+    """The hash of the inputs of the count stage that writes the alignments of reads to output, see
+    checkpoint.Checkpoints. options are the keyword arguments of run_pipeline()."""
+    return inputs_key({"config": file_signature(config), "reference": file_signature(reference),
+                       "reads": file_signature(reads), "output": os.path.abspath(output), "options": options})
+
+
+# options of run_pipeline() that change how fast the reads are counted, not their counts
+PERFORMANCE_OPTIONS = {"threads", "stream_alignments", "columnar_parser", "workers", "max_alignments_in_memory",
+                       "graph_cache_dir", "graph_cache_max_bytes", "resume", "chunk_reads", "shards",
+                       "gaf_compression", "gaf_index", "mmap_parser", "verbose"}
+
+
+def store_key(config, reference, options):
+    """The hash of the inputs the batches of an alignment_store.AlignmentStore are counted with. options are the
+    keyword arguments of run_pipeline(), batches can be counted with other PERFORMANCE_OPTIONS."""
+    return inputs_key({"config": file_signature(config), "reference": file_signature(reference),
+                       "options": {name: value for name, value in options.items()
+                                   if name not in PERFORMANCE_OPTIONS}})
+
+
+def count_batch(store, config, reference, reads, out_dir="./", metrics=None, **kwargs):
+    """Count the reads, a new batch of reads of a sample, with run_pipeline() and merge their alignments into store,
+    an alignment_store.AlignmentStore. The batch is identified by the path, size and modification time of reads, a
+    batch that was merged before is not counted again. kwargs are passed to run_pipeline().
+    Returns the number of new and replaced alignments, or None if the batch was merged before."""
+    batch = inputs_key(file_signature(reads))
+    if store.has_batch(batch):
+        return None
+    if metrics is None:
+        metrics = StageMetrics()
+    alignments = run_pipeline(config, reference, reads, out_dir=out_dir, metrics=metrics, **kwargs)
+    try:
+        with metrics.stage("merge") as counts:
+            n_new, n_replaced = store.merge(alignments, batch)
+            counts.update(new_alignments=n_new, replaced_alignments=n_replaced)
+    finally:
+        if isinstance(alignments, SpilledAlignments):
+            alignments.close()
+    return n_new, n_replaced
+
+
+def write_counts(alignments, output, checkpoints=None, key=None, metrics=None, output_format=TSV_FORMAT,
+                 compression=DEFAULT_COMPRESSION, genotype=False, min_identity=0.50):
+    """Write the alignments to output, the file is renamed when it is complete. With checkpoints the count stage is
+    recorded as done with key. With metrics, a stage_metrics.StageMetrics, the stages are written to
+    <output>.metrics.json, see write_metrics(). With output_format "parquet" or "arrow" the alignments are written
+    with compression as typed columns, see columnar_output.write_output(). With genotype the alleles of every locus
+    are called from the written counts of the reads with min_identity and written to <output>.genotypes.tsv, see
+    genotype.genotype_files()."""
+    with (metrics or StageMetrics()).stage("write"):
+        write_output(alignments, output + ".part", output_format, compression)
+        os.replace(output + ".part", output)
+        if isinstance(alignments, SpilledAlignments):
+            alignments.close()
+    outputs = [output]
+    if genotype:
+        from genotype import genotype_files
+        genotypes_file = output_stem(output) + ".genotypes.tsv"
+        with (metrics or StageMetrics()).stage("genotype"):
+            with open(genotypes_file + ".part", "w") as out:
+                genotype_files([output], out, min_identity=min_identity)
+            os.replace(genotypes_file + ".part", genotypes_file)
+        outputs.append(genotypes_file)
+    if checkpoints is not None:
+        checkpoints.done("count", key, outputs)
+    if metrics is not None:
+        write_metrics(metrics, output)
+
+
+def output_stem(output):
+    """output without its extension .tsv, .parquet or .arrow, the files written next to it are named after it."""
+    for extension in FILE_EXTENSIONS.values():
+        if output.endswith(extension):
+            return output[:-len(extension)]
+    return output
+
+
+def write_metrics(metrics, output):
+    """Write the report of metrics, a stage_metrics.StageMetrics, next to output to <output stem>.metrics.json, see
+    output_stem()."""
+    metrics_file = output_stem(output) + ".metrics.json"
+    with open(metrics_file, "w") as out:
+        metrics.write(out)
+    return metrics_file
+
+
+def load_sample_sheet(sample_sheet):
+    """Read the sample sheet, a TSV file with a header and the columns sample and fastq, into a list of
+    (sample, fastq). The sample names are used as file names and have to be unique."""
+    samples = list()
+    names = set()
+    try:
+        with open(sample_sheet) as f:
+            header = f.readline()
+            for line in f:
+                if line.startswith("#") or not line.strip():
+                    continue
+                sample, fastq = line.rstrip("\n").split("\t")[:2]
+                if not sample or sample in (".", "..") or os.sep in sample:
+                    raise ValueError(f"{sample} can not be used as a sample name")
+                if sample in names:
+                    raise ValueError(f"sample name {sample} is used more than once")
+                names.add(sample)
+                samples.append((sample, fastq))
+    except Exception as e:
+        sys.stderr.write("Error in sample sheet: " + str(e) + "\n")
+        sys.exit(1)
+    return samples
+
+
+def run_samples(config, reference, samples, out_dir="./", jobs=1, metrics_report=False, output_format=TSV_FORMAT,
+                compression=DEFAULT_COMPRESSION, genotype=False, **kwargs):
+    """Run the pipeline for many samples with one graph.
+
+    The graph is generated once, then up to jobs samples are aligned and counted at the same time, each GraphAligner
+    with the threads given in kwargs. samples is a list of (sample, reads) as returned by load_sample_sheet(), kwargs
+    are the keyword arguments of run_pipeline(). The alignments of a sample are written to out_dir/<sample>.tsv as
+    soon as it is done, its temporary files go to the tmp/<sample> folder in out_dir. With validate_fast_count the
+    counts of the engines are compared in out_dir/<sample>_fast_count_validation.tsv. With resume the samples whose
+    output was written by a previous run with the same inputs are skipped. With metrics_report the metrics of the
+    stages, see stage_metrics.StageMetrics, are written to out_dir/<sample>.metrics.json and the ones of the graph
+    to out_dir/graph.metrics.json. With output_format "parquet" or "arrow" the alignments are written to
+    out_dir/<sample>.parquet or .arrow instead, and with genotype the alleles to out_dir/<sample>.genotypes.tsv, see
+    write_counts().
+    Returns the output file per sample in the order of samples. Samples that failed are logged and left out.
+    """
+    check_output_format(output_format, compression)
+    options = dict(kwargs, output_format=output_format, compression=compression, genotype=genotype)
+    graph_options = {option: kwargs.pop(option) for option in GRAPH_OPTIONS if option in kwargs}
+    loci = load_config(config, graph_options.get("ucsc_browser_coords", False))
+    if kwargs.pop("prefilter", False):
+        kwargs["prefilter_loci"] = loci
+    count_engine = kwargs.pop("count_engine", GRAPHALIGNER_ENGINE)
+    validate_fast_count = kwargs.pop("validate_fast_count", False)
+    fast_count_k = kwargs.pop("fast_count_k", DEFAULT_ANCHOR_K)
+    if count_engine not in COUNT_ENGINES:
+        raise ValueError(f"unknown count engine {count_engine}")
+    check_parse_options(kwargs.get("stream_alignments", False), kwargs.get("columnar_parser", False),
+                        kwargs.get("workers", 1), kwargs.get("max_alignments_in_memory"), kwargs.get("resume", False),
+                        kwargs.get("shards", 1), kwargs.get("gaf_compression", NO_COMPRESSION),
+                        kwargs.get("gaf_index", False), kwargs.get("mmap_parser", False))
+    tmp_dir = os.path.join(out_dir, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    graph_file, graph_nodes = None, None
+    if count_engine != FAST_ENGINE or validate_fast_count:
+        graph_metrics = StageMetrics()
+        with graph_metrics.stage("graph"):
+            graph_file = generate_graph(config, reference, tmp_dir, resume=kwargs.get("resume", False),
+                                        verbose=kwargs.get("verbose", False), **graph_options)
+        if metrics_report:
+            write_metrics(graph_metrics, os.path.join(out_dir, "graph"))
+        graph_nodes = read_graph_nodes(graph_file)
+    locus_names = get_locus_names(config)
+
+    def count_sample(sample, reads):
+        sample_tmp_dir = os.path.join(tmp_dir, sample)
+        os.makedirs(sample_tmp_dir, exist_ok=True)
+        output = os.path.join(out_dir, sample + FILE_EXTENSIONS[output_format])
+        checkpoints, key = None, None
+        if kwargs.get("resume", False):
+            checkpoints = Checkpoints(sample_tmp_dir)
+            key = count_key(config, reference, reads, output, options)
+            if checkpoints.is_done("count", key):
+                logging.info(f"Sample {sample} was done by the previous run")
+                return output
+        metrics = StageMetrics()
+        alignments = count_with_engine(
+            lambda: align_and_count(graph_file, graph_nodes, locus_names, reads, sample_tmp_dir, metrics=metrics,
+                                    **kwargs),
+            reads, loci, count_engine, validate_fast_count,
+            os.path.join(out_dir, sample + "_" + FAST_COUNT_VALIDATION_FILE), kwargs.get("min_identity", 0.50),
+            kwargs.get("threads", 1), fast_count_k, metrics)
+        write_counts(alignments, output, checkpoints, key, metrics if metrics_report else None, output_format,
+                     compression, genotype, kwargs.get("min_identity", 0.50))
+        logging.info(f"Sample {sample} is done")
+        return output
+
+    # GraphAligner runs in its own process, so threads are enough to run several samples at the same time
+    outputs = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(count_sample, sample, reads): sample for sample, reads in samples}
+        for future in concurrent.futures.as_completed(futures):
+            sample = futures[future]
+            try:
+                outputs[sample] = future.result()
+            except FileNotFoundError as e:
+                logging.error(f"Could not run the pipeline for sample {sample}: {e}")
+            except subprocess.CalledProcessError as e:
+                logging.error(f"Error in aligning the reads of sample {sample} to the reference graph, GraphAligner "
+                              f"exited with {e.returncode}")
+    return {sample: outputs[sample] for sample, _ in samples if sample in outputs}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Software tool to analyse STR loci from long read data. STRcount can count the number of repeats in a repeat expansion and give you the count in a tabular format for further downstream analysis.')
+    parser.add_argument('--reference', help='the reference from which the STR Graph will be generated', required=True)
+    parser.add_argument('--fastq', help='the baseaclled reads in fastq format, required unless --samples is given', required=False)
+    parser.add_argument('--config', help='the config file', required=True)
+    parser.add_argument('--output', help='the output file, required unless --samples is given', required=False)
+    parser.add_argument('--samples', help='a sample sheet, a TSV file with the columns sample and fastq, to count the reads of several samples with one graph instead of --fastq. The output of each sample is written to <sample>.tsv in the output directory', required=False)
+    parser.add_argument('--jobs', type=int, default=1, help='Number of samples of the sample sheet that are aligned at the same time, each with --threads threads (default: 1)')
+    parser.add_argument('--min-identity', type=float, default=0.50, help='only use reads with identity greater than this', required=False)
+    parser.add_argument('--min-aligned-fraction', type=float, default=0.8, help='require alignments cover this proportion of the query sequence', required=False)
+    parser.add_argument('--write-non-spanned', action='store_true', default=False, help='do not require the reads to span the prefix/suffix region', required=False)
+    parser.add_argument('--repeat_orientation', help='the orientation of the repeat string. + or -', required=False, default="+")
+    parser.add_argument('--prefix_orientation', help='the orientation of the prefix, + or -', required=False, default="+")
+    parser.add_argument('--suffix_orientation', help='the orientation of the suffix, + or -', required=False, default="+")
+    parser.add_argument('--cleanup', help='do you want to clean up the temporary file?', required=False, default="yes")
+    parser.add_argument('--output_directory', help='the output directory for all output and temporary files', required=False, default="./")
+    parser.add_argument('--multiseed-DP', help='Aligner option', required=False, default="")
+    parser.add_argument('--precise-clipping', help='Aligner option: use arg as the identity threshold for a valid alignment.', required=False, default="")
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of threads for GraphAligner (default: 1)')
+    parser.add_argument('--stream_alignments', action='store_true', help='count the repeats while GraphAligner is still running by reading its alignments from a named pipe instead of a temporary file')
+    parser.add_argument('--columnar_parser', action='store_true', help='parse the alignments in chunks of 4 MB as columns with numpy, about twice as fast for large alignment files')
+    parser.add_argument('--mmap_parser', action='store_true', help='parse the alignment file on a memory mapped file, only the columns that are used are copied from it. Can not be combined with --stream_alignments, --columnar_parser, --max_alignments_in_memory, --shards or --gaf_compression')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes that parse the alignments in parallel, can not be combined with --stream_alignments (default: 1)')
+    parser.add_argument('--max_alignments_in_memory', type=int, default=None, help='spill the best alignments to temporary files in the output directory when more than this number of reads is kept in memory, can not be combined with --columnar_parser or --workers')
+    parser.add_argument('--graph_cache_dir', help='reuse the STR graph of earlier runs with the same config, reference and graph options from this directory', required=False, default=None)
+    parser.add_argument('--graph_cache_size', type=float, default=DEFAULT_MAX_CACHE_BYTES / 1024 ** 3, help=f'the size in GB above which the least recently used graphs are removed from the graph cache (default: {DEFAULT_MAX_CACHE_BYTES // 1024 ** 3})')
+    parser.add_argument('--prefilter', action='store_true', help='only align the reads that share k-mers with the prefix, repeat or suffix of a locus, the reads are checked by --threads processes')
+    parser.add_argument('--prefilter_k', type=int, default=DEFAULT_K, help=f'the k-mer length of --prefilter (default: {DEFAULT_K})')
+    parser.add_argument('--count_engine', choices=COUNT_ENGINES, default=GRAPHALIGNER_ENGINE, help='count the repeats by aligning the reads to the STR graph with GraphAligner, or with "fast" by anchoring the prefix and suffix of the loci in the reads and aligning the bases between them to copies of the repeat, with --threads processes. The fast engine does not need GraphAligner and only counts reads that span a locus, --min-aligned-fraction is not used (default: graphaligner)')
+    parser.add_argument('--validate_fast_count', action='store_true', help='run both count engines and compare their counts per read in fast_count_validation.tsv in the output directory')
+    parser.add_argument('--fast_count_k', type=int, default=DEFAULT_ANCHOR_K, help=f'the k-mer length the fast count engine anchors the prefix and suffix with, has to be shorter than them (default: {DEFAULT_ANCHOR_K})')
+    parser.add_argument('--resume', action='store_true', help='skip the stages that a previous run with the same inputs and output directory finished, the reads are aligned in chunks so only the chunks that were not aligned are aligned again. Can not be combined with --stream_alignments')
+    parser.add_argument('--chunk_reads', type=int, default=DEFAULT_CHUNK_READS, help=f'the number of reads per chunk with --resume (default: {DEFAULT_CHUNK_READS})')
+    parser.add_argument('--shards', type=int, default=1, help='split the reads into this number of shards that are aligned by several GraphAligner processes at the same time, --threads is then split between them and limited to the number of cores. Can not be combined with --stream_alignments, --resume or --workers (default: 1)')
+    parser.add_argument('--gaf_compression', choices=GAF_COMPRESSIONS, default=NO_COMPRESSION, help='write the alignments of GraphAligner bgzip (gzip) or zstd compressed to tmp/alignment.gaf.gz or .zst, they are compressed while GraphAligner writes them and decompressed by bgzip, pigz or zstd while they are parsed when --threads is more than 1. Can not be combined with --stream_alignments, --resume, --shards or --workers (default: none)')
+    parser.add_argument('--gaf_index', action='store_true', help='index the alignment file by read name in tmp/alignment.gaf.rni, or .gaf.gz.rni, to fetch the alignments of single reads with compressed_io.py --read. Can not be combined with --gaf_compression zstd')
+    parser.add_argument('--metrics', action='store_true', help='write the wall time, CPU time, peak memory, bytes read and written and throughput of every stage to <output>.metrics.json next to the output')
+    parser.add_argument('--output_format', choices=OUTPUT_FORMATS, default=TSV_FORMAT, help='write the counts as TSV, or as typed columns in a Parquet or Arrow IPC file, which need pyarrow. With --samples the outputs are named <sample>.parquet or <sample>.arrow (default: tsv)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=DEFAULT_COMPRESSION, help=f'the compression of the parquet and arrow output, arrow only supports zstd, lz4 and none (default: {DEFAULT_COMPRESSION})')
+    parser.add_argument('--genotype', action='store_true', help='call one or two alleles per locus from the counts of the spanning reads with --min-identity, with their confidence intervals and read depth, and write them to <output>.genotypes.tsv next to the output. genotype.py does the same for the outputs of many samples')
+    parser.add_argument('--incremental', action='store_true', help='merge the alignments of --fastq, a new batch of reads of the sample, into <output>.alignments.sqlite next to the output and write the counts of all batches merged so far. Batches that were merged before are skipped, the config, reference and options have to be the ones of the first batch. Can not be combined with --samples or --resume')
+    parser.add_argument('--verbose', action='store_true', help='verbose')
+    parser.add_argument('--only_use_provided_fixes', action='store_true', help='only use the provided suffixes and prefixes, not the complete reference sequence.')
+    parser.add_argument('--use_fixed_len_before_and_after_fixes', action='store_true', help='Use a fixed length for the before or after prefix or suffix sequences and not using the complete reference sequence.')
+    parser.add_argument('--before_and_after_fixes_len', type=int, default=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN, help=f'the number of reference bases to use before the prefix and after the suffix when --use_fixed_len_before_and_after_fixes is set. Reads much longer than the window can fail --min-aligned-fraction (default: {DEFAULT_BEFORE_AND_AFTER_FIXES_LEN})')
+    parser.add_argument('--ucsc_browser_coords', action='store_true',
+                            help='use UCSC browser coordinates, i.e. start counting at 1 and end is inclusive.')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.samples and (args.fastq or args.output):
+        print("Error: --samples can not be combined with --fastq or --output.")
+        exit(1)
+    if not args.samples and not (args.fastq and args.output):
+        print("Error: --fastq and --output are required unless --samples is given.")
+        exit(1)
+    if args.jobs < 1:
+        print("Error: --jobs has to be at least 1.")
+        exit(1)
+    if not 0 < args.prefilter_k <= MAX_K:
+        print(f"Error: --prefilter_k has to be between 1 and {MAX_K}.")
+        exit(1)
+    if not 0 < args.fast_count_k <= MAX_K:
+        print(f"Error: --fast_count_k has to be between 1 and {MAX_K}.")
+        exit(1)
+    if args.use_fixed_len_before_and_after_fixes and args.only_use_provided_fixes:
+        print("Error: --use_fixed_len_before_and_after_fixes can not be combined with --only_use_provided_fixes.")
+        exit(1)
+    if args.workers < 1:
+        print("Error: --workers has to be at least 1.")
+        exit(1)
+    if args.workers > 1 and args.stream_alignments:
+        print("Error: --workers can not be combined with --stream_alignments.")
+        exit(1)
+    if args.resume and args.stream_alignments:
+        print("Error: --resume can not be combined with --stream_alignments.")
+        exit(1)
+    if args.shards < 1:
+        print("Error: --shards has to be at least 1.")
+        exit(1)
+    if args.shards > 1 and (args.stream_alignments or args.resume or args.workers > 1):
+        print("Error: --shards can not be combined with --stream_alignments, --resume or --workers.")
+        exit(1)
+    if (args.gaf_compression != NO_COMPRESSION or args.gaf_index) and (args.stream_alignments or args.resume or args.shards > 1 or args.workers > 1):
+        print("Error: --gaf_compression and --gaf_index can not be combined with --stream_alignments, --resume, --shards or --workers.")
+        exit(1)
+    if args.mmap_parser and (args.stream_alignments or args.columnar_parser or args.max_alignments_in_memory is not None or args.shards > 1 or args.gaf_compression != NO_COMPRESSION):
+        print("Error: --mmap_parser can not be combined with --stream_alignments, --columnar_parser, --max_alignments_in_memory, --shards or --gaf_compression.")
+        exit(1)
+    if args.gaf_index and args.gaf_compression == ZSTD:
+        print("Error: --gaf_index can not be combined with --gaf_compression zstd.")
+        exit(1)
+    if args.fastq and os.path.exists(args.fastq) and detect_compression(args.fastq) == ZSTD:
+        print("Error: GraphAligner can not read zstd compressed reads, compress them with bgzip or gzip instead.")
+        exit(1)
+    if args.incremental and (args.samples or args.resume):
+        print("Error: --incremental can not be combined with --samples or --resume.")
+        exit(1)
+    if args.chunk_reads < 1:
+        print("Error: --chunk_reads has to be at least 1.")
+        exit(1)
+    try:
+        load_config(args.config, args.ucsc_browser_coords)
+    except ValueError as e:
+        print(f"Error: {e}.")
+        exit(1)
+    except FileNotFoundError as e:
+        logging.error(f"Could not run the pipeline: {e}")
+        sys.exit(1)
+    try:
+        check_output_format(args.output_format, args.compression)
+    except ValueError as e:
+        print(f"Error: {e}.")
+        exit(1)
+    except ImportError:
+        print(f"Error: --output_format {args.output_format} needs pyarrow, install it with pip install pyarrow.")
+        exit(1)
+    if args.max_alignments_in_memory is not None:
+        if args.max_alignments_in_memory < 1:
+            print("Error: --max_alignments_in_memory has to be at least 1.")
+            exit(1)
+        if args.columnar_parser or args.workers > 1:
+            print("Error: --max_alignments_in_memory can not be combined with --columnar_parser or --workers.")
+            exit(1)
+
+    options = dict(min_identity=args.min_identity,
+                   min_aligned_fraction=args.min_aligned_fraction,
+                   write_non_spanned=args.write_non_spanned,
+                   repeat_orientation=args.repeat_orientation,
+                   prefix_orientation=args.prefix_orientation,
+                   suffix_orientation=args.suffix_orientation,
+                   only_use_provided_fixes=args.only_use_provided_fixes,
+                   ucsc_browser_coords=args.ucsc_browser_coords,
+                   use_fixed_len_before_and_after_fixes=args.use_fixed_len_before_and_after_fixes,
+                   before_and_after_fixes_len=args.before_and_after_fixes_len,
+                   multiseed_dp=args.multiseed_DP,
+                   precise_clipping=args.precise_clipping,
+                   threads=args.threads,
+                   stream_alignments=args.stream_alignments,
+                   columnar_parser=args.columnar_parser,
+                   workers=args.workers,
+                   max_alignments_in_memory=args.max_alignments_in_memory,
+                   graph_cache_dir=args.graph_cache_dir,
+                   graph_cache_max_bytes=int(args.graph_cache_size * 1024 ** 3),
+                   prefilter=args.prefilter,
+                   prefilter_k=args.prefilter_k,
+                   count_engine=args.count_engine,
+                   validate_fast_count=args.validate_fast_count,
+                   fast_count_k=args.fast_count_k,
+                   resume=args.resume,
+                   chunk_reads=args.chunk_reads,
+                   shards=args.shards,
+                   gaf_compression=args.gaf_compression,
+                   gaf_index=args.gaf_index,
+                   mmap_parser=args.mmap_parser,
+                   verbose=args.verbose)
+
+    if args.samples:
+        samples = load_sample_sheet(args.samples)
+        try:
+            outputs = run_samples(args.config, args.reference, samples, out_dir=args.output_directory,
+                                  jobs=args.jobs, metrics_report=args.metrics, output_format=args.output_format,
+                                  compression=args.compression, genotype=args.genotype, **options)
+        except FileNotFoundError as e:
+            logging.error(f"Could not run the pipeline: {e}")
+            sys.exit(1)
+        if len(outputs) < len(samples):
+            logging.error(f"{len(samples) - len(outputs)} of {len(samples)} samples failed")
+            sys.exit(1)
+        return
+
+    output = os.path.join(args.output_directory, args.output)
+    if args.incremental:
+        store = AlignmentStore(output_stem(output) + ".alignments.sqlite")
+        metrics = StageMetrics() if args.metrics else None
+        try:
+            store.check_inputs(store_key(args.config, args.reference, options))
+            merged = count_batch(store, args.config, args.reference, args.fastq, out_dir=args.output_directory,
+                                 metrics=metrics, **options)
+            if merged is None:
+                logging.info(f"{args.fastq} was merged before")
+            else:
+                logging.info(f"{merged[0]} new and {merged[1]} replaced alignments merged from {args.fastq}")
+            write_counts(store, output, metrics=metrics, output_format=args.output_format,
+                         compression=args.compression, genotype=args.genotype, min_identity=args.min_identity)
+        except ValueError as e:
+            print(f"Error: {e}.")
+            exit(1)
+        except FileNotFoundError as e:
+            logging.error(f"Could not run the pipeline: {e}")
+            sys.exit(1)
+        except subprocess.CalledProcessError as e:
+            logging.error(f"Error in aligning the reads to the reference graph, GraphAligner exited with {e.returncode}")
+            sys.exit(1)
+        finally:
+            store.close()
+        return
+
+    checkpoints, key = None, None
+    if args.resume:
+        checkpoints = Checkpoints(os.path.join(args.output_directory, "tmp"))
+        key = count_key(args.config, args.reference, args.fastq, output,
+                        dict(options, output_format=args.output_format, compression=args.compression,
+                             genotype=args.genotype))
+        if checkpoints.is_done("count", key):
+            logging.info(f"{output} was written by the previous run")
+            return
+
+    metrics = StageMetrics() if args.metrics else None
+    try:
+        alignments = run_pipeline(args.config, args.reference, args.fastq, out_dir=args.output_directory,
+                                  metrics=metrics, **options)
+    except FileNotFoundError as e:
+        logging.error(f"Could not run the pipeline: {e}")
+        sys.exit(1)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error in aligning the reads to the reference graph, GraphAligner exited with {e.returncode}")
+        sys.exit(1)
+
+    write_counts(alignments, output, checkpoints, key, metrics, args.output_format, args.compression, args.genotype,
+                 args.min_identity)
 
 if __name__ == "__main__":
     main()
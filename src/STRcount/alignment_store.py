@@ -0,0 +1,103 @@
+#! /usr/bin/env python
+"""The best alignment per (read name, locus) of all batches of reads of a sample, kept in an SQLite file.
+
+When the reads of a sample arrive in batches, every batch is aligned and parsed on its own and merged into the store
+with the rule of parse_gaf.add_alignment(): an alignment replaces the stored one of its read and locus only if its
+score is higher. The store then holds what parse_gaf() would return for the alignments of all batches together, in
+the same order, and an update costs as much as the new batch, not all reads of the sample.
+
+The store remembers the batches that were merged, so a batch is not merged twice, and the hash of the config,
+reference and options they were counted with, alignments counted with other inputs can not be merged.
+"""
+
+import sqlite3
+
+from parse_gaf import GraphAlignment
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS alignments (
+    position INTEGER PRIMARY KEY,
+    read_name TEXT NOT NULL,
+    locus TEXT NOT NULL,
+    strand TEXT NOT NULL,
+    spanned INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    alignment_score REAL NOT NULL,
+    identity REAL NOT NULL,
+    aligned_fraction REAL NOT NULL,
+    UNIQUE (read_name, locus)
+);
+CREATE TABLE IF NOT EXISTS batches (batch TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS inputs (key TEXT NOT NULL);
+"""
+
+# the position of an alignment is the one of the first alignment of its read and locus, like the keys of a dict
+_MERGE = """
+INSERT INTO alignments (read_name, locus, strand, spanned, count, alignment_score, identity, aligned_fraction)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (read_name, locus) DO UPDATE SET
+    strand = excluded.strand, spanned = excluded.spanned, count = excluded.count,
+    alignment_score = excluded.alignment_score, identity = excluded.identity,
+    aligned_fraction = excluded.aligned_fraction
+WHERE excluded.alignment_score > alignments.alignment_score
+"""
+
+
+class AlignmentStore:
+    """The alignments of the batches merged into the SQLite file path, which is created if it does not exist.
+    values() yields them like the values of the dict of parse_gaf(), so the store can be written with
+    parse_gaf.write_alignments()."""
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(_SCHEMA)
+
+    def check_inputs(self, key):
+        """Record key, the hash of the inputs the alignments are counted with, in a new store. Raises ValueError
+        if the store has alignments that were counted with other inputs."""
+        row = self.connection.execute("SELECT key FROM inputs").fetchone()
+        if row is None:
+            with self.connection:
+                self.connection.execute("INSERT INTO inputs (key) VALUES (?)", (key,))
+        elif row[0] != key:
+            raise ValueError(f"the alignments in {self.path} were counted with another config, reference or options")
+
+    def has_batch(self, batch):
+        """True if the batch, any string that identifies it, was merged."""
+        return self.connection.execute("SELECT 1 FROM batches WHERE batch = ?", (batch,)).fetchone() is not None
+
+    def merge(self, alignments, batch=None):
+        """Merge the alignments, a dict as returned by parse_gaf() or anything else with values(), and record the
+        batch in the same transaction. Returns the number of new and of replaced alignments."""
+        before = len(self)
+        changes = self.connection.total_changes
+        with self.connection:
+            self.connection.executemany(_MERGE, ((ga.read_name, ga.locus, ga.strand, int(ga.spanned), ga.count,
+                                                  ga.alignment_score, ga.identity, ga.aligned_fraction)
+                                                 for ga in alignments.values()))
+            # alignments that do not replace the stored one are not changes
+            n_changed = self.connection.total_changes - changes
+            if batch is not None:
+                self.connection.execute("INSERT OR IGNORE INTO batches (batch) VALUES (?)", (batch,))
+        n_new = len(self) - before
+        return n_new, n_changed - n_new
+
+    def values(self):
+        """Yield the alignments as GraphAlignment in the order their read and locus were first merged."""
+        cursor = self.connection.execute("SELECT read_name, strand, spanned, count, alignment_score, identity, "
+                                         "aligned_fraction, locus FROM alignments ORDER BY position")
+        for read_name, strand, spanned, count, score, identity, aligned_fraction, locus in cursor:
+            yield GraphAlignment(read_name, strand, bool(spanned), count, score, identity, aligned_fraction, locus)
+
+    def __len__(self):
+        return self.connection.execute("SELECT count(*) FROM alignments").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
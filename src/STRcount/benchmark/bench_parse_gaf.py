@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""Compare the speed of parse_gaf(), parse_gaf_columnar(), parse_gaf_mmap() and, with --workers, parse_gaf_parallel() on
+a synthetic GAF file and check that all give the same output. The first three are also timed with the nodes looked up
+in the graph.
+
+Run from this directory: python bench_parse_gaf.py --records 1000000
+"""
+
+import argparse
+import io
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append('..')
+from parse_gaf import parse_gaf, parse_gaf_parallel, read_graph_nodes, write_alignments
+from parse_gaf_columnar import parse_gaf_columnar
+from parse_gaf_mmap import parse_gaf_mmap
+
+
+def write_synthetic_gfa(out, n_loci=10):
+    """Write the nodes and links of the graph that write_synthetic_gaf() aligns to, without sequences."""
+    out.write("H\tVN:Z:a.0\n")
+    for locus in range(1, n_loci + 1):
+        nodes = [f"chr1_before_prefix_{locus}", f"chr1_prefix_{locus}", f"repeat_{locus}", f"chr1_suffix_{locus}",
+                 f"chr1_after_suffix_{locus}"]
+        for node in nodes:
+            out.write(f"S\t{node}\tA\n")
+        for from_node, to_node in zip(nodes[:3] + nodes[2:4], nodes[1:3] + nodes[2:]):
+            out.write(f"L\t{from_node}\t+\t{to_node}\t+\t0M\n")
+
+
+def write_synthetic_gaf(out, n_records, n_loci=10, max_repeats=200, seed=1):
+    """Write GraphAligner like alignments of reads to the graph of n_loci loci, some reads align several times."""
+    rng = random.Random(seed)
+    for i in range(n_records):
+        read_name = f"read_{rng.randrange(max(1, n_records // 2))} runid=abc"
+        locus = rng.randrange(1, n_loci + 1)
+        nodes = [f"chr1_prefix_{locus}"] + [f"repeat_{locus}"] * rng.randrange(0, max_repeats + 1)
+        spans_suffix = rng.random() < 0.9
+        if spans_suffix:
+            nodes.append(f"chr1_suffix_{locus}")
+        if rng.random() < 0.5:
+            # a path through the graph only reaches the after suffix node through the suffix
+            nodes = [f"chr1_before_prefix_{locus}"] + nodes + [f"chr1_after_suffix_{locus}"] * spans_suffix
+        path_dir = rng.choice("<>")
+        if path_dir == "<":
+            nodes.reverse()
+        query_len = rng.randrange(1000, 20000)
+        query_start = rng.randrange(0, query_len // 4)
+        query_end = query_len - rng.randrange(0, query_len // 4)
+        out.write(f"{read_name}\t{query_len}\t{query_start}\t{query_end}\t+\t{path_dir}{path_dir.join(nodes)}"
+                  f"\t50000\t100\t40000\t30000\t32000\t60\tNM:i:{rng.randrange(0, 2000)}"
+                  f"\tAS:f:{rng.randrange(0, 30000) / 2}\tdv:f:0.05\tid:f:{rng.uniform(0.3, 1.0)}\n")
+
+
+def read_and_parse(parse):
+    def parse_file(gaf_file):
+        with open(gaf_file) as f:
+            return parse(f)
+    return parse_file
+
+
+def time_parser(name, parse_file, gaf_file):
+    start = time.perf_counter()
+    alignments = parse_file(gaf_file)
+    elapsed = time.perf_counter() - start
+    out = io.StringIO()
+    write_alignments(alignments, out)
+    sys.stderr.write(f"{name}: {elapsed:.2f}s\n")
+    return elapsed, out.getvalue()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=200000, help='the number of alignments in the GAF file')
+    parser.add_argument('--loci', type=int, default=10, help='the number of loci in the graph')
+    parser.add_argument('--max-repeats', type=int, default=200, help='the maximum repeat count of a read')
+    parser.add_argument('--workers', type=int, nargs='*', default=[],
+                        help='also time parse_gaf_parallel() with these numbers of workers')
+    args = parser.parse_args()
+
+    parsers = [("parse_gaf", read_and_parse(parse_gaf)), ("parse_gaf_columnar", read_and_parse(parse_gaf_columnar)),
+               ("parse_gaf_mmap", parse_gaf_mmap)]
+    for workers in args.workers:
+        parsers.append((f"parse_gaf_parallel, {workers} workers",
+                        lambda gaf_file, workers=workers: parse_gaf_parallel(gaf_file, workers)))
+        parsers.append((f"parse_gaf_parallel columnar, {workers} workers",
+                        lambda gaf_file, workers=workers: parse_gaf_parallel(gaf_file, workers, columnar=True)))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".gfa") as gfa:
+        write_synthetic_gfa(gfa, args.loci)
+        gfa.flush()
+        graph_nodes = read_graph_nodes(gfa.name)
+    parsers.insert(3, ("parse_gaf with graph nodes",
+                       read_and_parse(lambda f: parse_gaf(f, graph_nodes=graph_nodes))))
+    parsers.insert(4, ("parse_gaf_columnar with graph nodes",
+                       read_and_parse(lambda f: parse_gaf_columnar(f, graph_nodes=graph_nodes))))
+    parsers.insert(5, ("parse_gaf_mmap with graph nodes",
+                       lambda gaf_file: parse_gaf_mmap(gaf_file, graph_nodes=graph_nodes)))
+
+    with tempfile.NamedTemporaryFile("w", suffix=".gaf") as gaf:
+        write_synthetic_gaf(gaf, args.records, args.loci, args.max_repeats)
+        gaf.flush()
+        timings = [(name,) + time_parser(name, parse_file, gaf.name) for name, parse_file in parsers]
+
+    _, line_time, line_output = timings[0]
+    for name, elapsed, output in timings[1:]:
+        if output != line_output:
+            sys.stderr.write(f"Error: the outputs of parse_gaf and {name} differ\n")
+            sys.exit(1)
+        sys.stderr.write(f"{name}: speedup {line_time / elapsed:.2f}x, output is identical\n")
@@ -0,0 +1,217 @@
+#! /usr/bin/env python
+"""Benchmarks of STRcount on synthetic data from synthetic_data.py, compared with the baselines in baselines.json.
+
+The cases are the start-up of the command line tools, generating the graph of the loci, parse_gaf(),
+parse_gaf_columnar() and parse_gaf_mmap() on GAF files of every size and end to end runs of run_pipeline() with
+stub_graphaligner.py as GraphAligner and with the fast count engine, so everything runs offline. Every case runs in its
+own process, its wall time and peak memory are measured and a hash of its output is compared with the baseline, a
+different hash means the output changed. The end to end cases also report the fraction of reads counted with their true
+repeat count.
+
+Run from this directory: python run_benchmarks.py --sizes 1000 100000 10000000
+The baselines are only comparable on the same machine, store new ones with --update-baselines.
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from unittest import mock
+
+sys.path.append('..')
+from synthetic_data import generate, parse_truth
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+DEFAULT_SIZES = [1000, 10000, 100000]
+# the command line tools whose start-up is timed
+SCRIPTS = ["STRcount.py", "parse_gaf.py", "genome_str_graph_generator.py"]
+STARTUP_REPEATS = 5
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def _write_graph(paths, graph_file):
+    from genome_str_graph_generator import iter_genome_str_graph, write_genome_str_graph
+    with open(graph_file, "w") as out:
+        write_genome_str_graph(iter_genome_str_graph(paths["config"], paths["reference"], "+", "+", "+"), out)
+
+
+def bench_graph(paths, tmp_dir):
+    graph_file = os.path.join(tmp_dir, "graph.gfa")
+    _write_graph(paths, graph_file)
+    with open(graph_file) as f:
+        return _digest(f.read()), {}
+
+
+def bench_parse(paths, tmp_dir, size, columnar, mmap=False):
+    # only the parser of the case is imported, numpy and pandas would count in the peak memory of the others
+    from parse_gaf import get_locus_names, parse_gaf, read_graph_nodes, write_alignments
+    graph_nodes = read_graph_nodes(paths["graph"])
+    locus_names = get_locus_names(paths["config"])
+    if mmap:
+        from parse_gaf_mmap import parse_gaf_mmap
+        alignments = parse_gaf_mmap(paths[f"alignments_{size}"], locus_names=locus_names, graph_nodes=graph_nodes)
+    else:
+        with open(paths[f"alignments_{size}"]) as f:
+            if columnar:
+                from parse_gaf_columnar import parse_gaf_columnar
+                alignments = parse_gaf_columnar(f, locus_names=locus_names, graph_nodes=graph_nodes)
+            else:
+                alignments = parse_gaf(f, locus_names=locus_names, graph_nodes=graph_nodes)
+    out = io.StringIO()
+    write_alignments(alignments, out)
+    return _digest(out.getvalue()), {"alignments": size}
+
+
+def _accuracy(paths, alignments):
+    import pysam
+    from genome_str_graph_generator import load_config
+    names = {locus[7]: locus[3] for locus in load_config(paths["config"])}
+    exact = within_one = n = 0
+    with pysam.FastxFile(paths["reads"]) as fastx:
+        for record in fastx:
+            truth = parse_truth(record.comment or "")
+            if truth is None:
+                continue
+            n += 1
+            ga = alignments.get((record.name, names[truth[0]]))
+            if ga is not None:
+                exact += ga.count == truth[1]
+                within_one += abs(ga.count - truth[1]) <= 1
+    return {"exact_fraction": exact / n if n else None, "within_one_fraction": within_one / n if n else None}
+
+
+def bench_end_to_end(paths, tmp_dir, count_engine):
+    from STRcount import run_pipeline
+    from parse_gaf import write_alignments
+    # a GraphAligner on the PATH that runs stub_graphaligner.py
+    stub = os.path.join(tmp_dir, "GraphAligner")
+    with open(stub, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath("stub_graphaligner.py")}" "$@"\n')
+    os.chmod(stub, 0o755)
+    with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"]}):
+        alignments = run_pipeline(paths["config"], paths["reference"], paths["reads"], os.path.join(tmp_dir, "out"),
+                                  count_engine=count_engine)
+    out = io.StringIO()
+    write_alignments(alignments, out)
+    return _digest(out.getvalue()), _accuracy(paths, alignments)
+
+
+def bench_startup(paths, tmp_dir, script):
+    """Time the start-up of the script with -h, the fastest of STARTUP_REPEATS runs counts."""
+    times = list()
+    for _ in range(STARTUP_REPEATS):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, os.path.join("..", script), "-h"], check=True, capture_output=True,
+                                text=True).stdout
+        times.append(time.perf_counter() - start)
+    return _digest(output), {"startup_time_s": min(times)}
+
+
+def _run_case(conn, bench, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        digest, extra = bench(*args[:1], tmp_dir, *args[1:])
+        elapsed = extra.pop("startup_time_s", time.perf_counter() - start)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    max_rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1 if sys.platform == "darwin" else 1024
+    conn.send({"wall_time_s": elapsed, "peak_rss_bytes": max(max_rss, max_rss_children) * scale,
+               "output_sha256": digest, **extra})
+    conn.close()
+
+
+def run_case(bench, *args):
+    """Run bench(paths, tmp_dir, *rest) in a new process and return its measurements."""
+    context = multiprocessing.get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case, args=(sender, bench, args))
+    process.start()
+    sender.close()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def compare(name, result, baseline, tolerance):
+    """The problems of result compared with the baseline, an empty list if there are none."""
+    if baseline is None:
+        return []
+    problems = list()
+    if result["output_sha256"] != baseline["output_sha256"]:
+        problems.append("the output differs from the baseline")
+    for key in ("wall_time_s", "peak_rss_bytes"):
+        if result[key] > baseline[key] * (1 + tolerance):
+            problems.append(f"{key} {result[key]:.3g} is more than {tolerance:.0%} above the baseline "
+                            f"{baseline[key]:.3g}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help=f'the numbers of alignments of the GAF files (default: {DEFAULT_SIZES})')
+    parser.add_argument('--loci', type=int, default=10, help='the number of loci (default: 10)')
+    parser.add_argument('--reads', type=int, default=1000, help='the number of reads of the end to end runs '
+                                                                '(default: 1000)')
+    parser.add_argument('--data-dir', help='keep the generated data in this directory and reuse it')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='how much slower or larger than the baseline a case may be (default: 0.5)')
+    parser.add_argument('--update-baselines', action='store_true', help='store the results as the new baselines')
+    parser.add_argument('--output', help='also write the results as JSON to this file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_dir = args.data_dir or tmp_dir
+        paths = generate(data_dir, args.loci, args.reads, args.sizes)
+        paths["graph"] = os.path.join(data_dir, "graph.gfa")
+        _write_graph(paths, paths["graph"])
+
+        cases = [(f"startup_{script[:-3]}", bench_startup, (script,)) for script in SCRIPTS]
+        cases.append(("graph", bench_graph, ()))
+        for size in args.sizes:
+            cases.append((f"parse_gaf_{size}", bench_parse, (size, False)))
+            cases.append((f"parse_gaf_columnar_{size}", bench_parse, (size, True)))
+            cases.append((f"parse_gaf_mmap_{size}", bench_parse, (size, False, True)))
+        cases.append(("end_to_end_graphaligner_stub", bench_end_to_end, ("graphaligner",)))
+        cases.append(("end_to_end_fast_count", bench_end_to_end, ("fast",)))
+
+        baselines = dict()
+        if os.path.exists(BASELINES):
+            with open(BASELINES) as f:
+                baselines = json.load(f)
+        # the data of other loci or read numbers gives other outputs
+        setup = f"loci={args.loci} reads={args.reads}"
+        results = dict()
+        failed = False
+        for name, bench, case_args in cases:
+            result = run_case(bench, paths, *case_args)
+            results[name] = result
+            problems = compare(name, result, baselines.get(setup, {}).get(name), args.tolerance)
+            failed |= bool(problems)
+            extra = "".join(f", {key} {value:.3f}" for key, value in result.items()
+                            if key.endswith("_fraction") and value is not None)
+            sys.stderr.write(f"{name}: {result['wall_time_s']:.2f}s, peak RSS "
+                             f"{result['peak_rss_bytes'] / 1024 ** 2:.0f} MB{extra}"
+                             f"{''.join('; ' + problem for problem in problems)}\n")
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=2)
+    if args.update_baselines:
+        baselines.setdefault(setup, {}).update(results)
+        with open(BASELINES, "w") as out:
+            json.dump(baselines, out, indent=2, sort_keys=True)
+            out.write("\n")
+    elif failed:
+        sys.exit(1)
@@ -0,0 +1,43 @@
+#! /usr/bin/env python
+"""A stand-in for GraphAligner for the benchmarks, it writes the alignment of every read generated by
+synthetic_data.py to its locus from the truth in the read comment instead of aligning it.
+
+It takes the GraphAligner options STRcount passes and ignores all but -f, -a and -g. The chromosome of a locus is
+looked up in the graph given with -g.
+"""
+
+import argparse
+import re
+
+import pysam
+
+from synthetic_data import gaf_record, parse_truth
+
+
+def read_locus_chromosomes(graph_file):
+    """{locus id: chromosome} from the prefix segment names <chromosome>_prefix_<locus id> of the graph."""
+    chromosomes = dict()
+    with open(graph_file) as f:
+        for line in f:
+            if line.startswith("S\t"):
+                match = re.fullmatch(r"(.+)_prefix_(\d+)", line.split("\t", 2)[1])
+                if match and not match.group(1).endswith("_before"):
+                    chromosomes[int(match.group(2))] = match.group(1)
+    return chromosomes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-g', required=True)
+    parser.add_argument('-f', required=True)
+    parser.add_argument('-a', required=True)
+    args, _ = parser.parse_known_args()
+
+    chromosomes = read_locus_chromosomes(args.g)
+    with pysam.FastxFile(args.f) as fastx, open(args.a, "w") as out:
+        for record in fastx:
+            truth = parse_truth(record.comment or "")
+            if truth is None:
+                continue
+            locus_id, count, strand = truth
+            out.write(gaf_record(record.name, len(record.sequence), chromosomes[locus_id], locus_id, count, strand))
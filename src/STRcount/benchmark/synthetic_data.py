@@ -0,0 +1,205 @@
+#! /usr/bin/env python
+"""Generate a synthetic reference, a config with several STR loci, long reads with known repeat counts and GAF files
+of alignments to the STR graph of the config, for the benchmarks.
+
+Every locus has a normal and an expanded allele. A read of a locus gets the repeat count of one of them, sequencing
+errors from an ErrorProfile, and is on either strand. The truth of a read is written to its comment as
+locus=<locus id> count=<repeat count> strand=<+ or ->, so stub_graphaligner.py can write the alignments GraphAligner
+would write for it without aligning anything. Reads without a comment do not come from a locus.
+Everything is generated from a seed, the same arguments always give the same files.
+
+Run from this directory: python synthetic_data.py --out-dir data --loci 10 --reads 10000 --alignments 1000000
+"""
+
+import argparse
+import os
+import random
+from collections import namedtuple
+
+BASES = "ACGT"
+MOTIFS = ["CAG", "GGCCCC", "AAG", "CGG", "ATTCT", "CCTG", "GAA", "AT"]
+
+ErrorProfile = namedtuple("ErrorProfile", ["substitution", "insertion", "deletion"])
+# roughly the error profile of nanopore reads
+DEFAULT_ERROR_PROFILE = ErrorProfile(0.03, 0.02, 0.03)
+NO_ERRORS = ErrorProfile(0, 0, 0)
+
+# the allele counts of a locus and the reference count
+Locus = namedtuple("Locus", ["chromosome", "begin", "end", "name", "repeat", "prefix", "suffix", "locus_id",
+                             "normal_count", "expanded_count"])
+
+
+def random_sequence(rng, length):
+    return "".join(rng.choices(BASES, k=length))
+
+
+def reverse_complement(sequence):
+    return sequence.translate(str.maketrans("ACGT", "TGCA"))[::-1]
+
+
+def add_errors(rng, sequence, profile=DEFAULT_ERROR_PROFILE):
+    """sequence with substitutions, insertions and deletions at the rates of profile."""
+    bases = list()
+    for base in sequence:
+        r = rng.random()
+        if r < profile.deletion:
+            continue
+        if r < profile.deletion + profile.substitution:
+            base = rng.choice(BASES.replace(base, ""))
+        bases.append(base)
+        if rng.random() < profile.insertion:
+            bases.append(rng.choice(BASES))
+    return "".join(bases)
+
+
+def make_reference(rng, n_loci, loci_per_contig=5, flank_len=150, spacing=20000, max_expansion=500):
+    """The contigs of a reference {name: sequence} with n_loci loci, loci_per_contig on each contig, and the loci.
+
+    The reference has the normal allele of every locus, the expanded allele has up to max_expansion repeats.
+    """
+    contigs = dict()
+    loci = list()
+    for contig_index in range((n_loci + loci_per_contig - 1) // loci_per_contig):
+        name = f"chr{contig_index + 1}"
+        parts = list()
+        length = 0
+        for _ in range(min(loci_per_contig, n_loci - len(loci))):
+            locus_id = len(loci) + 1
+            repeat = MOTIFS[(locus_id - 1) % len(MOTIFS)]
+            normal_count = rng.randrange(5, 30)
+            gap = random_sequence(rng, spacing)
+            prefix, suffix = random_sequence(rng, flank_len), random_sequence(rng, flank_len)
+            begin = length + spacing + flank_len
+            end = begin + normal_count * len(repeat)
+            parts += [gap, prefix, repeat * normal_count, suffix]
+            length = end + flank_len
+            loci.append(Locus(name, begin, end, f"locus_{locus_id}", repeat, prefix, suffix, locus_id, normal_count,
+                              rng.randrange(normal_count, max(normal_count, max_expansion) + 1)))
+        parts.append(random_sequence(rng, spacing))
+        contigs[name] = "".join(parts)
+    return contigs, loci
+
+
+def write_reference(out, contigs, line_length=60):
+    for name, sequence in contigs.items():
+        out.write(f">{name}\n")
+        for i in range(0, len(sequence), line_length):
+            out.write(sequence[i:i + line_length] + "\n")
+
+
+def write_config(out, loci):
+    """Write the loci as a config file, see genome_str_graph_generator.load_config()."""
+    out.write("chr\tbegin\tend\tname\trepeat\tprefix\tsuffix\n")
+    for locus in loci:
+        out.write("\t".join(str(value) for value in locus[:7]) + "\n")
+
+
+def simulate_reads(rng, contigs, loci, n_reads, read_length=10000, profile=DEFAULT_ERROR_PROFILE,
+                   off_target_fraction=0.1):
+    """Yield (name, comment, sequence) of n_reads reads, see the module documentation for the comment."""
+    for i in range(n_reads):
+        if rng.random() < off_target_fraction:
+            name = rng.choice(list(contigs))
+            start = rng.randrange(0, max(1, len(contigs[name]) - read_length))
+            yield f"read_{i}", "", add_errors(rng, contigs[name][start:start + read_length], profile)
+            continue
+        locus = rng.choice(loci)
+        count = rng.choice([locus.normal_count, locus.expanded_count])
+        contig = contigs[locus.chromosome]
+        # the read covers the locus with a random part of the reference on both sides
+        left = rng.randrange(len(locus.prefix), max(len(locus.prefix), read_length // 2) + 1)
+        right = rng.randrange(len(locus.suffix), max(len(locus.suffix), read_length // 2) + 1)
+        sequence = contig[max(0, locus.begin - left):locus.begin] + locus.repeat * count + \
+            contig[locus.end:locus.end + right]
+        strand = rng.choice("+-")
+        if strand == "-":
+            sequence = reverse_complement(sequence)
+        yield f"read_{i}", f"locus={locus.locus_id} count={count} strand={strand}", add_errors(rng, sequence, profile)
+
+
+def write_reads(out, reads, fastq=True):
+    for name, comment, sequence in reads:
+        header = f"{name} {comment}" if comment else name
+        if fastq:
+            out.write(f"@{header}\n{sequence}\n+\n{'5' * len(sequence)}\n")
+        else:
+            out.write(f">{header}\n{sequence}\n")
+
+
+def parse_truth(comment):
+    """The (locus id, count, strand) of a read comment written by simulate_reads(), None for off target reads."""
+    fields = dict(field.split("=", 1) for field in comment.split() if "=" in field)
+    if "locus" not in fields:
+        return None
+    return int(fields["locus"]), int(fields["count"]), fields["strand"]
+
+
+def gaf_record(read_name, read_length, chromosome, locus_id, count, strand, identity=0.95, flanks=True):
+    """The GAF line GraphAligner writes for a read that spans the locus with count repeats, see parse_gaf."""
+    nodes = [f"{chromosome}_prefix_{locus_id}"] + [f"repeat_{locus_id}"] * count + [f"{chromosome}_suffix_{locus_id}"]
+    if flanks:
+        nodes = [f"{chromosome}_before_prefix_{locus_id}"] + nodes + [f"{chromosome}_after_suffix_{locus_id}"]
+    path_dir = ">"
+    if strand == "-":
+        nodes.reverse()
+        path_dir = "<"
+    query_start = read_length // 100
+    query_end = read_length - read_length // 100
+    matches = int((query_end - query_start) * identity)
+    return (f"{read_name}\t{read_length}\t{query_start}\t{query_end}\t+\t{path_dir}{path_dir.join(nodes)}\t50000\t100"
+            f"\t40000\t{matches}\t{query_end - query_start}\t60\tNM:i:{query_end - query_start - matches}"
+            f"\tAS:f:{matches * 2 - (query_end - query_start)}\tdv:f:{1 - identity:.3f}\tid:f:{identity:.4f}\n")
+
+
+def write_gaf(out, rng, loci, n_records, max_alignments_per_read=3):
+    """Write n_records alignments of reads to the loci, reads can have several alignments to the same locus."""
+    i = 0
+    read = 0
+    while i < n_records:
+        locus = rng.choice(loci)
+        read_length = rng.randrange(1000, 20000)
+        for _ in range(min(rng.randrange(1, max_alignments_per_read + 1), n_records - i)):
+            count = rng.choice([locus.normal_count, locus.expanded_count]) + rng.randrange(-2, 3)
+            out.write(gaf_record(f"read_{read}", read_length, locus.chromosome, locus.locus_id, max(0, count),
+                                 rng.choice("+-"), rng.uniform(0.6, 1.0), rng.random() < 0.5))
+            i += 1
+        read += 1
+
+
+def generate(out_dir, n_loci=10, n_reads=1000, n_alignments=(), read_length=10000, profile=DEFAULT_ERROR_PROFILE,
+             seed=1):
+    """Write ref.fa, config.tsv, reads.fastq and alignments_<n>.gaf for every n in n_alignments to out_dir and return
+    the paths {name: path}."""
+    rng = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    contigs, loci = make_reference(rng, n_loci)
+    paths = {"reference": os.path.join(out_dir, "ref.fa"), "config": os.path.join(out_dir, "config.tsv"),
+             "reads": os.path.join(out_dir, "reads.fastq")}
+    with open(paths["reference"], "w") as out:
+        write_reference(out, contigs)
+    with open(paths["config"], "w") as out:
+        write_config(out, loci)
+    with open(paths["reads"], "w") as out:
+        write_reads(out, simulate_reads(rng, contigs, loci, n_reads, read_length, profile))
+    for n in n_alignments:
+        paths[f"alignments_{n}"] = os.path.join(out_dir, f"alignments_{n}.gaf")
+        with open(paths[f"alignments_{n}"], "w") as out:
+            write_gaf(out, random.Random(seed + n), loci, n)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out-dir', required=True, help='the directory the files are written to')
+    parser.add_argument('--loci', type=int, default=10, help='the number of loci')
+    parser.add_argument('--reads', type=int, default=1000, help='the number of reads')
+    parser.add_argument('--read-length', type=int, default=10000, help='the length of the reads')
+    parser.add_argument('--alignments', type=int, nargs='*', default=[],
+                        help='write GAF files with these numbers of alignments')
+    parser.add_argument('--error-rates', type=float, nargs=3, default=list(DEFAULT_ERROR_PROFILE),
+                        metavar=('SUBSTITUTION', 'INSERTION', 'DELETION'), help='the error rates of the reads')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    generate(args.out_dir, args.loci, args.reads, args.alignments, args.read_length, ErrorProfile(*args.error_rates),
+             args.seed)
@@ -0,0 +1,119 @@
+#! /usr/bin/env python
+"""Checkpoints of the stages of STRcount, so a run that was interrupted skips the stages that are already done.
+
+Every finished stage is recorded in checkpoints.json in the tmp folder with the hash of its inputs, its output files
+and the time it finished. A rerun with the same inputs skips a stage if its outputs still exist. Input files are
+identified by their absolute path, size and modification time like the reference in graph_cache.graph_cache_key().
+The alignment stage aligns the reads in chunks, every chunk that has a finished GAF file is skipped when it is resumed.
+"""
+
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import subprocess
+import time
+
+from defaults import DEFAULT_CHUNK_READS
+
+MANIFEST = "checkpoints.json"
+
+
+def file_signature(path):
+    """The absolute path, size and modification time of a file, None if it does not exist."""
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def inputs_key(inputs):
+    """The hash of inputs, anything that can be written as JSON."""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class Checkpoints:
+    """The stages recorded in directory/checkpoints.json."""
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST)
+        self.stages = dict()
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.stages = json.load(f)
+            except ValueError:
+                # a manifest that was not written completely, nothing is skipped
+                self.stages = dict()
+
+    def is_done(self, stage, key):
+        """True if stage was finished with the inputs of key and its outputs still exist."""
+        entry = self.stages.get(stage)
+        return entry is not None and entry["key"] == key and entry["finished"] is not None and \
+            all(os.path.exists(output) for output in entry["outputs"])
+
+    def key(self, stage):
+        """The key stage was last started or finished with, None if it is not recorded."""
+        entry = self.stages.get(stage)
+        return None if entry is None else entry["key"]
+
+    def start(self, stage, key):
+        """Record that stage was started with the inputs of key, it is not done until done() is called."""
+        self.stages[stage] = {"key": key, "outputs": [], "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                              "finished": None}
+        self._write()
+
+    def done(self, stage, key, outputs):
+        """Record that stage was finished with the inputs of key and wrote the files outputs."""
+        entry = self.stages.get(stage, {})
+        self.stages[stage] = {"key": key, "outputs": [os.path.abspath(output) for output in outputs],
+                              "started": entry.get("started"), "finished": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        self._write()
+
+    def _write(self):
+        tmp_path = self.path + ".part"
+        with open(tmp_path, "w") as out:
+            json.dump(self.stages, out, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def align_in_chunks(get_command, reads, chunk_dir, chunk_reads=DEFAULT_CHUNK_READS):
+    """Align the reads in chunks of chunk_reads reads and return the GAF files of the chunks in the order of reads.
+
+    get_command(reads, alignment_file) returns the GraphAligner command of a chunk. The reads of a chunk are written
+    to chunk_dir and removed when it is aligned, its alignments are written to a temporary file that is renamed to
+    chunk_<i>.gaf when GraphAligner succeeded. Chunks that already have their GAF file are not aligned again.
+    Raises subprocess.CalledProcessError if GraphAligner fails.
+    """
+    import pysam
+    os.makedirs(chunk_dir, exist_ok=True)
+    gaf_files = list()
+    with pysam.FastxFile(reads) as fastx:
+        for i, chunk in enumerate(iter(lambda: list(itertools.islice(fastx, chunk_reads)), [])):
+            gaf_file = os.path.join(chunk_dir, f"chunk_{i}.gaf")
+            gaf_files.append(gaf_file)
+            if os.path.exists(gaf_file):
+                continue
+            # GraphAligner tells FASTA and FASTQ apart by the file extension and GAF and GAM by the output extension
+            chunk_file = os.path.join(chunk_dir, f"chunk_{i}.fastq" if chunk[0].quality else f"chunk_{i}.fasta")
+            with open(chunk_file, "w") as out:
+                for record in chunk:
+                    out.write(str(record) + "\n")
+            part_file = os.path.join(chunk_dir, f"chunk_{i}.part.gaf")
+            subprocess.run(get_command(chunk_file, part_file), check=True)
+            os.replace(part_file, gaf_file)
+            os.remove(chunk_file)
+    return gaf_files
+
+
+def clear_chunks(chunk_dir):
+    """Remove the chunks of an alignment with other inputs."""
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+
+
+def iter_gaf_files(gaf_files):
+    """The records of the GAF files one after the other."""
+    for gaf_file in gaf_files:
+        with open(gaf_file) as f:
+            yield from f
@@ -0,0 +1,104 @@
+#! /usr/bin/env python
+"""Write the alignments as Parquet or Arrow IPC files instead of TSV.
+
+The columns are the ones of parse_gaf.write_alignments() with their types: spanned is a boolean, count an integer and
+the score, identity and aligned fraction are doubles that are not rounded like in the TSV. The alignments are
+converted and written in record batches of batch_size rows, so only one batch is held as columns at a time, also
+while SpilledAlignments.values() merges them from disk. Parquet files are dictionary encoded and compressed per
+column, Arrow IPC files can be memory mapped and read without copies.
+
+pyarrow is optional, it is only imported when one of these formats is written.
+"""
+
+import itertools
+
+from parse_gaf import write_alignments
+
+TSV_FORMAT = "tsv"
+PARQUET_FORMAT = "parquet"
+ARROW_FORMAT = "arrow"
+OUTPUT_FORMATS = [TSV_FORMAT, PARQUET_FORMAT, ARROW_FORMAT]
+FILE_EXTENSIONS = {TSV_FORMAT: ".tsv", PARQUET_FORMAT: ".parquet", ARROW_FORMAT: ".arrow"}
+
+# Arrow IPC files only support zstd and lz4
+COMPRESSIONS = ["zstd", "lz4", "snappy", "gzip", "none"]
+ARROW_COMPRESSIONS = ["zstd", "lz4", "none"]
+DEFAULT_COMPRESSION = "zstd"
+DEFAULT_BATCH_SIZE = 65536
+
+
+def check_output_format(output_format, compression=DEFAULT_COMPRESSION):
+    """Raises ValueError if the format or its compression is not supported and ImportError if the format needs
+    pyarrow and it is not installed."""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format {output_format}")
+    if output_format == TSV_FORMAT:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}")
+    if output_format == ARROW_FORMAT and compression not in ARROW_COMPRESSIONS:
+        raise ValueError(f"the arrow format only supports the compressions {', '.join(ARROW_COMPRESSIONS)}")
+    # fail before the alignments are counted, not when they are written
+    import pyarrow
+
+
+def alignment_schema():
+    import pyarrow as pa
+    return pa.schema([("read_name", pa.string()), ("strand", pa.string()), ("spanned", pa.bool_()),
+                      ("count", pa.int32()), ("align_score", pa.float64()), ("identity", pa.float64()),
+                      ("query_aligned_fraction", pa.float64()), ("locus", pa.string())])
+
+
+def iter_record_batches(alignments, batch_size=DEFAULT_BATCH_SIZE):
+    """Yield the alignments, a dict as returned by parse_gaf() or anything else with values(), as pyarrow record
+    batches of up to batch_size rows."""
+    import pyarrow as pa
+    schema = alignment_schema()
+    values = iter(alignments.values())
+    while True:
+        batch = list(itertools.islice(values, batch_size))
+        if not batch:
+            return
+        yield pa.record_batch([[ga.read_name for ga in batch], [ga.strand for ga in batch],
+                               [bool(ga.spanned) for ga in batch], [ga.count for ga in batch],
+                               [ga.alignment_score for ga in batch], [ga.identity for ga in batch],
+                               [ga.aligned_fraction for ga in batch], [ga.locus for ga in batch]], schema=schema)
+
+
+def write_alignments_columnar(alignments, out, output_format=PARQUET_FORMAT, compression=DEFAULT_COMPRESSION,
+                              batch_size=DEFAULT_BATCH_SIZE):
+    """Write the alignments to out, a path or a file opened in binary mode, as a Parquet or Arrow IPC file."""
+    import pyarrow as pa
+    codec = None if compression == "none" else compression
+    if output_format == PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+        with pq.ParquetWriter(out, alignment_schema(), compression=codec or "none") as writer:
+            for batch in iter_record_batches(alignments, batch_size):
+                writer.write_batch(batch)
+    elif output_format == ARROW_FORMAT:
+        options = pa.ipc.IpcWriteOptions(compression=codec)
+        with pa.ipc.new_file(out, alignment_schema(), options=options) as writer:
+            for batch in iter_record_batches(alignments, batch_size):
+                writer.write_batch(batch)
+    else:
+        raise ValueError(f"unknown columnar output format {output_format}")
+
+
+def write_output(alignments, output, output_format=TSV_FORMAT, compression=DEFAULT_COMPRESSION):
+    """Write the alignments to the file output in output_format, TSV with parse_gaf.write_alignments()."""
+    if output_format == TSV_FORMAT:
+        with open(output, "w") as out:
+            write_alignments(alignments, out)
+    else:
+        with open(output, "wb") as out:
+            write_alignments_columnar(alignments, out, output_format, compression)
+
+
+def read_output(output, output_format):
+    """Read a Parquet or Arrow IPC file written by write_output() into a pyarrow Table, the IPC file is memory
+    mapped."""
+    import pyarrow as pa
+    if output_format == PARQUET_FORMAT:
+        import pyarrow.parquet as pq
+        return pq.read_table(output)
+    return pa.ipc.open_file(pa.memory_map(output)).read_all()
@@ -0,0 +1,256 @@
+#! /usr/bin/env python
+"""Read and write compressed GAF files, and index them by read name.
+
+The compression of a file is recognized by its first bytes, not its name: gzip, which includes bgzip, and zstd. With
+more than one thread the file is decompressed by bgzip, pigz or zstd in a separate process when they are installed,
+so decompressing runs at the same time as parsing, otherwise it is decompressed in this process with a large buffer.
+
+GAF files are written bgzip compressed with pysam or zstd compressed with zstd. Plain and bgzip compressed files can
+be indexed by read name: the index <gaf>.rni has the offset, a virtual offset for bgzip, of the first alignment of
+every read, and the alignments of a read are fetched without reading the rest of the file. GraphAligner writes the
+alignments of a read one after the other. zstd files can not be indexed because they can not be read from an offset.
+"""
+
+import argparse
+import gzip
+import io
+import shutil
+import subprocess
+import sys
+
+GZIP = "gzip"
+ZSTD = "zstd"
+NO_COMPRESSION = "none"
+GAF_COMPRESSIONS = [NO_COMPRESSION, GZIP, ZSTD]
+EXTENSIONS = {NO_COMPRESSION: "", GZIP: ".gz", ZSTD: ".zst"}
+READ_INDEX_EXTENSION = ".rni"
+
+_MAGIC = {b"\x1f\x8b": GZIP, b"\x28\xb5\x2f\xfd": ZSTD}
+READ_BUFFER_SIZE = 4 * 1024 ** 2
+
+
+def detect_compression(path):
+    """GZIP, ZSTD or NO_COMPRESSION by the first bytes of the file."""
+    with open(path, "rb") as f:
+        start = f.read(4)
+    for magic, compression in _MAGIC.items():
+        if start.startswith(magic):
+            return compression
+    return NO_COMPRESSION
+
+
+class _ProcessReader:
+    """The lines of the output of a decompressing process. Raises subprocess.CalledProcessError on close if it
+    failed."""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=READ_BUFFER_SIZE)
+        self.lines = io.TextIOWrapper(self.process.stdout)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def close(self):
+        finished = self.lines.read(1) == ""
+        if not finished:
+            # the consumer stopped early
+            self.process.kill()
+        self.lines.close()
+        self.process.wait()
+        if finished and self.process.returncode != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _decompress_command(path, compression, threads):
+    if compression == ZSTD and shutil.which("zstd"):
+        return ["zstd", "-q", "-d", "-c", f"-T{threads}", path]
+    if compression == GZIP and threads > 1:
+        if shutil.which("bgzip"):
+            # bgzip decompresses plain gzip too, but only bgzip files in parallel
+            return ["bgzip", "-d", "-c", "-@", str(threads), path]
+        if shutil.which("pigz"):
+            return ["pigz", "-d", "-c", "-p", str(threads), path]
+    return None
+
+
+def open_text(path, threads=1):
+    """Open the plain or compressed text file path for reading its lines, see the module documentation.
+    Raises ValueError for zstd files if neither zstd nor the zstandard module are installed."""
+    compression = detect_compression(path)
+    if compression == NO_COMPRESSION:
+        return open(path, buffering=READ_BUFFER_SIZE)
+    command = _decompress_command(path, compression, threads)
+    if command is not None:
+        return _ProcessReader(command)
+    if compression == GZIP:
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(path), READ_BUFFER_SIZE))
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError(f"{path} is zstd compressed, install zstd or the zstandard module to read it")
+    return io.TextIOWrapper(io.BufferedReader(zstandard.open(path, "rb"), READ_BUFFER_SIZE))
+
+
+class _BinaryWriter:
+    # tell() of a binary file is its offset, a virtual offset for a BGZFile
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, text):
+        self.file.write(text.encode())
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class _ProcessWriter:
+    def __init__(self, command):
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.file = io.TextIOWrapper(self.process.stdin)
+
+    def write(self, text):
+        self.file.write(text)
+
+    def close(self):
+        self.file.close()
+        if self.process.wait() != 0:
+            raise subprocess.CalledProcessError(self.process.returncode, self.command)
+
+
+def write_gaf(records, path, compression=NO_COMPRESSION, index=False, threads=1):
+    """Write the GAF records to path with compression, one of GAF_COMPRESSIONS, and return the number of records.
+    With index the read name index path + READ_INDEX_EXTENSION is written too, see fetch_read(). Raises ValueError
+    for an index of a zstd file, or if neither zstd nor the zstandard module are installed for zstd."""
+    if compression not in GAF_COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}")
+    if compression == ZSTD:
+        if index:
+            raise ValueError("zstd compressed GAF files can not be indexed")
+        if shutil.which("zstd"):
+            out = _ProcessWriter(["zstd", "-q", "-f", f"-T{threads}", "-o", path])
+        else:
+            try:
+                import zstandard
+            except ImportError:
+                raise ValueError("install zstd or the zstandard module to write zstd compressed files")
+            out = io.TextIOWrapper(zstandard.open(path, "wb"))
+    elif compression == GZIP:
+        from pysam.libcbgzf import BGZFile
+        out = _BinaryWriter(BGZFile(path, "wb"))
+    else:
+        out = _BinaryWriter(open(path, "wb"))
+
+    index_out = open(path + READ_INDEX_EXTENSION, "w") if index else None
+    n = 0
+    previous = None
+    try:
+        for record in records:
+            if index_out is not None:
+                # the name without the FASTQ comment that GraphAligner keeps, like parse_gaf.parse_gaf_record()
+                read_name = record.split("\t", 1)[0].split(" ")[0]
+                if read_name != previous:
+                    index_out.write(f"{read_name}\t{out.tell()}\n")
+                    previous = read_name
+            out.write(record)
+            n += 1
+    finally:
+        out.close()
+        if index_out is not None:
+            index_out.close()
+    return n
+
+
+def _open_binary(path, compression):
+    if compression == GZIP:
+        from pysam.libcbgzf import BGZFile
+        return BGZFile(path, "rb")
+    return open(path, "rb")
+
+
+def index_gaf(path):
+    """Write the read name index of the plain or bgzip compressed GAF file path, see write_gaf()."""
+    compression = detect_compression(path)
+    if compression == ZSTD:
+        raise ValueError("zstd compressed GAF files can not be indexed")
+    f = _open_binary(path, compression)
+    previous = None
+    with open(path + READ_INDEX_EXTENSION, "w") as out:
+        try:
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                # BGZFile.readline() strips the newline, the end of the file is where the offset does not move
+                if f.tell() == offset:
+                    break
+                if not line.strip():
+                    continue
+                read_name = line.split(b"\t", 1)[0].split(b" ")[0].decode()
+                if read_name != previous:
+                    out.write(f"{read_name}\t{offset}\n")
+                    previous = read_name
+        finally:
+            f.close()
+
+
+def load_read_index(path):
+    """{read name: offset} of the read name index of the GAF file path."""
+    with open(path + READ_INDEX_EXTENSION) as f:
+        return {read_name: int(offset) for read_name, offset in (line.rstrip("\n").split("\t") for line in f)}
+
+
+def fetch_read(path, read_name, read_index=None):
+    """The GAF records of read_name in the indexed GAF file path, read_index is the one of load_read_index(). Like in
+    parse_gaf.parse_gaf_record(), the read name is the one without the FASTQ comment."""
+    if read_index is None:
+        read_index = load_read_index(path)
+    if read_name not in read_index:
+        return []
+    f = _open_binary(path, detect_compression(path))
+    records = list()
+    try:
+        f.seek(read_index[read_name])
+        read_name = read_name.encode()
+        while True:
+            line = f.readline()
+            if line.split(b"\t", 1)[0].split(b" ")[0] != read_name:
+                break
+            records.append(line.rstrip(b"\n").decode() + "\n")
+    finally:
+        f.close()
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Index a plain or bgzip compressed GAF file by read name and fetch '
+                                                 'the alignments of reads from it')
+    parser.add_argument('--gaf', required=True, help='the GAF file')
+    parser.add_argument('--index', action='store_true',
+                        help=f'write the read name index <gaf>{READ_INDEX_EXTENSION}')
+    parser.add_argument('--read', nargs='*', default=[], help='write the alignments of these reads to stdout')
+    args = parser.parse_args()
+
+    try:
+        if args.index:
+            index_gaf(args.gaf)
+        if args.read:
+            read_index = load_read_index(args.gaf)
+            for read_name in args.read:
+                sys.stdout.writelines(fetch_read(args.gaf, read_name, read_index))
+    except (OSError, ValueError) as e:
+        sys.stderr.write(f"Error: {e}\n")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,11 @@
+#! /usr/bin/env python
+"""The defaults of the options of the modules that import numpy or pysam, so STRcount.py can show them in its help and
+check its arguments without importing these."""
+
+# the k-mer length of read_prefilter.py, k-mers are packed into 64 bit integers
+DEFAULT_K = 15
+MAX_K = 32
+# the k-mer length of the flank anchors of fast_count.py
+DEFAULT_ANCHOR_K = 11
+# the number of reads per chunk of checkpoint.align_in_chunks()
+DEFAULT_CHUNK_READS = 100000
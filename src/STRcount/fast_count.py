@@ -0,0 +1,221 @@
+#! /usr/bin/env python
+"""Count the repeats of the loci in the reads without aligning them to the STR graph.
+
+The prefix and suffix of every locus are anchored in a read by their k-mers: the k-mers of a flank that are found in
+the read vote for the diagonal, the offset between read and flank, and the densest band of diagonals gives the
+position of the flank. Reads are searched on both strands. The bases between the anchored prefix and suffix are
+aligned to tandem copies of the repeat motif, an edit distance alignment that can go around the motif any number of
+times, and the number of complete copies is the count.
+
+The alignments have the columns of parse_gaf.parse_gaf(), but the alignment score is the length of the repeat region
+minus the edit distance, the identity is the identity of the repeat region to the copies of the motif and the aligned
+fraction is the fraction of the read between the start of the prefix and the end of the suffix. Only reads that span
+the prefix and suffix of a locus are counted.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+import pysam
+
+from defaults import DEFAULT_ANCHOR_K
+from genome_str_graph_generator import load_config
+from parse_gaf import GraphAlignment, add_alignment, write_alignments
+from read_prefilter import encode_kmers, iter_read_batches, map_batches, reverse_complement, MAX_K
+
+DEFAULT_MIN_ANCHOR_HITS = 2
+# the counts of the repeat alignment are packed into one integer, the edit distance above the number of copies
+_COST = 1 << 32
+
+
+class FlankAnchors:
+    """The k-mers of the prefixes and suffixes of the loci, see load_config(). The flanks of locus i are anchor 2 * i
+    and 2 * i + 1."""
+
+    def __init__(self, loci, k=DEFAULT_ANCHOR_K):
+        if not 0 < k <= MAX_K:
+            raise ValueError(f"k has to be between 1 and {MAX_K}")
+        self.k = k
+        self.lengths = list()
+        kmers, anchors, positions = list(), list(), list()
+        for locus in loci:
+            for flank in (locus[5], locus[6]):
+                flank_kmers, flank_positions = encode_kmers(flank, k, positions=True)
+                kmers.append(flank_kmers)
+                positions.append(flank_positions)
+                anchors.append(np.full(len(flank_kmers), len(self.lengths), dtype=np.intp))
+                self.lengths.append(len(flank))
+        kmers = np.concatenate(kmers)
+        order = np.argsort(kmers, kind="stable")
+        self.kmers = kmers[order]
+        self.anchors = np.concatenate(anchors)[order]
+        self.positions = np.concatenate(positions)[order]
+
+    def hits(self, sequence):
+        """The k-mers of sequence that are in a flank as arrays of anchors, flank positions and read positions."""
+        kmers, read_positions = encode_kmers(sequence, self.k, positions=True)
+        begins = np.searchsorted(self.kmers, kmers, "left")
+        n = np.searchsorted(self.kmers, kmers, "right") - begins
+        # a k-mer can be in several flanks or several times in one, one hit for each
+        offsets = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        entries = np.repeat(begins, n) + offsets
+        return self.anchors[entries], self.positions[entries], np.repeat(read_positions, n)
+
+    def locate(self, anchor, flank_positions, read_positions, min_hits=DEFAULT_MIN_ANCHOR_HITS):
+        """The start and end of the flank in the read from the hits of one anchor, None if it has less than min_hits
+        hits in one band of diagonals."""
+        if len(flank_positions) < min_hits:
+            return None
+        length = self.lengths[anchor]
+        diagonals = read_positions - flank_positions
+        order = np.argsort(diagonals, kind="stable")
+        diagonals = diagonals[order]
+        # the diagonal drifts by the insertions and deletions in the flank
+        ends = np.searchsorted(diagonals, diagonals + length // 10 + 1, "right")
+        best = int(np.argmax(ends - np.arange(len(diagonals))))
+        if ends[best] - best < min_hits:
+            return None
+        band = order[best:ends[best]]
+        first = band[np.argmin(flank_positions[band])]
+        last = band[np.argmax(flank_positions[band])]
+        return (int(read_positions[first] - flank_positions[first]),
+                int(read_positions[last] + length - flank_positions[last]))
+
+
+def count_units(region, motif):
+    """Align region to any number of tandem copies of motif and return the number of copies and the edit distance.
+
+    The alignment starts and ends at the start of the motif, the states are the position in the motif and the
+    copies are counted when the alignment goes around it. Of the alignments with the lowest edit distance the one with
+    the most copies is used, deletions are the most common errors of long reads and alignments with fewer copies
+    explain them as missing copies.
+    """
+    m = len(motif)
+    if not m:
+        return 0, len(region)
+    # edit distance * _COST - copies, so min() prefers the lower edit distance and then more copies
+    row = [0] + [None] * (m - 1)
+    row = _delete(row, m)
+    for base in region:
+        new_row = [value + _COST if value is not None else None for value in row]
+        for j in range(m):
+            if row[j] is None:
+                continue
+            value = row[j] + (_COST if base != motif[j] else 0)
+            if j + 1 == m:
+                value -= 1
+            j_next = (j + 1) % m
+            if new_row[j_next] is None or value < new_row[j_next]:
+                new_row[j_next] = value
+        row = _delete(new_row, m)
+    copies = -row[0] % _COST
+    return copies, (row[0] + copies) // _COST
+
+
+def _delete(row, m):
+    # skip bases of the motif, twice around it so every state is reached from every other one
+    for i in range(2 * m):
+        j = i % m
+        if row[j] is None:
+            continue
+        value = row[j] + _COST - (1 if j + 1 == m else 0)
+        j_next = (j + 1) % m
+        if row[j_next] is None or value < row[j_next]:
+            row[j_next] = value
+    return row
+
+
+def count_read(read_name, sequence, anchors, loci, min_hits=DEFAULT_MIN_ANCHOR_HITS):
+    """The alignments of the read to the loci it spans, at most one per locus."""
+    alignments = dict()
+    for strand, strand_sequence in (("+", sequence), ("-", reverse_complement(sequence))):
+        anchor_ids, flank_positions, read_positions = anchors.hits(strand_sequence)
+        if not len(anchor_ids):
+            continue
+        for i in np.unique(anchor_ids // 2).tolist():
+            flanks = list()
+            for anchor in (2 * i, 2 * i + 1):
+                selected = anchor_ids == anchor
+                flanks.append(anchors.locate(anchor, flank_positions[selected], read_positions[selected], min_hits))
+            prefix, suffix = flanks
+            if prefix is None or suffix is None or suffix[0] <= prefix[0]:
+                continue
+            region = strand_sequence[max(prefix[1], 0):max(suffix[0], 0)].upper()
+            motif = loci[i][4].upper()
+            count, cost = count_units(region, motif)
+            span = min(suffix[1], len(sequence)) - max(prefix[0], 0)
+            add_alignment(alignments, GraphAlignment(read_name, strand, True, count, len(region) - cost,
+                                                     1 - cost / max(len(region), count * len(motif), 1),
+                                                     span / len(sequence), loci[i][3]))
+    return list(alignments.values())
+
+
+_worker_args = None
+
+
+def _init_worker(anchors, loci, min_hits):
+    global _worker_args
+    _worker_args = (anchors, loci, min_hits)
+
+
+def _count_batch(reads):
+    anchors, loci, min_hits = _worker_args
+    return [ga for read_name, sequence in reads for ga in count_read(read_name, sequence, anchors, loci, min_hits)]
+
+
+def fast_count(reads, loci, min_identity=0.50, k=DEFAULT_ANCHOR_K, min_hits=DEFAULT_MIN_ANCHOR_HITS, processes=1):
+    """Count the repeats of the loci, see load_config(), in the FASTQ/FASTA file reads with processes processes.
+    Returns the best alignment per (read name, locus) like parse_gaf.parse_gaf(), there is no aligned fraction
+    filter because the flanks of the loci are usually much shorter than the reads."""
+    anchors = FlankAnchors(loci, k)
+    alignments = dict()
+    with pysam.FastxFile(reads) as fastx:
+        for _, batch_alignments in map_batches(_count_batch, iter_read_batches(fastx),
+                                               lambda batch: [(record.name, record.sequence) for record in batch],
+                                               processes, _init_worker, (anchors, loci, min_hits)):
+            for ga in batch_alignments:
+                if ga.identity >= min_identity:
+                    add_alignment(alignments, ga)
+    return alignments
+
+
+def compare_counts(alignments, fast_alignments, out):
+    """Write the counts of alignments and fast_alignments per read and locus as TSV to out, NA if a read was only
+    counted by one of them. Returns the number of reads counted by both, of these the number with the same count,
+    and the numbers of reads only in alignments and only in fast_alignments."""
+    counts = {(ga.read_name, ga.locus): ga.count for ga in alignments.values()}
+    fast_counts = {(ga.read_name, ga.locus): ga.count for ga in fast_alignments.values()}
+    out.write("read_name\tlocus\tcount\tfast_count\n")
+    for key in list(counts) + [key for key in fast_counts if key not in counts]:
+        out.write("%s\t%s\t%s\t%s\n" % (key + (counts.get(key, "NA"), fast_counts.get(key, "NA"))))
+    both = counts.keys() & fast_counts.keys()
+    return (len(both), sum(counts[key] == fast_counts[key] for key in both), len(counts) - len(both),
+            len(fast_counts) - len(both))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fastq', help='the reads in FASTQ or FASTA format, can be gzip compressed', required=True)
+    parser.add_argument('--config', help='the config file', required=True)
+    parser.add_argument('--output', help='the output file', required=True)
+    parser.add_argument('--min-identity', type=float, default=0.50,
+                        help='only use reads whose repeat region has an identity greater than this')
+    parser.add_argument('-k', type=int, default=DEFAULT_ANCHOR_K,
+                        help=f'the k-mer length of the flank anchors (default: {DEFAULT_ANCHOR_K})')
+    parser.add_argument('--min-hits', type=int, default=DEFAULT_MIN_ANCHOR_HITS,
+                        help=f'the number of k-mers that anchor a flank (default: {DEFAULT_MIN_ANCHOR_HITS})')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='the number of processes (default: 1)')
+    args = parser.parse_args()
+
+    if not 0 < args.k <= MAX_K:
+        sys.stderr.write(f"Error: -k has to be between 1 and {MAX_K}.\n")
+        sys.exit(1)
+    try:
+        loci = load_config(args.config)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}.\n")
+        sys.exit(1)
+    with open(args.output, "w") as out:
+        write_alignments(fast_count(args.fastq, loci, args.min_identity, args.k, args.min_hits, args.threads),
+                         out)
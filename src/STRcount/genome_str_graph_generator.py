@@ -1,21 +1,62 @@
 #! /usr/bin/env python3
 import sys
-import pysam
 import argparse
-import pandas as pd
 
+# number of reference bases kept before the prefix and after the suffix when
+# --use_fixed_len_before_and_after_fixes is set
+DEFAULT_BEFORE_AND_AFTER_FIXES_LEN = 50000
 
-# TODO shouldn't the orientations be per line in config file?
-def get_genome_str_graph(config=None,
-                         reference_file=None,
-                         repeat_orientation=None,
-                         prefix_orientation=None,
-                         suffix_orientation=None,
-                         only_use_provided_fixes=False,
-                         ucsc_browser_coords=False,
-                         verbose=False):
-
-    # read in the configs and store them in the respective variables
+
+class ReferenceContig:
+    """A reference chromosome whose sequence is only read when a region of it is fetched."""
+
+    def __init__(self, name, length, fetch):
+        self.name = name
+        self.length = length
+        self._fetch = fetch
+
+    def fetch(self, begin, end):
+        return self._fetch(begin, end)
+
+
+def open_indexed_reference(reference_file, verbose=False):
+    """Open the reference with its .fai index, which htslib builds next to the file when it is missing.
+    bgzip compressed references are supported, plain gzip ones can not be indexed and None is returned."""
+    import pysam
+    try:
+        return pysam.FastaFile(reference_file)
+    except (OSError, ValueError) as e:
+        if verbose:
+            sys.stderr.write(f"Could not open indexed reference ({e}), reading it sequentially instead\n")
+        return None
+
+
+def iter_reference_contigs(reference_file, verbose=False):
+    """Yield a ReferenceContig per chromosome in reference order.
+
+    With an index only the requested regions are read from disk, otherwise every chromosome is streamed
+    and held in memory while it is processed."""
+    fasta = open_indexed_reference(reference_file, verbose)
+    if fasta is not None:
+        with fasta:
+            for chr_name, chr_len in zip(fasta.references, fasta.lengths):
+                yield ReferenceContig(chr_name, chr_len,
+                                      lambda begin, end, chr_name=chr_name: fasta.fetch(chr_name, begin, end))
+        return
+
+    import pysam
+    for chr in pysam.FastxFile(reference_file):
+        yield ReferenceContig(chr.name, len(chr.sequence),
+                              lambda begin, end, sequence=chr.sequence: sequence[begin:end])
+
+
+def load_config(config, ucsc_browser_coords=False, verbose=False):
+    """Read the config file into a list of loci [chromosome, begin, end, name, repeat, prefix, suffix, locus_id].
+
+    begin and end are converted to 0-based, end exclusive coordinates. The locus_id is the 1-based position of the
+    locus in the config file and is used to name its segments in the graph, e.g. repeat_<locus_id>. A malformed
+    config file raises a ValueError.
+    """
     configs = list()
     config_fh = open(config)
     header = config_fh.readline()
@@ -31,90 +72,143 @@ def get_genome_str_graph(config=None,
 
     config_fh.close()
 
-    configs_dict = dict()
-
-    # In this case I am extracting only 1 config but in case we have more than 1,
-    # we can have a loop here to extract the other configs
+    loci = list()
+    names = set()
     try:
         for chromosome, begin, end, name, repeat, prefix, suffix in configs:
-            configs_dict[name] = [chromosome, int(begin), int(end), name, repeat, prefix, suffix]
-    except Exception as e:
-        sys.stderr.write("Error in config file: " + str(e) + "\n")
-        sys.exit(1)
+            if name in names:
+                raise ValueError(f"locus name {name} is used more than once")
+            names.add(name)
+            begin = int(begin)
+            end = int(end)
+            if ucsc_browser_coords:
+                begin = begin - 1
+            loci.append([chromosome, begin, end, name, repeat, prefix, suffix, len(loci) + 1])
+    except ValueError as e:
+        raise ValueError(f"error in config file {config}: {e}") from e
+    return loci
 
-    # approach it chromosome wise and then have a variable for segments and one for
-    # links for the chromosome and then in the end iterate over all and print.
 
-    segments = dict()
-    links = dict()
+def build_locus_index(loci):
+    """Index the loci by chromosome, each list sorted by begin. Overlapping loci are reported."""
+    locus_index = dict()
+    for locus in loci:
+        locus_index.setdefault(locus[0], []).append(locus)
+    for chromosome, chr_loci in locus_index.items():
+        chr_loci.sort()
+        for previous, locus in zip(chr_loci, chr_loci[1:]):
+            if locus[1] - len(locus[5]) < previous[2] + len(previous[6]):
+                sys.stderr.write(f"Warning: loci {previous[3]} and {locus[3]} overlap, reads spanning both "
+                                 "may not be counted for either\n")
+    return locus_index
+
+
+def write_table(rows, columns, out):
+    """Write the rows as a table with the column names to out, for verbose output. pandas is only imported here,
+    it takes longer to import than the rest of STRcount."""
+    import pandas as pd
+    out.write(pd.DataFrame(rows, columns=columns).to_string() + "\n")
+
+
+# TODO shouldn't the orientations be per line in config file?
+def iter_genome_str_graph(config=None,
+                          reference_file=None,
+                          repeat_orientation=None,
+                          prefix_orientation=None,
+                          suffix_orientation=None,
+                          only_use_provided_fixes=False,
+                          ucsc_browser_coords=False,
+                          verbose=False,
+                          use_fixed_len_before_and_after_fixes=False,
+                          before_and_after_fixes_len=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN):
+    """Yield the sub-graph of every locus as (key, segments, links) as soon as it is built.
 
-    c = 0
+    Only one locus (and, without a reference index, one chromosome) is held in memory at a time.
+    """
 
+    loci = load_config(config, ucsc_browser_coords, verbose)
+    locus_index = build_locus_index(loci)
+
+    # approach it chromosome wise and yield the segments and links of each locus on the chromosome
     # for column names see http://gfa-spec.github.io/GFA-spec/GFA1.html
     segments_cols = ["RecordType", "Name", "Sequence"]
     links_cols = ["RecordType", "From", "FromOrient", "To", "ToOrient", "Overlap"]
-    for chr in pysam.FastxFile(reference_file):
-        for key in configs_dict:
-            config_chr, begin, end, name, repeat, prefix, suffix = configs_dict[key]
-            if (chr.name == config_chr):
-                # TODO what if the config file contains multiple entries for the same chromosome?
-                if verbose:
-                    sys.stderr.write("Processing: " + key + "\n")
-                c = c + 1
-
-                before_prefix_id = f"{chr.name}_before_prefix_{c}"
-                prefix_id = f"{chr.name}_prefix_{c}"
-                repeat_id = f"repeat_{c}"
-                suffix_id = f"{chr.name}_suffix_{c}"
-                after_suffix_id = f"{chr.name}_after_suffix_{c}"
-
-                if not only_use_provided_fixes:
-
-                    if ucsc_browser_coords:
-                        begin = begin - 1
-                        end = end
-                    before_prefix_line = ["S", before_prefix_id, chr.sequence[: begin - len(prefix)]]
-                    after_suffix_line = ["S", after_suffix_id, chr.sequence[end + len(suffix):]]
-                prefix_line = ["S", prefix_id, prefix]
-                repeat_line = ["S", repeat_id, repeat]
-                suffix_line = ["S", suffix_id, suffix]
-
-                dict_key = chr.name + "_" + str(c)
-
-                if not only_use_provided_fixes:
-                    segments[dict_key] = [before_prefix_line, prefix_line, repeat_line, suffix_line, after_suffix_line]
+    found_chromosomes = set()
+    for chr in iter_reference_contigs(reference_file, verbose):
+        found_chromosomes.add(chr.name)
+        # every locus gets its own sub-graph, so loci on the same chromosome do not share segments
+        for locus in locus_index.get(chr.name, []):
+            config_chr, begin, end, name, repeat, prefix, suffix, c = locus
+            if verbose:
+                sys.stderr.write("Processing: " + name + "\n")
+
+            before_prefix_id = f"{chr.name}_before_prefix_{c}"
+            prefix_id = f"{chr.name}_prefix_{c}"
+            repeat_id = f"repeat_{c}"
+            suffix_id = f"{chr.name}_suffix_{c}"
+            after_suffix_id = f"{chr.name}_after_suffix_{c}"
+
+            if not only_use_provided_fixes:
+                before_prefix_end = begin - len(prefix)
+                after_suffix_begin = end + len(suffix)
+                if use_fixed_len_before_and_after_fixes:
+                    # only keep a window around the locus so the graph does not grow with the chromosome
+                    before_prefix_begin = max(0, before_prefix_end - before_and_after_fixes_len)
+                    after_suffix_end = after_suffix_begin + before_and_after_fixes_len
                 else:
-                    segments[dict_key] = [prefix_line, repeat_line, suffix_line]
+                    before_prefix_begin = 0
+                    after_suffix_end = chr.length
+                before_prefix_line = ["S", before_prefix_id, chr.fetch(before_prefix_begin, before_prefix_end)]
+                after_suffix_line = ["S", after_suffix_id, chr.fetch(after_suffix_begin, after_suffix_end)]
+            prefix_line = ["S", prefix_id, prefix]
+            repeat_line = ["S", repeat_id, repeat]
+            suffix_line = ["S", suffix_id, suffix]
 
-                if verbose:
-                    sys.stderr.write(f"Segments for chromosome {chr.name}\n")
-                    segments_df = pd.DataFrame(segments[dict_key], columns=segments_cols)
-                    sys.stderr.write(segments_df.to_string() + "\n")
+            dict_key = chr.name + "_" + str(c)
 
-                cigar = "0M"  # the "to" segment follows directly after the "from segment"
+            if not only_use_provided_fixes:
+                locus_segments = [before_prefix_line, prefix_line, repeat_line, suffix_line, after_suffix_line]
+            else:
+                locus_segments = [prefix_line, repeat_line, suffix_line]
 
-                if not only_use_provided_fixes:
-                    before_prefix_line = ["L", before_prefix_id, "+", prefix_id, prefix_orientation, cigar]
-                    after_suffix_line = ["L", suffix_id, suffix_orientation, after_suffix_id, "+", cigar]
+            if verbose:
+                sys.stderr.write(f"Segments for chromosome {chr.name}\n")
+                write_table(locus_segments, segments_cols, sys.stderr)
 
-                prefix_line = ["L", prefix_id, prefix_orientation, repeat_id, repeat_orientation, cigar]
-                repeat_line = ["L", repeat_id, repeat_orientation, repeat_id, repeat_orientation, cigar]
-                suffix_line = ["L", repeat_id, repeat_orientation, suffix_id, suffix_orientation, cigar]
+            cigar = "0M"  # the "to" segment follows directly after the "from segment"
 
-                if not only_use_provided_fixes:
-                    links[dict_key] = [before_prefix_line, prefix_line, repeat_line, suffix_line, after_suffix_line]
-                else:
-                    links[dict_key] = [prefix_line, repeat_line, suffix_line]
+            if not only_use_provided_fixes:
+                before_prefix_line = ["L", before_prefix_id, "+", prefix_id, prefix_orientation, cigar]
+                after_suffix_line = ["L", suffix_id, suffix_orientation, after_suffix_id, "+", cigar]
 
-                if verbose:
-                    sys.stderr.write(f"Links for chromosome {chr.name}\n")
-                    segments_df = pd.DataFrame(links[dict_key], columns=links_cols)
-                    sys.stderr.write(segments_df.to_string() + "\n")
+            prefix_line = ["L", prefix_id, prefix_orientation, repeat_id, repeat_orientation, cigar]
+            repeat_line = ["L", repeat_id, repeat_orientation, repeat_id, repeat_orientation, cigar]
+            suffix_line = ["L", repeat_id, repeat_orientation, suffix_id, suffix_orientation, cigar]
 
+            if not only_use_provided_fixes:
+                locus_links = [before_prefix_line, prefix_line, repeat_line, suffix_line, after_suffix_line]
             else:
-                sys.stderr.write("Not processing: " + key + "\n")
-                # TODO This should no tbe needed
-                # segments[chr.name] = sep.join(["S", chr.name, chr.sequence])
+                locus_links = [prefix_line, repeat_line, suffix_line]
+
+            if verbose:
+                sys.stderr.write(f"Links for chromosome {chr.name}\n")
+                write_table(locus_links, links_cols, sys.stderr)
+
+            yield dict_key, locus_segments, locus_links
+
+    for locus in loci:
+        if locus[0] not in found_chromosomes:
+            sys.stderr.write(f"Not processing: {locus[3]}, chromosome {locus[0]} is not in the reference\n")
+
+
+def get_genome_str_graph(*args, **kwargs):
+    """Build the whole graph in memory, returns the segments and links of each locus in two dicts.
+    Takes the same arguments as iter_genome_str_graph()."""
+    segments = dict()
+    links = dict()
+    for dict_key, locus_segments, locus_links in iter_genome_str_graph(*args, **kwargs):
+        segments[dict_key] = locus_segments
+        links[dict_key] = locus_links
     return segments, links
 
 
@@ -130,9 +224,24 @@ def print_genome_str_graph(segments: dict, links: dict):
             print("\t".join(entry))
 
 
-if __name__ == "__main__":
+def write_genome_str_graph(graph, out):
+    """Write the sub-graphs yielded by iter_genome_str_graph() to the file handle out as they are built.
+
+    The fields are written one by one so sequences are not copied into a joined line.
+    """
+    out.write("H\tVN:Z:a.0\n")
+    for dict_key, locus_segments, locus_links in graph:
+        for entry in locus_segments + locus_links:
+            for i, field in enumerate(entry):
+                if i:
+                    out.write("\t")
+                out.write(field)
+            out.write("\n")
+
+
+def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--ref', help='the ref file', required=True)
+    parser.add_argument('--ref', help='the ref file, plain or bgzip compressed fasta', required=True)
     parser.add_argument('--config', help='the config file', required=True)
     parser.add_argument('--repeat_orientation', help='the orientation of the repeat string. + or -',
                         required=False, default="+")
@@ -145,6 +254,11 @@ if __name__ == "__main__":
                         help='only use the provided suffixes and prefixes, not the whole reference sequence.')
     parser.add_argument('--ucsc_browser_coords', action='store_true',
                         help='use UCSC browser coordinates, i.e. start counting at 1 and end is inclusive.')
+    parser.add_argument('--use_fixed_len_before_and_after_fixes', action='store_true',
+                        help='only use a fixed length of the reference before the prefix and after the suffix.')
+    parser.add_argument('--before_and_after_fixes_len', type=int, default=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN,
+                        help='the number of reference bases to use before the prefix and after the suffix '
+                             'when --use_fixed_len_before_and_after_fixes is set')
 
     args = parser.parse_args()
 
@@ -156,6 +270,22 @@ if __name__ == "__main__":
     verbose = args.verbose
     only_use_provided_fixes = args.only_use_provided_fixes
     ucsc_browser_coords = args.ucsc_browser_coords
+    use_fixed_len_before_and_after_fixes = args.use_fixed_len_before_and_after_fixes
+    before_and_after_fixes_len = args.before_and_after_fixes_len
+
+    if before_and_after_fixes_len < 0:
+        sys.stderr.write("Error: --before_and_after_fixes_len must not be negative\n")
+        sys.exit(1)
+
+    try:
+        write_genome_str_graph(iter_genome_str_graph(config, reference_file, repeat_orientation, prefix_orientation,
+                                                     suffix_orientation, only_use_provided_fixes, ucsc_browser_coords,
+                                                     verbose, use_fixed_len_before_and_after_fixes,
+                                                     before_and_after_fixes_len), sys.stdout)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}.\n")
+        sys.exit(1)
+
 
-    print_genome_str_graph(*get_genome_str_graph(config, reference_file, repeat_orientation, prefix_orientation,
-                                                 suffix_orientation, only_use_provided_fixes, ucsc_browser_coords, verbose))
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+"""Call the alleles of every locus from the per-read counts written by STRcount or parse_gaf.py.
+
+Only reads that span the locus and have at least min_identity are used. The counts of a locus are split into the two
+groups with the smallest sum of squared distances to their means, which for one dimension is the best of the splits
+between two neighbouring counts in sorted order, i.e. 1D 2-means. Two alleles are called if both groups have at least
+min_allele_reads reads and min_allele_fraction of the reads, and the split explains at least min_explained of the
+variance of the counts, otherwise one allele is called from all reads. An allele is the median count of its reads,
+its confidence interval the one of the median from the order statistics of its reads, and its depth the number of
+its reads.
+
+All loci of a sample are genotyped at once with numpy: the reads are sorted by locus and count, and the sums that
+give the squared distances of every split are cumulative sums over all loci. Samples are read and genotyped one by
+one, so a cohort is never held in memory at once.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+
+import numpy as np
+
+DEFAULT_MIN_ALLELE_READS = 2
+DEFAULT_MIN_ALLELE_FRACTION = 0.2
+DEFAULT_MIN_EXPLAINED = 0.5
+DEFAULT_CONFIDENCE = 0.95
+
+GENOTYPE_COLUMNS = ["sample", "locus", "depth", "allele1", "allele1_ci_low", "allele1_ci_high", "allele1_depth",
+                    "allele2", "allele2_ci_low", "allele2_ci_high", "allele2_depth", "histogram"]
+
+
+def load_counts(counts_file):
+    """The columns locus, count, spanned and identity of a counts file as numpy arrays. Parquet and Arrow IPC files,
+    see columnar_output, are recognized by their extension, other files are read as TSV."""
+    columns = ["locus", "count", "spanned", "identity"]
+    if counts_file.endswith((".parquet", ".arrow")):
+        from columnar_output import ARROW_FORMAT, PARQUET_FORMAT, read_output
+        table = read_output(counts_file, PARQUET_FORMAT if counts_file.endswith(".parquet") else ARROW_FORMAT)
+        return {column: table.column(column).to_numpy() for column in columns}
+    import pandas as pd
+    df = pd.read_csv(counts_file, sep="\t", usecols=columns, dtype={"locus": str})
+    return {column: df[column].to_numpy() for column in columns}
+
+
+def _group_keys(groups, counts):
+    # one integer per group and count that sorts by group, then count, faster to sort than both
+    return groups.astype(np.int64) * (int(counts.max(initial=0)) + 1) + counts
+
+
+def _medians(values, starts, sizes):
+    return (values[starts + (sizes - 1) // 2] + values[starts + sizes // 2]) / 2
+
+
+def _median_intervals(values, starts, sizes, confidence):
+    # the ranks of the order statistics that cover the median with the confidence, from the normal approximation of
+    # the binomial distribution
+    half_width = statistics.NormalDist().inv_cdf(0.5 + confidence / 2) * np.sqrt(sizes) / 2
+    low = np.clip(np.floor(sizes / 2 - half_width).astype(np.int64) - 1, 0, sizes - 1)
+    high = np.clip(np.ceil(sizes / 2 + half_width).astype(np.int64) - 1, 0, sizes - 1)
+    return values[starts + low], values[starts + high]
+
+
+def call_alleles(groups, counts, n_groups, min_allele_reads=DEFAULT_MIN_ALLELE_READS,
+                 min_allele_fraction=DEFAULT_MIN_ALLELE_FRACTION, min_explained=DEFAULT_MIN_EXPLAINED,
+                 confidence=DEFAULT_CONFIDENCE):
+    """Call one or two alleles for each of n_groups groups of counts, groups is the group of every count.
+
+    Returns a dict of arrays with one value per group: depth, allele1, allele1_ci_low, allele1_ci_high, allele1_depth
+    and the same for allele2, which is NaN and 0 for groups with one allele or without counts. allele1 is the shorter
+    allele.
+    """
+    order = np.argsort(_group_keys(groups, counts), kind="stable")
+    groups = groups[order]
+    values = counts[order].astype(np.float64)
+    sizes = np.bincount(groups, minlength=n_groups)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+
+    # the sizes, sums and sums of squares left and right of a split after every count of its group
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    squares = np.concatenate(([0.0], np.cumsum(values * values)))
+    ends = starts + sizes
+    left_n = np.arange(len(values)) - starts[groups] + 1
+    left_sum = sums[1:] - sums[starts][groups]
+    left_squares = squares[1:] - squares[starts][groups]
+    right_n = sizes[groups] - left_n
+    right_sum = sums[ends][groups] - sums[1:]
+    right_squares = squares[ends][groups] - squares[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        split_sse = left_squares - left_sum ** 2 / left_n + right_squares - right_sum ** 2 / right_n
+    minor = np.minimum(left_n, right_n)
+    valid = (minor >= max(1, min_allele_reads)) & (minor >= min_allele_fraction * sizes[groups])
+    split_sse = np.where(valid, split_sse, np.inf)
+
+    # the best split of every group is the first of the group when sorted by group and sum of squares
+    has_counts = sizes > 0
+    best = np.lexsort((split_sse, groups))[starts[has_counts]]
+    best_sse = np.full(n_groups, np.inf)
+    best_sse[has_counts] = split_sse[best]
+    split = np.zeros(n_groups, dtype=np.int64)
+    split[has_counts] = left_n[best]
+    total_sse = np.zeros(n_groups)
+    total_sse[has_counts] = (squares[ends] - squares[starts] - (sums[ends] - sums[starts]) ** 2 / np.maximum(sizes, 1)
+                             )[has_counts]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        two = np.isfinite(best_sse) & (total_sse > 0) & (1 - best_sse / total_sse >= min_explained)
+
+    first_sizes = np.where(two, split, sizes)
+    second_sizes = np.where(two, sizes - split, 0)
+    genotypes = {"depth": sizes}
+    for allele, allele_starts, allele_sizes in (("allele1", starts, first_sizes),
+                                                ("allele2", starts + first_sizes, second_sizes)):
+        called = allele_sizes > 0
+        median = np.full(n_groups, np.nan)
+        low = np.full(n_groups, np.nan)
+        high = np.full(n_groups, np.nan)
+        median[called] = _medians(values, allele_starts[called], allele_sizes[called])
+        low[called], high[called] = _median_intervals(values, allele_starts[called], allele_sizes[called], confidence)
+        genotypes[allele] = median
+        genotypes[allele + "_ci_low"] = low
+        genotypes[allele + "_ci_high"] = high
+        genotypes[allele + "_depth"] = allele_sizes
+    return genotypes
+
+
+def count_histograms(groups, counts, n_groups):
+    """The histogram of the counts of every group as a string count:reads,count:reads sorted by count."""
+    keys, reads = np.unique(_group_keys(groups, counts), return_counts=True)
+    width = int(counts.max(initial=0)) + 1
+    histograms = [[] for _ in range(n_groups)]
+    for group, count, n in zip((keys // width).tolist(), (keys % width).tolist(), reads.tolist()):
+        histograms[group].append(f"{count}:{n}")
+    return [",".join(histogram) for histogram in histograms]
+
+
+def genotype_counts(columns, min_identity=0.50, **kwargs):
+    """The genotypes of the loci of columns as returned by load_counts(), a dict of the GENOTYPE_COLUMNS but sample
+    with one value per locus, the loci in sorted order. kwargs are passed to call_alleles()."""
+    keep = columns["spanned"].astype(bool) & (columns["identity"] >= min_identity)
+    loci, groups = np.unique(columns["locus"].astype(str), return_inverse=True)
+    # loci without any read that passes the filters are reported with a depth of 0
+    groups = groups.reshape(-1)[keep]
+    counts = columns["count"][keep].astype(np.int64)
+    genotypes = {"locus": loci.tolist()}
+    genotypes.update(call_alleles(groups, counts, len(loci), **kwargs))
+    genotypes["histogram"] = count_histograms(groups, counts, len(loci))
+    return genotypes
+
+
+def _format(value):
+    # medians are whole or half counts
+    if isinstance(value, (float, np.floating)):
+        if np.isnan(value):
+            return "NA"
+        return str(int(value)) if value.is_integer() else f"{value:.1f}"
+    return str(value)
+
+
+def write_genotypes(genotypes, out, sample):
+    """Write the genotypes returned by genotype_counts() as rows of the sample to out, without a header."""
+    columns = [genotypes[column] for column in GENOTYPE_COLUMNS[1:]]
+    for row in zip(*columns):
+        out.write("\t".join([sample] + [_format(value) for value in row]) + "\n")
+
+
+def genotype_files(counts_files, out, samples=None, min_identity=0.50, **kwargs):
+    """Genotype the counts files one after the other and write the genotypes with a header to out. The samples are
+    named by samples, or by the file names without extension."""
+    out.write("\t".join(GENOTYPE_COLUMNS) + "\n")
+    for i, counts_file in enumerate(counts_files):
+        sample = samples[i] if samples else os.path.basename(counts_file).split(".")[0]
+        write_genotypes(genotype_counts(load_counts(counts_file), min_identity, **kwargs), out, sample)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Call one or two alleles per locus from the per-read counts of '
+                                                 'STRcount or parse_gaf.py, of one or many samples')
+    parser.add_argument('--counts', nargs='+', required=True,
+                        help='the counts files, TSV or the .parquet or .arrow files of --output_format')
+    parser.add_argument('--samples', nargs='+', required=False,
+                        help='the sample names of the counts files (default: the file names without extension)')
+    parser.add_argument('--output', required=False, help='the output file (default: stdout)')
+    parser.add_argument('--min-identity', type=float, default=0.50,
+                        help='only use reads with at least this identity (default: 0.5)')
+    parser.add_argument('--min-allele-reads', type=int, default=DEFAULT_MIN_ALLELE_READS,
+                        help=f'the reads a second allele needs (default: {DEFAULT_MIN_ALLELE_READS})')
+    parser.add_argument('--min-allele-fraction', type=float, default=DEFAULT_MIN_ALLELE_FRACTION,
+                        help=f'the fraction of the reads a second allele needs (default: '
+                             f'{DEFAULT_MIN_ALLELE_FRACTION})')
+    parser.add_argument('--min-explained', type=float, default=DEFAULT_MIN_EXPLAINED,
+                        help=f'the fraction of the variance of the counts two alleles have to explain (default: '
+                             f'{DEFAULT_MIN_EXPLAINED})')
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE,
+                        help=f'the confidence level of the intervals of the alleles (default: {DEFAULT_CONFIDENCE})')
+    args = parser.parse_args()
+
+    if args.samples and len(args.samples) != len(args.counts):
+        sys.stderr.write("Error: --samples needs one name per counts file.\n")
+        sys.exit(1)
+    if not 0 < args.confidence < 1:
+        sys.stderr.write("Error: --confidence has to be between 0 and 1.\n")
+        sys.exit(1)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        genotype_files(args.counts, out, args.samples, args.min_identity, min_allele_reads=args.min_allele_reads,
+                       min_allele_fraction=args.min_allele_fraction, min_explained=args.min_explained,
+                       confidence=args.confidence)
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#! /usr/bin/env python
+"""A cache of generated STR graphs shared by the runs of STRcount.
+
+Every graph is stored in a directory named after a hash of everything it is generated from: the loci of the config
+file, the reference contigs they are on and the options of iter_genome_str_graph(). Runs with the same config and
+reference find their graph in the cache instead of generating it. The least recently used graphs are removed when
+the cache grows beyond its size limit.
+
+GraphAligner builds its index in memory on every run and does not persist it, so only the graph is cached. Anything
+written next to the graph in its directory is kept and evicted together with it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from genome_str_graph_generator import DEFAULT_BEFORE_AND_AFTER_FIXES_LEN, iter_genome_str_graph, load_config, \
+    open_indexed_reference, write_genome_str_graph
+
+GRAPH_FILE = "genome_str_graph.gfa"
+DEFAULT_MAX_CACHE_BYTES = 10 * 1024 ** 3
+
+
+def _reference_contigs(reference_file, chromosomes):
+    """Names and lengths of the contigs of the reference the loci are on, None if the reference can not be indexed."""
+    fasta = open_indexed_reference(reference_file)
+    if fasta is None:
+        return None
+    with fasta:
+        return sorted((name, length) for name, length in zip(fasta.references, fasta.lengths) if name in chromosomes)
+
+
+def graph_cache_key(config,
+                    reference_file,
+                    repeat_orientation="+",
+                    prefix_orientation="+",
+                    suffix_orientation="+",
+                    only_use_provided_fixes=False,
+                    ucsc_browser_coords=False,
+                    use_fixed_len_before_and_after_fixes=False,
+                    before_and_after_fixes_len=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN):
+    """The hash of the inputs of iter_genome_str_graph() the graph depends on.
+
+    The reference is identified by its absolute path, size, modification time and the contigs the loci are on, so
+    a reference that is replaced or edited gets a new key.
+    """
+    loci = load_config(config, ucsc_browser_coords)
+    stat = os.stat(reference_file)
+    inputs = {
+        "loci": loci,
+        "reference": [os.path.abspath(reference_file), stat.st_size, stat.st_mtime_ns],
+        "contigs": _reference_contigs(reference_file, {locus[0] for locus in loci}),
+        "orientations": [repeat_orientation, prefix_orientation, suffix_orientation],
+        "only_use_provided_fixes": only_use_provided_fixes,
+        "before_and_after_fixes_len": before_and_after_fixes_len if use_fixed_len_before_and_after_fixes else None,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+class GraphCache:
+    """The graphs in cache_dir, cache_dir/<key>/genome_str_graph.gfa, at most max_bytes in total."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entries(self):
+        for key in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, key)
+            if os.path.isfile(os.path.join(entry, GRAPH_FILE)):
+                yield key, entry
+
+    @staticmethod
+    def _size(entry):
+        size = 0
+        for dir_path, _, file_names in os.walk(entry):
+            for file_name in file_names:
+                size += os.path.getsize(os.path.join(dir_path, file_name))
+        return size
+
+    def lookup(self, key):
+        """The path of the graph with the key or None, marks the graph as used."""
+        graph_file = os.path.join(self.cache_dir, key, GRAPH_FILE)
+        if not os.path.isfile(graph_file):
+            return None
+        os.utime(graph_file)
+        return graph_file
+
+    def add(self, key, write_graph):
+        """Store the graph written by write_graph(out) under the key and return its path.
+
+        The graph is written to a temporary directory that is renamed, so concurrent runs never see a partial graph.
+        """
+        tmp_entry = tempfile.mkdtemp(prefix=".tmp_", dir=self.cache_dir)
+        try:
+            with open(os.path.join(tmp_entry, GRAPH_FILE), "w") as out:
+                write_graph(out)
+            os.rename(tmp_entry, os.path.join(self.cache_dir, key))
+        except OSError:
+            # another run added the same graph first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            if self.lookup(key) is None:
+                raise
+        except BaseException:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        self.evict(keep=key)
+        return self.lookup(key)
+
+    def evict(self, keep=None):
+        """Remove the least recently used graphs until the cache is no larger than max_bytes, except keep."""
+        entries = list()
+        for key, entry in self._entries():
+            entries.append((os.path.getmtime(os.path.join(entry, GRAPH_FILE)), key, entry, self._size(entry)))
+        total = sum(size for _, _, _, size in entries)
+        for _, key, entry, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def get_graph(self,
+                  config,
+                  reference_file,
+                  repeat_orientation="+",
+                  prefix_orientation="+",
+                  suffix_orientation="+",
+                  only_use_provided_fixes=False,
+                  ucsc_browser_coords=False,
+                  verbose=False,
+                  use_fixed_len_before_and_after_fixes=False,
+                  before_and_after_fixes_len=DEFAULT_BEFORE_AND_AFTER_FIXES_LEN):
+        """The path of the graph of config and reference_file, generated with iter_genome_str_graph() if it is not in
+        the cache."""
+        key = graph_cache_key(config, reference_file, repeat_orientation, prefix_orientation, suffix_orientation,
+                              only_use_provided_fixes, ucsc_browser_coords, use_fixed_len_before_and_after_fixes,
+                              before_and_after_fixes_len)
+        graph_file = self.lookup(key)
+        if graph_file is not None:
+            if verbose:
+                sys.stderr.write(f"Using the cached graph {graph_file}\n")
+            return graph_file
+
+        def write_graph(out):
+            write_genome_str_graph(iter_genome_str_graph(config, reference_file, repeat_orientation,
+                                                         prefix_orientation, suffix_orientation,
+                                                         only_use_provided_fixes, ucsc_browser_coords, verbose,
+                                                         use_fixed_len_before_and_after_fixes,
+                                                         before_and_after_fixes_len), out)
+        return self.add(key, write_graph)
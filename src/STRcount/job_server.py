@@ -0,0 +1,405 @@
+#! /usr/bin/env python
+"""A long running server that counts the reads of jobs submitted over HTTP, with the STR graphs kept warm.
+
+Every run of STRcount.py imports its modules, generates the graph and reads its nodes before GraphAligner starts,
+which for small targeted jobs takes longer than aligning their reads. The server does this once: the graph of a
+config and reference is generated when the first job needs it, kept in a graph_cache.GraphCache on disk, and its
+nodes and locus names are kept in memory for the max_graphs most recently used configs. A job then only runs
+GraphAligner and counts its alignments.
+
+Jobs are put in a queue of at most max_queued_jobs jobs and run by workers jobs at the same time, each GraphAligner
+with threads threads. A job that is submitted while the queue is full is refused with 503 and a Retry-After header,
+so clients back off instead of piling up work. The server listens on a TCP port or a Unix socket:
+
+    POST /jobs              {"config": ..., "reference": ..., "fastq": ...}, returns the job with its id
+    GET  /jobs              all jobs
+    GET  /jobs/<id>         the job: its status (queued, running, done or failed), output, error and times
+    GET  /jobs/<id>/result  the output of a job that is done
+    GET  /status            the number of queued and running jobs and of warm graphs
+
+The counts of a job are written to <output_directory>/<id>.tsv, or .parquet or .arrow, see STRcount.write_counts().
+The temporary files of a job are removed when it is done and kept when it failed. A job is forgotten job_ttl seconds
+after it finished, its output stays in the output directory.
+"""
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from columnar_output import DEFAULT_COMPRESSION, COMPRESSIONS, FILE_EXTENSIONS, OUTPUT_FORMATS, TSV_FORMAT, \
+    check_output_format
+from genome_str_graph_generator import load_config
+from graph_cache import DEFAULT_MAX_CACHE_BYTES, GraphCache, graph_cache_key
+from parse_gaf import get_locus_names, read_graph_nodes
+from STRcount import GRAPH_OPTIONS, align_and_count, check_parse_options, generate_graph, write_counts
+
+DEFAULT_PORT = 8765
+DEFAULT_MAX_QUEUED_JOBS = 100
+DEFAULT_MAX_GRAPHS = 16
+DEFAULT_JOB_TTL = 24 * 3600
+MAX_REQUEST_BYTES = 1024 ** 2
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_REASONS = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+            409: "Conflict", 413: "Payload Too Large", 503: "Service Unavailable"}
+_CONTENT_TYPES = {TSV_FORMAT: "text/tab-separated-values", "parquet": "application/vnd.apache.parquet",
+                  "arrow": "application/vnd.apache.arrow.file"}
+
+
+class Job:
+    """A submitted job, the reads fastq counted with the graph of config and reference."""
+
+    def __init__(self, job_id, config, reference, fastq):
+        self.id = job_id
+        self.config = config
+        self.reference = reference
+        self.fastq = fastq
+        self.status = QUEUED
+        self.output = None
+        self.error = None
+        self.alignments = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def to_dict(self):
+        return {"id": self.id, "status": self.status, "config": self.config, "reference": self.reference,
+                "fastq": self.fastq, "output": self.output, "error": self.error, "alignments": self.alignments,
+                "queued_s": (self.started or time.time()) - self.submitted,
+                "run_s": None if self.started is None else (self.finished or time.time()) - self.started}
+
+
+class WarmGraphs:
+    """The graphs of the configs and references of the jobs, in a graph_cache.GraphCache in cache_dir, and the nodes
+    and locus names of the max_graphs most recently used ones in memory. A graph is generated once, also when
+    several jobs need it at the same time. graph_options are the GRAPH_OPTIONS of STRcount.generate_graph()."""
+
+    def __init__(self, cache_dir, max_graphs=DEFAULT_MAX_GRAPHS, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES,
+                 verbose=False, **graph_options):
+        self.cache_dir = cache_dir
+        self.max_graphs = max_graphs
+        self.max_cache_bytes = max_cache_bytes
+        self.verbose = verbose
+        self.graph_options = graph_options
+        self.cache = GraphCache(cache_dir, max_cache_bytes)
+        self.graphs = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.key_locks = dict()
+
+    def get(self, config, reference):
+        """The graph file, its nodes, see parse_gaf.read_graph_nodes(), and the locus names of config."""
+        key = graph_cache_key(config, reference, **self.graph_options)
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                graph = self.graphs.get(key)
+                if graph is not None:
+                    self.graphs.move_to_end(key)
+            # the lookup marks the graph as used in the cache, so the cache evicts the graphs that are not warm first.
+            # A graph that was evicted anyway, e.g. by a run of STRcount that shares the cache, is generated again.
+            if graph is not None and self.cache.lookup(key) is not None:
+                return graph
+            graph_file = generate_graph(config, reference, self.cache_dir, graph_cache_dir=self.cache_dir,
+                                        graph_cache_max_bytes=self.max_cache_bytes, verbose=self.verbose,
+                                        **self.graph_options)
+            graph = (graph_file, read_graph_nodes(graph_file), get_locus_names(config))
+            with self.lock:
+                self.graphs[key] = graph
+                while len(self.graphs) > self.max_graphs:
+                    self.graphs.popitem(last=False)
+            return graph
+
+    def __len__(self):
+        return len(self.graphs)
+
+
+class JobServer:
+    """Run the jobs of a queue of at most max_queued_jobs jobs, workers at the same time. The outputs are written to
+    out_dir in output_format, see STRcount.write_counts(). kwargs are the keyword arguments of STRcount.run_pipeline(),
+    the graph options and the ones of STRcount.align_and_count(). The graphs are kept in graph_cache_dir, by default
+    out_dir/graph_cache, see WarmGraphs."""
+
+    def __init__(self, out_dir="./", workers=1, max_queued_jobs=DEFAULT_MAX_QUEUED_JOBS, max_graphs=DEFAULT_MAX_GRAPHS,
+                 output_format=TSV_FORMAT, compression=DEFAULT_COMPRESSION, genotype=False, job_ttl=DEFAULT_JOB_TTL,
+                 **kwargs):
+        check_output_format(output_format, compression)
+        check_parse_options(kwargs.get("stream_alignments", False), kwargs.get("columnar_parser", False),
+                            kwargs.get("workers", 1), kwargs.get("max_alignments_in_memory"),
+                            kwargs.get("resume", False), kwargs.get("shards", 1),
+                            mmap_parser=kwargs.get("mmap_parser", False))
+        if kwargs.get("resume", False):
+            raise ValueError("the jobs of the server can not be resumed")
+        self.out_dir = out_dir
+        self.workers = workers
+        self.output_format = output_format
+        self.compression = compression
+        self.genotype = genotype
+        graph_options = {option: kwargs.pop(option) for option in GRAPH_OPTIONS if option in kwargs}
+        graph_cache_dir = graph_options.pop("graph_cache_dir", None) or os.path.join(out_dir, "graph_cache")
+        max_cache_bytes = graph_options.pop("graph_cache_max_bytes", DEFAULT_MAX_CACHE_BYTES)
+        self.graphs = WarmGraphs(graph_cache_dir, max_graphs, max_cache_bytes, kwargs.get("verbose", False),
+                                 **graph_options)
+        self.kwargs = kwargs
+        self.jobs = dict()
+        # the finished jobs in the order they finished in, see expire_jobs()
+        self.job_ttl = job_ttl
+        self.finished_jobs = collections.deque()
+        # created in start(), an asyncio.Queue belongs to the event loop it is used in
+        self.queue = None
+        self.max_queued_jobs = max_queued_jobs
+        self.executor = None
+        self.worker_tasks = list()
+
+    def submit(self, config, reference, fastq):
+        """Queue a job and return it. Raises FileNotFoundError if one of the files does not exist, ValueError if the
+        config is malformed and asyncio.QueueFull if the queue is full."""
+        for path in (config, reference, fastq):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"{path} does not exist")
+        load_config(config)
+        # the ids of the jobs of earlier runs of the server in the same output directory are not reused
+        job = Job(uuid.uuid4().hex[:12], os.path.abspath(config), os.path.abspath(reference),
+                  os.path.abspath(fastq))
+        self.queue.put_nowait(job)
+        self.jobs[job.id] = job
+        return job
+
+    def count(self, job):
+        """Count the reads of job, run in a thread of the executor. Returns the output file and the number of
+        alignments."""
+        graph_file, graph_nodes, locus_names = self.graphs.get(job.config, job.reference)
+        tmp_dir = os.path.join(self.out_dir, "tmp", job.id)
+        os.makedirs(tmp_dir, exist_ok=True)
+        alignments = align_and_count(graph_file, graph_nodes, locus_names, job.fastq, tmp_dir, **self.kwargs)
+        n_alignments = len(alignments)
+        output = os.path.join(self.out_dir, job.id + FILE_EXTENSIONS[self.output_format])
+        write_counts(alignments, output, output_format=self.output_format, compression=self.compression,
+                     genotype=self.genotype, min_identity=self.kwargs.get("min_identity", 0.50))
+        shutil.rmtree(tmp_dir)
+        return output, n_alignments
+
+    async def _work(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            job.status = RUNNING
+            job.started = time.time()
+            try:
+                job.output, job.alignments = await loop.run_in_executor(self.executor, self.count, job)
+                job.status = DONE
+                logging.info(f"Job {job.id} is done")
+            except subprocess.CalledProcessError as e:
+                logging.error(f"Error in aligning the reads of job {job.id} to the reference graph, GraphAligner "
+                              f"exited with {e.returncode}")
+                job.error = f"GraphAligner exited with {e.returncode}"
+                job.status = FAILED
+            except (Exception, SystemExit) as e:
+                # a failed job must not stop its worker, nor the server when a library function exits
+                logging.exception(f"Job {job.id} failed")
+                job.error = str(e) or type(e).__name__
+                job.status = FAILED
+            finally:
+                job.finished = time.time()
+                self.finished_jobs.append(job)
+                self.queue.task_done()
+
+    def expire_jobs(self):
+        """Forget the jobs that finished more than job_ttl seconds ago."""
+        expired = time.time() - self.job_ttl
+        while self.finished_jobs and self.finished_jobs[0].finished <= expired:
+            del self.jobs[self.finished_jobs.popleft().id]
+
+    async def start(self):
+        """Create the queue and start the workers in the running event loop."""
+        self.queue = asyncio.Queue(self.max_queued_jobs)
+        # GraphAligner runs in its own process, so threads are enough to run several jobs at the same time
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.worker_tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Cancel the workers, the running jobs are finished first."""
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+    def status(self):
+        return {"queued": self.queue.qsize(), "max_queued": self.max_queued_jobs,
+                "running": sum(job.status == RUNNING for job in self.jobs.values()), "workers": self.workers,
+                "warm_graphs": len(self.graphs)}
+
+    async def route(self, method, path, body):
+        """The status code, headers and body of the response to an HTTP request."""
+        self.expire_jobs()
+        parts = path.split("?", 1)[0].strip("/").split("/")
+        if parts == ["status"] and method == "GET":
+            return _json_response(200, self.status())
+        if parts == ["jobs"] and method == "GET":
+            return _json_response(200, [job.to_dict() for job in self.jobs.values()])
+        if parts == ["jobs"] and method == "POST":
+            try:
+                request = json.loads(body)
+                config, reference, fastq = request["config"], request["reference"], request["fastq"]
+            except (ValueError, KeyError, TypeError) as e:
+                return _json_response(400, {"error": f"the body has to be a JSON object with config, reference and "
+                                                     f"fastq: {e}"})
+            try:
+                job = self.submit(config, reference, fastq)
+            except (FileNotFoundError, ValueError, TypeError) as e:
+                return _json_response(400, {"error": str(e)})
+            except asyncio.QueueFull:
+                return _json_response(503, {"error": f"{self.max_queued_jobs} jobs are queued, retry later"},
+                                      {"Retry-After": "1"})
+            return _json_response(202, job.to_dict(), {"Location": f"/jobs/{job.id}"})
+        if len(parts) in (2, 3) and parts[0] == "jobs" and (len(parts) == 2 or parts[2] == "result"):
+            if method != "GET":
+                return _json_response(405, {"error": f"{method} is not allowed"})
+            job = self.jobs.get(parts[1])
+            if job is None:
+                return _json_response(404, {"error": f"there is no job {parts[1]}"})
+            if len(parts) == 2:
+                return _json_response(200, job.to_dict())
+            if job.status != DONE:
+                return _json_response(409, {"error": f"job {job.id} is {job.status}"})
+            # the output is read in a thread, the event loop keeps answering the other requests
+            output = await asyncio.get_running_loop().run_in_executor(None, _read_file, job.output)
+            return 200, {"Content-Type": _CONTENT_TYPES[self.output_format]}, output
+        return _json_response(404, {"error": f"there is no {path}"})
+
+    async def handle(self, reader, writer):
+        """Answer one HTTP request of a connection, see route()."""
+        try:
+            request_line = (await reader.readline()).decode("latin-1").split()
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode("latin-1").strip()
+                if not line:
+                    break
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            content_length = headers.get("content-length", "0")
+            if len(request_line) < 2 or not content_length.isdigit():
+                response = _json_response(400, {"error": "not an HTTP request"})
+            elif int(content_length) > MAX_REQUEST_BYTES:
+                response = _json_response(413, {"error": "the request is too large"})
+            else:
+                body = await reader.readexactly(int(content_length))
+                response = await self.route(request_line[0], request_line[1], body)
+            status, response_headers, response_body = response
+            writer.write(f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Length: {len(response_body)}\r\n"
+                         f"Connection: close\r\n".encode()
+                         + "".join(f"{name}: {value}\r\n" for name, value in response_headers.items()).encode()
+                         + b"\r\n" + response_body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # the client went away
+            pass
+        finally:
+            writer.close()
+
+
+def _read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _json_response(status, value, headers=None):
+    return status, dict(headers or {}, **{"Content-Type": "application/json"}), json.dumps(value).encode() + b"\n"
+
+
+async def start_server(job_server, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None):
+    """Start the workers of job_server and an asyncio.Server that answers its requests on host and port, or on the
+    Unix socket socket_path. The port is picked by the system if it is 0."""
+    await job_server.start()
+    if socket_path:
+        return await asyncio.start_unix_server(job_server.handle, path=socket_path)
+    return await asyncio.start_server(job_server.handle, host, port)
+
+
+async def serve(job_server, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None):
+    """Run job_server, see start_server(), until it is cancelled."""
+    server = await start_server(job_server, host, port, socket_path)
+    logging.info(f"Listening on {socket_path or f'{host}:{port}'}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await job_server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Count the repeats of jobs submitted over HTTP with the STR graphs '
+                                                 'of their configs kept warm, see the documentation of the module')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f'the port to listen on (default: {DEFAULT_PORT})')
+    parser.add_argument('--socket', help='listen on this Unix socket instead of --host and --port')
+    parser.add_argument('--output-directory', default='./', help='the directory of the outputs of the jobs')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of jobs that run at the same time (default: 1)')
+    parser.add_argument('--max-queued-jobs', type=int, default=DEFAULT_MAX_QUEUED_JOBS,
+                        help=f'refuse jobs when this number of jobs is queued (default: {DEFAULT_MAX_QUEUED_JOBS})')
+    parser.add_argument('--max-graphs', type=int, default=DEFAULT_MAX_GRAPHS,
+                        help=f'the number of graphs kept in memory (default: {DEFAULT_MAX_GRAPHS})')
+    parser.add_argument('--job-ttl', type=float, default=DEFAULT_JOB_TTL,
+                        help=f'forget the jobs this number of seconds after they finished, their outputs are kept '
+                             f'(default: {DEFAULT_JOB_TTL})')
+    parser.add_argument('--graph-cache-dir', help='keep the graphs in this directory (default: graph_cache in the '
+                                                  'output directory)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='the threads of GraphAligner per job (default: 1)')
+    parser.add_argument('--min-identity', type=float, default=0.50,
+                        help='only use reads with identity greater than this')
+    parser.add_argument('--min-aligned-fraction', type=float, default=0.8,
+                        help='require alignments cover this proportion of the query sequence')
+    parser.add_argument('--write-non-spanned', action='store_true', help='do not require the reads to span the '
+                                                                         'prefix/suffix region')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=TSV_FORMAT,
+                        help='write the counts as TSV, or typed columns to a Parquet or Arrow IPC file (default: tsv)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=DEFAULT_COMPRESSION,
+                        help=f'the compression of the parquet and arrow output (default: {DEFAULT_COMPRESSION})')
+    parser.add_argument('--genotype', action='store_true', help='also call the alleles of every locus, see STRcount '
+                                                                '--genotype')
+    parser.add_argument('--verbose', action='store_true', help='verbose')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.workers < 1 or args.max_queued_jobs < 1 or args.max_graphs < 1:
+        sys.stderr.write("Error: --workers, --max-queued-jobs and --max-graphs have to be at least 1.\n")
+        sys.exit(1)
+    try:
+        job_server = JobServer(args.output_directory, args.workers, args.max_queued_jobs, args.max_graphs,
+                               args.output_format, args.compression, args.genotype, args.job_ttl, threads=args.threads,
+                               min_identity=args.min_identity, min_aligned_fraction=args.min_aligned_fraction,
+                               write_non_spanned=args.write_non_spanned, graph_cache_dir=args.graph_cache_dir,
+                               verbose=args.verbose)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}.\n")
+        sys.exit(1)
+    except ImportError:
+        sys.stderr.write(f"Error: --output-format {args.output_format} needs pyarrow, install it with pip install "
+                         "pyarrow.\n")
+        sys.exit(1)
+    try:
+        asyncio.run(serve(job_server, args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
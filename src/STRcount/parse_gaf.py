@@ -1,11 +1,19 @@
 #! /usr/bin/env python
 
 import argparse
+import collections
+import multiprocessing
+import os
 import sys
 
+from compressed_io import NO_COMPRESSION, detect_compression, open_text
+
 
 class GraphAlignment:
-    def __init__(self, read_name, strand, spanned, count, alignment_score, identity, aligned_fraction):
+    # no per-instance dict, there is one GraphAlignment per read and locus
+    __slots__ = ["read_name", "strand", "spanned", "count", "alignment_score", "identity", "aligned_fraction", "locus"]
+
+    def __init__(self, read_name, strand, spanned, count, alignment_score, identity, aligned_fraction, locus):
         self.read_name = read_name
         self.strand = strand
         self.spanned = spanned
@@ -13,93 +21,440 @@ class GraphAlignment:
         self.alignment_score = alignment_score
         self.identity = identity
         self.aligned_fraction = aligned_fraction
+        self.locus = locus
 
     def print(self):
         sys.stderr.write(
-            f"read_name: {self.read_name}, strand: {self.strand}, spanned: {self.spanned}, count: {self.count}, alignment_score: {self.alignment_score}, identity: {self.identity}, aligned_fraction: {self.aligned_fraction}\n")
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--input', help='the input file which was generated from graphaligner', required=True)
-parser.add_argument('--min-identity', type=float, default=0.50,
-                    help='only use reads with identity greater than this', required=False)
-parser.add_argument('--min-aligned-fraction', type=float, default=0.8,
-                    help='require alignments cover this proportion of the query sequence', required=False)
-parser.add_argument('--write-non-spanned', action='store_true', default=False,
-                    help='do not require the reads to span the prefix/suffix region', required=False)
-parser.add_argument('--verbose', action='store_true', help='verbose')
-
-args = parser.parse_args()
-
-input_file = open(args.input)
-
-alignments = dict()
-with open(args.input) as f:
-    for record in f:
-        fields = record.rstrip().split("\t")
-
-        if args.verbose:
-            sys.stderr.write(f"Processing alignment: {', '.join(fields)}\n")
-
-        read_id = fields[0].split(' ')[0]  # remove FASTQ metadata that GraphAligner emits
-
-        tags = dict()
-        for t in fields[12:]:
-            (key, data_type, value) = t.split(":")
-            tags[key] = value
-
-        align_score = float(tags["AS"])
-        identity = float(tags["id"])
-
-        query_len = int(fields[1])
-        query_start = int(fields[2])
-        query_end = int(fields[3])
-        query_af = float(query_end - query_start) / float(query_len)
-
-        path_str = fields[5]
-        path_dir = path_str[0]
-        segments = path_str.split(path_dir)
-        has_prefix = False
-        has_suffix = False
-
-        count = 0
-        for s in segments:
-            if s.find("prefix") >= 0:
-                has_prefix = True
-            if s.find("suffix") >= 0:
-                has_suffix = True
-            count += s.find("repeat") >= 0
-
-        valid = has_prefix and has_suffix
-        strand = fields[4]
-        if args.verbose:
-            if strand != "+":
-                sys.stderr.write("Strand is not \"+\", exiting.\n")
-        assert (strand == "+")
-        if path_dir == "<":
-            strand = "-"
-        ga = GraphAlignment(read_id, strand, valid, count, align_score, identity, query_af)
-        if args.verbose:
-            sys.stderr.write("Found alignment: \n")
-            ga.print()
-        if not valid and not args.write_non_spanned:
-            if args.verbose:
-                sys.stderr.write("Skipping alignment because it does not span the prefix/suffix region\n")
-            continue
-        if ga.identity < args.min_identity:
-            if args.verbose:
-                sys.stderr.write("Skipping alignment because identity is too low\n")
-            continue
-        if ga.aligned_fraction < args.min_aligned_fraction:
-            if args.verbose:
-                sys.stderr.write("Skipping alignment because aligned fraction is too low\n")
-            continue
-        if ga.read_name not in alignments or alignments[ga.read_name].alignment_score < ga.alignment_score:
-            if args.verbose:
-                sys.stderr.write("Keeping alignment bc it has better score than previous alignment\n")
-            alignments[ga.read_name] = ga
-
-print("\t".join(["read_name", "strand", "spanned", "count", "align_score", "identity", "query_aligned_fraction"]))
-for ga in alignments.values():
-    print("%s\t%s\t%d\t%d\t%.1f\t%.3f\t%.3f" % (ga.read_name, ga.strand, ga.spanned,
-          ga.count, ga.alignment_score, ga.identity, ga.aligned_fraction))
+            f"read_name: {self.read_name}, strand: {self.strand}, spanned: {self.spanned}, count: {self.count}, alignment_score: {self.alignment_score}, identity: {self.identity}, aligned_fraction: {self.aligned_fraction}, locus: {self.locus}\n")
+
+
+def get_locus_names(config):
+    """Map the locus ids used in the graph segment names to the locus names of the config file."""
+    from genome_str_graph_generator import load_config
+    locus_names = dict()
+    for locus in load_config(config):
+        locus_names[str(locus[7])] = locus[3]
+    return locus_names
+
+
+PREFIX = "prefix"
+REPEAT = "repeat"
+SUFFIX = "suffix"
+FLANK = "flank"
+
+
+class GraphNodes:
+    """The nodes of a STR graph with integer ids, in the order of the S lines of the GFA file.
+
+    roles[i] and loci[i] hold the role (PREFIX, REPEAT, SUFFIX or FLANK) and the locus id of node i.
+    """
+
+    def __init__(self, names, roles, loci):
+        self.names = names
+        self.roles = roles
+        self.loci = loci
+        self.ids = {name: i for i, name in enumerate(names)}
+
+
+def read_graph_nodes(gfa_file):
+    """Read the nodes of the graph written by genome_str_graph_generator.write_genome_str_graph().
+
+    The roles are taken from the links: the repeat node is the one that links to itself, the prefix links to it and
+    it links to the suffix, all other nodes are flanks. Every locus is a connected component of the graph, its id is
+    the one at the end of the name of its repeat node, see get_genome_str_graph().
+    """
+    names = list()
+    links = list()
+    with open(gfa_file) as f:
+        for line in f:
+            if line.startswith("S\t"):
+                names.append(line.split("\t", 2)[1].rstrip("\n"))
+            elif line.startswith("L\t"):
+                fields = line.split("\t")
+                links.append((fields[1], fields[3]))
+    ids = {name: i for i, name in enumerate(names)}
+    if len(ids) != len(names):
+        raise ValueError(f"{gfa_file} contains several segments with the same name")
+
+    roles = [FLANK] * len(names)
+    neighbours = [list() for _ in names]
+    for from_name, to_name in links:
+        if from_name not in ids or to_name not in ids:
+            raise ValueError(f"{gfa_file} links a segment that it does not contain")
+        from_id, to_id = ids[from_name], ids[to_name]
+        neighbours[from_id].append(to_id)
+        neighbours[to_id].append(from_id)
+        if from_id == to_id:
+            roles[from_id] = REPEAT
+    for from_name, to_name in links:
+        from_id, to_id = ids[from_name], ids[to_name]
+        if from_id != to_id and roles[to_id] == REPEAT:
+            roles[from_id] = PREFIX
+        if from_id != to_id and roles[from_id] == REPEAT:
+            roles[to_id] = SUFFIX
+
+    loci = [None] * len(names)
+    for repeat_id in [i for i, role in enumerate(roles) if role == REPEAT]:
+        locus_id = names[repeat_id].rsplit("_", 1)[-1]
+        stack = [repeat_id]
+        while stack:
+            node = stack.pop()
+            if loci[node] is None:
+                loci[node] = locus_id
+                stack.extend(neighbours[node])
+    return GraphNodes(names, roles, loci)
+
+
+def split_path(path_str):
+    """The node names of a GAF path, e.g. >a<b<b>c, each node is preceded by the direction it is visited in."""
+    # replace() and split() are several times faster than re.split() on long paths
+    return path_str[1:].replace("<", ">").split(">")
+
+
+def count_repeats(path_nodes, graph_nodes):
+    """The number of visits of the repeat node per locus id of (node id, visits) pairs."""
+    counts = dict()
+    for node_id, visits in path_nodes:
+        if graph_nodes.roles[node_id] == REPEAT:
+            locus_id = graph_nodes.loci[node_id]
+            counts[locus_id] = counts.get(locus_id, 0) + visits
+    return counts
+
+
+def summarize_path(path_str, graph_nodes):
+    """Returns if the path visits the prefix and the suffix, the locus id of its first node and the repeat count at
+    that locus."""
+    # only the distinct nodes are looked up, the visits of a node are counted in one pass over the path
+    node_names = split_path(path_str)
+    try:
+        path_nodes = [(graph_nodes.ids[name], visits) for name, visits in collections.Counter(node_names).items()]
+    except KeyError as e:
+        raise ValueError(f"the path {path_str} visits the node {e} which is not in the graph")
+    roles = {graph_nodes.roles[node_id] for node_id, _ in path_nodes}
+    locus_id = graph_nodes.loci[path_nodes[0][0]]
+    return PREFIX in roles, SUFFIX in roles, locus_id, count_repeats(path_nodes, graph_nodes).get(locus_id, 0)
+
+
+def summarize_path_by_names(path_str):
+    """Same as summarize_path() without the graph, the role of the nodes is guessed from their names."""
+    segments = path_str.split(path_str[0])
+    has_prefix = False
+    has_suffix = False
+    # all segments of a locus end in _<locus_id>, see get_genome_str_graph
+    locus_id = segments[1].rsplit("_", 1)[-1]
+
+    # only the distinct segments are looked at, a repeat segment is visited once per repeat unit
+    count = 0
+    for s, visits in collections.Counter(segments).items():
+        if s.find("prefix") >= 0:
+            has_prefix = True
+        if s.find("suffix") >= 0:
+            has_suffix = True
+        if s.find("repeat") >= 0:
+            count += visits
+    return has_prefix, has_suffix, locus_id, count
+
+
+def parse_gaf_record(record, locus_names=None, verbose=False, graph_nodes=None):
+    """Turn one line of GraphAligner's GAF output into a GraphAlignment.
+
+    With graph_nodes, see read_graph_nodes(), the nodes of the path are looked up by their id in the graph. Otherwise
+    their role is guessed from their name, which fails for chromosome names that contain e.g. "prefix".
+    """
+    fields = record.rstrip().split("\t")
+
+    if verbose:
+        sys.stderr.write(f"Processing alignment: {', '.join(fields)}\n")
+
+    read_id = fields[0].split(' ')[0]  # remove FASTQ metadata that GraphAligner emits
+
+    tags = dict()
+    for t in fields[12:]:
+        (key, data_type, value) = t.split(":")
+        tags[key] = value
+
+    align_score = float(tags["AS"])
+    identity = float(tags["id"])
+
+    query_len = int(fields[1])
+    query_start = int(fields[2])
+    query_end = int(fields[3])
+    query_af = float(query_end - query_start) / float(query_len)
+
+    path_str = fields[5]
+    path_dir = path_str[0]
+    if graph_nodes is not None:
+        has_prefix, has_suffix, locus_id, count = summarize_path(path_str, graph_nodes)
+    else:
+        has_prefix, has_suffix, locus_id, count = summarize_path_by_names(path_str)
+    locus = locus_names.get(locus_id, locus_id) if locus_names else locus_id
+
+    valid = has_prefix and has_suffix
+    strand = fields[4]
+    if verbose:
+        if strand != "+":
+            sys.stderr.write("Strand is not \"+\", exiting.\n")
+    assert (strand == "+")
+    if path_dir == "<":
+        strand = "-"
+    ga = GraphAlignment(read_id, strand, valid, count, align_score, identity, query_af, locus)
+    if verbose:
+        sys.stderr.write("Found alignment: \n")
+        ga.print()
+    return ga
+
+
+def keep_alignment(ga, min_identity=0.50, min_aligned_fraction=0.8, write_non_spanned=False, verbose=False):
+    """Apply the spanned, identity and aligned fraction filters to an alignment."""
+    if not ga.spanned and not write_non_spanned:
+        if verbose:
+            sys.stderr.write("Skipping alignment because it does not span the prefix/suffix region\n")
+        return False
+    if ga.identity < min_identity:
+        if verbose:
+            sys.stderr.write("Skipping alignment because identity is too low\n")
+        return False
+    if ga.aligned_fraction < min_aligned_fraction:
+        if verbose:
+            sys.stderr.write("Skipping alignment because aligned fraction is too low\n")
+        return False
+    return True
+
+
+def add_alignment(alignments, ga, verbose=False):
+    """Store ga in alignments if it is the best alignment of its read at its locus so far."""
+    # a read can span several loci, keep the best alignment of the read for each of them
+    key = (ga.read_name, ga.locus)
+    if key not in alignments or alignments[key].alignment_score < ga.alignment_score:
+        if verbose:
+            sys.stderr.write("Keeping alignment bc it has better score than previous alignment\n")
+        alignments[key] = ga
+
+
+def parse_gaf(records,
+              min_identity=0.50,
+              min_aligned_fraction=0.8,
+              write_non_spanned=False,
+              locus_names=None,
+              verbose=False,
+              graph_nodes=None):
+    """Parse GAF lines, e.g. an open GAF file, into a dict of the best alignment per (read name, locus)."""
+    alignments = dict()
+    for record in records:
+        ga = parse_gaf_record(record, locus_names, verbose, graph_nodes)
+        if keep_alignment(ga, min_identity, min_aligned_fraction, write_non_spanned, verbose):
+            add_alignment(alignments, ga, verbose)
+    return alignments
+
+
+def split_gaf_file(gaf_file, n_ranges):
+    """Split gaf_file into at most n_ranges byte ranges (begin, end) of about the same size that start at a line."""
+    size = os.path.getsize(gaf_file)
+    boundaries = [0]
+    with open(gaf_file, "rb") as f:
+        for i in range(1, n_ranges):
+            f.seek(max(size * i // n_ranges - 1, boundaries[-1]))
+            f.readline()
+            if f.tell() >= size:
+                break
+            if f.tell() > boundaries[-1]:
+                boundaries.append(f.tell())
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def iter_gaf_range(gaf_file, begin, end):
+    """Yield the GAF lines in the byte range begin to end of gaf_file, see split_gaf_file()."""
+    with open(gaf_file, "rb") as f:
+        f.seek(begin)
+        while begin < end:
+            line = f.readline()
+            if not line:
+                break
+            begin += len(line)
+            yield line.decode()
+
+
+def _parse_gaf_range(args):
+    gaf_file, begin, end, min_identity, min_aligned_fraction, write_non_spanned, locus_names, columnar, \
+        graph_nodes = args
+    if columnar:
+        from parse_gaf_columnar import parse_gaf_columnar
+        return parse_gaf_columnar(iter_gaf_range(gaf_file, begin, end), min_identity, min_aligned_fraction,
+                                  write_non_spanned, locus_names, graph_nodes=graph_nodes)
+    from parse_gaf_mmap import parse_gaf_mmap
+    return parse_gaf_mmap(gaf_file, min_identity, min_aligned_fraction, write_non_spanned, locus_names, graph_nodes,
+                          begin, end)
+
+
+def parse_gaf_parallel(gaf_file,
+                       workers,
+                       min_identity=0.50,
+                       min_aligned_fraction=0.8,
+                       write_non_spanned=False,
+                       locus_names=None,
+                       columnar=False,
+                       graph_nodes=None):
+    """Same as parse_gaf() on the lines of gaf_file but parses byte ranges of the file in a pool of worker processes.
+
+    The ranges are parsed on the memory mapped file by parse_gaf_mmap.parse_gaf_mmap(), or by
+    parse_gaf_columnar.parse_gaf_columnar() with columnar. The best alignments of the ranges are merged in file
+    order with add_alignment(), so the result, including its order and which alignment is kept on equal scores, does
+    not depend on the number of workers. Raises ValueError for compressed files, they can not be split into byte
+    ranges.
+    """
+    if detect_compression(gaf_file) != NO_COMPRESSION:
+        raise ValueError(f"{gaf_file} is compressed and can not be parsed by several workers")
+    # more ranges than workers so a slow range does not hold up the others
+    ranges = split_gaf_file(gaf_file, workers * 4)
+    tasks = [(gaf_file, begin, end, min_identity, min_aligned_fraction, write_non_spanned, locus_names, columnar,
+              graph_nodes) for begin, end in ranges]
+    alignments = dict()
+    with multiprocessing.Pool(workers) as pool:
+        for range_alignments in pool.imap(_parse_gaf_range, tasks):
+            for ga in range_alignments.values():
+                add_alignment(alignments, ga)
+    return alignments
+
+
+def write_alignments(alignments, out):
+    """Write the alignments, a dict as returned by parse_gaf() or anything else with values(), as TSV."""
+    out.write("\t".join(["read_name", "strand", "spanned", "count", "align_score", "identity",
+                         "query_aligned_fraction", "locus"]) + "\n")
+    for ga in alignments.values():
+        out.write("%s\t%s\t%d\t%d\t%.1f\t%.3f\t%.3f\t%s\n" % (ga.read_name, ga.strand, ga.spanned,
+                  ga.count, ga.alignment_score, ga.identity, ga.aligned_fraction, ga.locus))
+
+
+def main():
+    from columnar_output import COMPRESSIONS, DEFAULT_COMPRESSION, OUTPUT_FORMATS, TSV_FORMAT, check_output_format, \
+        write_output
+    from stage_metrics import StageMetrics, count_records
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='the input file which was generated from graphaligner, plain, gzip, bgzip or '
+                                        'zstd compressed', required=True)
+    parser.add_argument('--decompress-threads', type=int, default=1,
+                        help='decompress the input with bgzip, pigz or zstd with this number of threads while it is '
+                             'parsed, if they are installed (default: 1)')
+    parser.add_argument('--min-identity', type=float, default=0.50,
+                        help='only use reads with identity greater than this', required=False)
+    parser.add_argument('--min-aligned-fraction', type=float, default=0.8,
+                        help='require alignments cover this proportion of the query sequence', required=False)
+    parser.add_argument('--write-non-spanned', action='store_true', default=False,
+                        help='do not require the reads to span the prefix/suffix region', required=False)
+    parser.add_argument('--config', required=False,
+                        help='the config file the graph was generated from, used to report the locus names '
+                             'instead of their position in the config file')
+    parser.add_argument('--graph', required=False,
+                        help='the GFA file the reads were aligned to, the nodes of the paths are looked up in it '
+                             'instead of being recognized by their name')
+    parser.add_argument('--columnar', action='store_true',
+                        help='parse the alignments in chunks of 4 MB as columns with numpy, about twice as fast for '
+                             'large files but without verbose output per alignment')
+    parser.add_argument('--mmap', action='store_true',
+                        help='parse the plain input file memory mapped, only the columns that are used are copied '
+                             'from it. Can not be combined with --columnar or --max-alignments-in-memory')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of processes that parse parts of the input file in parallel (default: 1)')
+    parser.add_argument('--max-alignments-in-memory', type=int, required=False,
+                        help='spill the best alignments to temporary files when more than this number of reads is '
+                             'kept in memory, can not be combined with --columnar or --workers')
+    parser.add_argument('--tmp-dir', required=False, help='the directory for the spilled alignments')
+    parser.add_argument('--output', required=False,
+                        help='the output file, required for --output-format parquet or arrow (default: stdout)')
+    parser.add_argument('--output-format', choices=OUTPUT_FORMATS, default=TSV_FORMAT,
+                        help='write TSV, or typed columns to a Parquet or Arrow IPC file, which need pyarrow '
+                             '(default: tsv)')
+    parser.add_argument('--compression', choices=COMPRESSIONS, default=DEFAULT_COMPRESSION,
+                        help='the compression of the parquet and arrow output, arrow only supports zstd, lz4 and '
+                             f'none (default: {DEFAULT_COMPRESSION})')
+    parser.add_argument('--metrics', required=False,
+                        help='write the wall time, CPU time, peak memory, bytes read and written and throughput, e.g. '
+                             'the alignments parsed per second, of the parse and write stages as JSON to this file')
+    parser.add_argument('--verbose', action='store_true', help='verbose')
+
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        sys.stderr.write("Error: --workers has to be at least 1.\n")
+        sys.exit(1)
+    if args.workers > 1 and detect_compression(args.input) != NO_COMPRESSION:
+        sys.stderr.write("Error: --workers can not be used for compressed input.\n")
+        sys.exit(1)
+    if args.mmap and (args.columnar or args.max_alignments_in_memory is not None):
+        sys.stderr.write("Error: --mmap can not be combined with --columnar or --max-alignments-in-memory.\n")
+        sys.exit(1)
+    if args.mmap and detect_compression(args.input) != NO_COMPRESSION:
+        sys.stderr.write("Error: --mmap can not be used for compressed input.\n")
+        sys.exit(1)
+    if args.max_alignments_in_memory is not None:
+        if args.max_alignments_in_memory < 1:
+            sys.stderr.write("Error: --max-alignments-in-memory has to be at least 1.\n")
+            sys.exit(1)
+        if args.columnar or args.workers > 1:
+            sys.stderr.write("Error: --max-alignments-in-memory can not be combined with --columnar or --workers.\n")
+            sys.exit(1)
+
+    if args.output_format != TSV_FORMAT:
+        if not args.output:
+            sys.stderr.write(f"Error: --output-format {args.output_format} needs --output.\n")
+            sys.exit(1)
+        try:
+            check_output_format(args.output_format, args.compression)
+        except ValueError as e:
+            sys.stderr.write(f"Error: {e}.\n")
+            sys.exit(1)
+        except ImportError:
+            sys.stderr.write(f"Error: --output-format {args.output_format} needs pyarrow, install it with pip install "
+                             "pyarrow.\n")
+            sys.exit(1)
+
+    try:
+        locus_names = get_locus_names(args.config) if args.config else None
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}.\n")
+        sys.exit(1)
+    graph_nodes = read_graph_nodes(args.graph) if args.graph else None
+
+    metrics = StageMetrics()
+    with metrics.stage("parse") as counts:
+        if args.max_alignments_in_memory is not None:
+            from parse_gaf_external import parse_gaf_external
+            with open_text(args.input, args.decompress_threads) as f:
+                alignments = parse_gaf_external(count_records(f, counts), args.min_identity,
+                                                args.min_aligned_fraction, args.write_non_spanned, locus_names,
+                                                args.max_alignments_in_memory, args.tmp_dir, graph_nodes)
+        elif args.mmap and args.workers <= 1:
+            from parse_gaf_mmap import parse_gaf_mmap
+            alignments = parse_gaf_mmap(args.input, args.min_identity, args.min_aligned_fraction,
+                                        args.write_non_spanned, locus_names, graph_nodes, counts=counts)
+        elif args.workers > 1:
+            alignments = parse_gaf_parallel(args.input, args.workers, args.min_identity, args.min_aligned_fraction,
+                                            args.write_non_spanned, locus_names, args.columnar, graph_nodes)
+        else:
+            with open_text(args.input, args.decompress_threads) as f:
+                records = count_records(f, counts)
+                if args.columnar:
+                    from parse_gaf_columnar import parse_gaf_columnar
+                    alignments = parse_gaf_columnar(records, args.min_identity, args.min_aligned_fraction,
+                                                    args.write_non_spanned, locus_names, graph_nodes=graph_nodes)
+                else:
+                    alignments = parse_gaf(records, args.min_identity, args.min_aligned_fraction,
+                                           args.write_non_spanned, locus_names, args.verbose, graph_nodes)
+        counts["kept_alignments"] = len(alignments)
+
+    with metrics.stage("write"):
+        if args.output:
+            write_output(alignments, args.output, args.output_format, args.compression)
+        else:
+            write_alignments(alignments, sys.stdout)
+    if args.max_alignments_in_memory is not None:
+        alignments.close()
+    if args.metrics:
+        with open(args.metrics, "w") as out:
+            metrics.write(out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+#! /usr/bin/env python
+"""Batched GAF parsing, the per-record work of parse_gaf.parse_gaf() done on columns of a chunk of records.
+
+The records of a chunk are joined into one buffer. numpy finds the lines, fields and tags from the positions of the
+newlines and tabs and parses the numbers, the path columns are scanned with bytes methods on offsets into the buffer
+so no field is split or copied. With the graph every distinct path of a chunk is summarized once, the reads of an
+allele share their path. The filters are applied to the columns, only the rows that pass them are turned into tuples
+and reduced to the best alignment per read and locus. A chunk holds at most chunk_size records of at most chunk_bytes
+characters, so the memory does not grow with the size of the GAF file.
+
+Records that do not look like GraphAligner output (e.g. trailing whitespace, unusual tags or paths) are handed to
+parse_gaf.parse_gaf_record() so the output is identical to parse_gaf.parse_gaf(), including the order of the
+alignments and which alignment is kept when several have the same score.
+"""
+
+import itertools
+
+import numpy as np
+
+from parse_gaf import keep_alignment, parse_gaf_record, summarize_path, GraphAlignment
+
+COLS = ["read_name", "strand", "spanned", "count", "align_score", "identity", "aligned_fraction", "locus"]
+GAF_MANDATORY_FIELDS = 12
+MAX_INT_DIGITS = 18
+DEFAULT_CHUNK_BYTES = 4 * 1024 ** 2
+
+
+def _parse_ints(buf, begins, ends):
+    """Parse the decimal numbers in buf[begins:ends], returns the values and a mask of the valid ones."""
+    lengths = ends - begins
+    valid = (lengths > 0) & (lengths <= MAX_INT_DIGITS)
+    lengths = np.where(valid, lengths, 0)
+    offsets = np.arange(max(int(lengths.max(initial=0)), 1))
+    in_field = offsets < lengths[:, None]
+    digits = buf[np.minimum(begins[:, None] + offsets, len(buf) - 1)].astype(np.int64) - ord("0")
+    digits = np.where(in_field, digits, 0)
+    valid &= ((digits >= 0) & (digits <= 9)).all(axis=1)
+    powers = 10 ** np.clip(lengths[:, None] - 1 - offsets, 0, None)
+    return (np.where(valid[:, None], digits, 0) * powers).sum(axis=1), valid
+
+
+def _tag_values(buf, tabs, tab_lines, tag_tabs, line_ends, n_lines, key):
+    """Find the value of the tag key, e.g. AS:f:25.5, on every line. tag_tabs masks the tabs that start a tag.
+    Returns the values as bytes and a mask of the lines on which the tag was found exactly once."""
+    is_key = tag_tabs.copy()
+    # the type is a single character, see parse_gaf_record()
+    for i, c in enumerate(b"\t" + key + b":"):
+        is_key &= buf[np.minimum(tabs + i, len(buf) - 1)] == c
+    key_tabs = np.flatnonzero(is_key)
+    valid = np.bincount(tab_lines[key_tabs], minlength=n_lines) == 1
+    value_begins = tabs[key_tabs] + len(key) + 4
+    valid[tab_lines[key_tabs[buf[value_begins - 1] != ord(":")]]] = False
+    # the value ends at the next tab of the line or at the end of the line
+    next_tabs = np.minimum(key_tabs + 1, len(tabs) - 1)
+    value_ends = np.where((key_tabs + 1 < len(tabs)) & (tab_lines[next_tabs] == tab_lines[key_tabs]),
+                          tabs[next_tabs], line_ends[tab_lines[key_tabs]])
+    lines = tab_lines[key_tabs]
+    keep = valid[lines]
+    return lines[keep], value_begins[keep], value_ends[keep], valid
+
+
+def parse_gaf_chunk(records, first_order=0, locus_names=None, graph_nodes=None):
+    """Parse a list of GAF lines into columns, a dict of the COLS and order to arrays with one row per alignment,
+    and the (order, parse_gaf.GraphAlignment) of the records that parse_gaf.parse_gaf_record() parsed.
+
+    The order column holds the position of the record in the GAF file, starting at first_order. With graph_nodes the
+    distinct paths are summarized with parse_gaf.summarize_path().
+    """
+    data = "".join(records).encode()
+    if data.count(b"\n") != len(records) or not data.endswith(b"\n"):
+        data = "".join(record.rstrip("\n") + "\n" for record in records).encode()
+    buf = np.frombuffer(data, dtype=np.uint8)
+
+    line_ends = np.flatnonzero(buf == ord("\n"))
+    line_starts = np.concatenate(([0], line_ends[:-1] + 1))
+    n_lines = len(line_starts)
+    tabs = np.flatnonzero(buf == ord("\t"))
+    tab_lines = np.searchsorted(line_starts, tabs, side="right") - 1
+    first_tab = np.searchsorted(tabs, line_starts)
+    n_tabs = np.searchsorted(tabs, line_ends) - first_tab
+
+    last_char = buf[np.maximum(line_ends - 1, 0)]
+    simple = n_tabs >= GAF_MANDATORY_FIELDS
+    simple &= ~np.isin(last_char, np.frombuffer(b" \t\r\x0b\x0c", dtype=np.uint8))
+    simple[np.searchsorted(line_starts, np.flatnonzero(buf >= 128), side="right") - 1] = False
+    if not len(tabs):
+        tabs = np.zeros(1, dtype=np.int64)
+
+    # field i of a simple line is buf[field_begins[i]:field_ends[i]]
+    tab_index = np.where(simple, first_tab, 0)[:, None] + np.arange(GAF_MANDATORY_FIELDS)
+    field_tabs = tabs[np.minimum(tab_index, len(tabs) - 1)]
+    field_begins = np.concatenate((line_starts[:, None], field_tabs[:, :-1] + 1), axis=1).T
+    field_ends = field_tabs.T
+
+    query_lens, valid = _parse_ints(buf, field_begins[1], field_ends[1])
+    simple &= valid & (query_lens > 0)
+    query_starts, valid = _parse_ints(buf, field_begins[2], field_ends[2])
+    simple &= valid
+    query_ends, valid = _parse_ints(buf, field_begins[3], field_ends[3])
+    simple &= valid
+    simple &= (field_ends[4] - field_begins[4] == 1) & (buf[field_begins[4]] == ord("+"))
+
+    path_dir = buf[field_begins[5]]
+    simple &= (field_ends[5] > field_begins[5]) & np.isin(path_dir, np.frombuffer(b"<>", dtype=np.uint8))
+
+    tag_tabs = (np.arange(len(tabs)) - first_tab[tab_lines] >= GAF_MANDATORY_FIELDS - 1) & simple[tab_lines]
+    tag_values = list()
+    for key in (b"AS", b"id"):
+        lines, value_begins, value_ends, valid = _tag_values(buf, tabs, tab_lines, tag_tabs, line_ends, n_lines,
+                                                             key)
+        simple &= valid
+        tag_values.append((lines, value_begins, value_ends))
+
+    rows = np.flatnonzero(simple)
+    path_begins = field_begins[5][rows].tolist()
+    path_ends = field_ends[5][rows].tolist()
+    path_dirs = [bytes((d,)) for d in path_dir[rows].tolist()]
+
+    if graph_nodes is not None:
+        # the reads of an allele have the same path, every distinct path is summarized once and its summary is
+        # spread to the rows by the codes of the paths
+        codes = dict()
+        rows_codes = [codes.setdefault(data[b:e], len(codes)) for b, e in zip(path_begins, path_ends)]
+        summaries = [summarize_path(path.decode(), graph_nodes) for path in codes]
+        spanned = np.array([has_prefix and has_suffix for has_prefix, has_suffix, _, _ in summaries],
+                           dtype=bool)[rows_codes]
+        loci = [summaries[code][2] for code in rows_codes]
+        repeats = np.array([count for _, _, _, count in summaries], dtype=np.int64)[rows_codes]
+    else:
+        # parse_gaf_record() splits the path on its first character and counts the segments that contain "repeat". When
+        # every "repeat" starts a segment that is the number of "repeat" after the path direction.
+        repeats = np.array([data.count(d + b"repeat", b, e) for d, b, e in zip(path_dirs, path_begins, path_ends)],
+                           dtype=np.int64)
+        if repeats.sum() != data.count(b"repeat"):
+            simple[rows] = repeats == [data.count(b"repeat", b, e) for b, e in zip(path_begins, path_ends)]
+        spanned = np.array([data.find(b"prefix", b, e) >= 0 and data.find(b"suffix", b, e) >= 0
+                            for b, e in zip(path_begins, path_ends)], dtype=bool)
+        # the locus id follows the last "_" of the first segment
+        loci = list()
+        for d, b, e in zip(path_dirs, path_begins, path_ends):
+            segment_end = data.find(d, b + 1, e)
+            if segment_end < 0:
+                segment_end = e
+            loci.append(data[max(data.rfind(b"_", b + 1, segment_end), b) + 1:segment_end].decode())
+    if locus_names:
+        loci = [locus_names.get(locus_id, locus_id) for locus_id in loci]
+
+    tag_columns = list()
+    for lines, value_begins, value_ends in tag_values:
+        values = np.full(n_lines, np.nan)
+        values[lines] = np.array([data[b:e] for b, e in zip(value_begins.tolist(), value_ends.tolist())],
+                                 dtype=bytes).astype(float)
+        tag_columns.append(values[rows])
+
+    # remove FASTQ metadata that GraphAligner emits
+    read_names = list()
+    for b, e in zip(line_starts[rows].tolist(), field_ends[0][rows].tolist()):
+        name_end = data.find(b" ", b, e)
+        read_names.append(data[b:e if name_end < 0 else name_end].decode())
+
+    # the rows of the lines that turned out not to be simple while their paths were scanned are left out
+    keep = simple[rows]
+    columns = {
+        "read_name": np.array(read_names, dtype=object)[keep],
+        "strand": np.where(path_dir[rows] == ord("<"), "-", "+")[keep],
+        "spanned": spanned[keep],
+        "count": repeats[keep],
+        "align_score": tag_columns[0][keep],
+        "identity": tag_columns[1][keep],
+        "aligned_fraction": ((query_ends[rows] - query_starts[rows]) / query_lens[rows])[keep],
+        "locus": np.array(loci, dtype=object)[keep],
+        "order": rows[keep] + first_order,
+    }
+    others = list()
+    for i in np.flatnonzero(~simple).tolist():
+        others.append((i + first_order, parse_gaf_record(data[line_starts[i]:line_ends[i]].decode(), locus_names,
+                                                         graph_nodes=graph_nodes)))
+    return columns, others
+
+
+def filter_alignments(columns, min_identity=0.50, min_aligned_fraction=0.8, write_non_spanned=False):
+    """The filters of parse_gaf.keep_alignment() as a mask of the rows of columns."""
+    mask = (columns["identity"] >= min_identity) & (columns["aligned_fraction"] >= min_aligned_fraction)
+    if not write_non_spanned:
+        mask &= columns["spanned"]
+    return mask
+
+
+def add_best_alignments(alignments, rows):
+    """Keep the row with the highest score per (read name, locus) in alignments, the earliest one on ties like
+    parse_gaf.add_alignment(). The rows are tuples of COLS in the order of the records."""
+    for row in rows:
+        key = (row[0], row[7])
+        best = alignments.get(key)
+        if best is None or best[4] < row[4]:
+            alignments[key] = row
+
+
+def parse_gaf_columnar(records,
+                       min_identity=0.50,
+                       min_aligned_fraction=0.8,
+                       write_non_spanned=False,
+                       locus_names=None,
+                       chunk_size=100000,
+                       graph_nodes=None,
+                       chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """Same as parse_gaf.parse_gaf() but parses chunk_size records at a time as columns. A chunk ends earlier when
+    its records take chunk_bytes characters, the arrays of a chunk take a few times its size."""
+    records = iter(records)
+    alignments = dict()
+    n_records = 0
+    while True:
+        chunk_records = list()
+        n_chars = 0
+        for record in records:
+            chunk_records.append(record)
+            n_chars += len(record)
+            if len(chunk_records) >= chunk_size or n_chars >= chunk_bytes:
+                break
+        if not chunk_records:
+            break
+        columns, others = parse_gaf_chunk(chunk_records, n_records, locus_names, graph_nodes)
+        n_records += len(chunk_records)
+        keep = filter_alignments(columns, min_identity, min_aligned_fraction, write_non_spanned)
+        rows = zip(*[columns[col][keep].tolist() for col in COLS])
+        if others:
+            # the records parse_gaf_record() parsed go between the rows in the order of the records
+            orders = columns["order"][keep].tolist()
+            rows = [row for _, row in sorted(itertools.chain(
+                zip(orders, rows), ((order, (ga.read_name, ga.strand, ga.spanned, ga.count, ga.alignment_score,
+                                             ga.identity, ga.aligned_fraction, ga.locus))
+                                    for order, ga in others
+                                    if keep_alignment(ga, min_identity, min_aligned_fraction, write_non_spanned))),
+                key=lambda order_row: order_row[0])]
+        add_best_alignments(alignments, rows)
+    return {key: GraphAlignment(*row) for key, row in alignments.items()}
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+"""parse_gaf.parse_gaf() with a bounded number of alignments in memory.
+
+The best alignments per (read name, locus) are collected in a dict like parse_gaf() does. When it holds more than
+max_in_memory keys it is sorted by key and spilled to a run file on disk. The runs are merged by key, which gives the
+best alignment of every key, and the result is sorted back into the order of parse_gaf() in a second round of runs.
+"""
+
+import heapq
+import itertools
+import os
+import tempfile
+
+from parse_gaf import GraphAlignment, keep_alignment, parse_gaf_record
+
+DEFAULT_MAX_IN_MEMORY = 1000000
+
+
+def _write_run(rows, path):
+    # floats are written with repr() so they are read back exactly
+    with open(path, "w") as out:
+        for read_name, locus, first, order, ga in rows:
+            out.write("\t".join([read_name, locus, str(first), str(order), ga.strand, str(int(ga.spanned)),
+                                 str(ga.count), repr(ga.alignment_score), repr(ga.identity),
+                                 repr(ga.aligned_fraction)]) + "\n")
+
+
+def _read_run(path):
+    with open(path) as f:
+        for line in f:
+            read_name, locus, first, order, strand, spanned, count, score, identity, aligned_fraction = \
+                line.rstrip("\n").split("\t")
+            yield read_name, locus, int(first), int(order), GraphAlignment(read_name, strand, spanned == "1",
+                                                                         int(count), float(score), float(identity),
+                                                                         float(aligned_fraction), locus)
+
+
+class SpilledAlignments:
+    """The result of parse_gaf_external(), values() yields the alignments in the order of parse_gaf().values() and
+    len() is their number, like for the dict of parse_gaf(). The run files are removed by close()."""
+
+    def __init__(self, tmp_dir, runs, n_alignments):
+        self.tmp_dir = tmp_dir
+        self.runs = runs
+        self.n_alignments = n_alignments
+
+    def __len__(self):
+        return self.n_alignments
+
+    def values(self):
+        for _, _, _, _, ga in heapq.merge(*[_read_run(run) for run in self.runs], key=lambda row: row[2]):
+            yield ga
+
+    def close(self):
+        self.tmp_dir.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _merge_keys(runs):
+    """Merge runs sorted by key into the best alignment per key, see parse_gaf.add_alignment()."""
+    best = None
+    for row in heapq.merge(*[_read_run(run) for run in runs], key=lambda row: (row[0], row[1])):
+        if best is None or best[:2] != row[:2]:
+            if best is not None:
+                yield best
+            best = row
+            continue
+        # the runs are in file order, the first alignment of a key is where parse_gaf() inserts it
+        first = min(best[2], row[2])
+        if row[4].alignment_score > best[4].alignment_score or \
+                (row[4].alignment_score == best[4].alignment_score and row[3] < best[3]):
+            best = row
+        best = best[:2] + (first,) + best[3:]
+    if best is not None:
+        yield best
+
+
+def parse_gaf_external(records,
+                       min_identity=0.50,
+                       min_aligned_fraction=0.8,
+                       write_non_spanned=False,
+                       locus_names=None,
+                       max_in_memory=DEFAULT_MAX_IN_MEMORY,
+                       tmp_dir=None,
+                       graph_nodes=None):
+    """Same as parse_gaf.parse_gaf() but keeps at most max_in_memory alignments in memory, the others are spilled to
+    run files in a temporary directory in tmp_dir. Returns a SpilledAlignments."""
+    run_dir = tempfile.TemporaryDirectory(prefix="strcount_runs_", dir=tmp_dir)
+    runs = list()
+    run_ids = itertools.count()
+
+    def spill(rows, sort_key):
+        path = os.path.join(run_dir.name, f"run_{next(run_ids)}.tsv")
+        _write_run(sorted(rows, key=sort_key), path)
+        runs.append(path)
+
+    def by_key(row):
+        return row[0], row[1]
+
+    def by_first(row):
+        return row[2]
+
+    try:
+        # key: [first, order, alignment]
+        alignments = dict()
+        for order, record in enumerate(records):
+            ga = parse_gaf_record(record, locus_names, graph_nodes=graph_nodes)
+            if not keep_alignment(ga, min_identity, min_aligned_fraction, write_non_spanned):
+                continue
+            key = (ga.read_name, ga.locus)
+            if key not in alignments:
+                alignments[key] = [order, order, ga]
+            elif alignments[key][2].alignment_score < ga.alignment_score:
+                alignments[key][1:] = [order, ga]
+            if len(alignments) >= max_in_memory:
+                spill([key + tuple(value) for key, value in alignments.items()], by_key)
+                alignments.clear()
+
+        rows = [key + tuple(value) for key, value in alignments.items()]
+        del alignments
+        n_alignments = len(rows)
+        if runs:
+            spill(rows, by_key)
+            key_runs = list(runs)
+            runs.clear()
+            rows = list()
+            n_alignments = 0
+            for row in _merge_keys(key_runs):
+                rows.append(row)
+                n_alignments += 1
+                if len(rows) >= max_in_memory:
+                    spill(rows, by_first)
+                    rows = list()
+            for run in key_runs:
+                os.remove(run)
+        spill(rows, by_first)
+    except BaseException:
+        run_dir.cleanup()
+        raise
+    return SpilledAlignments(run_dir, runs, n_alignments)
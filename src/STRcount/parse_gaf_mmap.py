@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+"""GAF parsing on a memory mapped file, the same as parse_gaf.parse_gaf() on its lines without reading them as text.
+
+parse_gaf.parse_gaf_record() decodes every line and splits it into one string per column. Here the lines and fields
+are found as offsets into the mapped file with mmap.find(), and only the columns that are used are copied and
+parsed: the read name, the query length, start and end, the strand, the path and the values of the AS and id tags.
+The path, the longest column, is only copied for the alignments that pass the identity and aligned fraction filters.
+The reads of an allele have the same path, so every distinct path is summarized once and only decoded to look its
+nodes up in the graph, without the graph its segments are recognized on the bytes. The pages of the file are read by
+the operating system and shared between the processes that map the same file, the pages that were parsed are
+released every RELEASE_BYTES so they do not add up in the resident memory.
+
+Records that do not look like GraphAligner output (e.g. trailing whitespace or without the AS or id tag) are handed
+to parse_gaf.parse_gaf_record() and paths that are not simple to count on the bytes to
+parse_gaf.summarize_path_by_names(), so the output is identical to parse_gaf.parse_gaf(), including the order of the
+alignments and which alignment is kept when several have the same score. Only plain GAF files can be mapped.
+"""
+
+import mmap
+import os
+import re
+
+from parse_gaf import GraphAlignment, add_alignment, keep_alignment, parse_gaf_record, summarize_path, \
+    summarize_path_by_names
+
+# the number of tabs before the path column
+PATH_FIELD = 5
+_WHITESPACE = b" \t\r\n\x0b\x0c"
+_TWO_REPEATS = re.compile(rb"repeat[^<>]*repeat")
+_OPPOSITE_DIRECTION = {b">": b"<", b"<": b">"}
+# the parsed part of the file is released from the mapping in steps of this size
+RELEASE_BYTES = 8 * 1024 ** 2
+# the summaries of the distinct paths are forgotten when their paths take more than this
+MAX_CACHED_PATH_BYTES = 16 * 1024 ** 2
+
+
+def _tag_value(find, mm, tag, begin, end):
+    # the value of the tag, e.g. b"\tAS:", between the offsets begin and end, None if the line does not have it
+    start = find(tag, begin, end)
+    if start < 0:
+        return None
+    start += len(tag) + 2
+    value_end = find(b"\t", start, end)
+    return mm[start:end if value_end < 0 else value_end]
+
+
+def _summarize_path_by_names(path):
+    # parse_gaf.summarize_path_by_names() on the bytes of the path without splitting it, the repeat segments are
+    # counted at once unless a segment contains "repeat" twice. summarize_path_by_names() splits the path on its
+    # first character only, so the nodes that are visited in the other direction are left to it.
+    opposite = _OPPOSITE_DIRECTION.get(path[:1])
+    if opposite is None or opposite in path or _TWO_REPEATS.search(path):
+        return summarize_path_by_names(path.decode())
+    segment_end = path.find(path[:1], 1)
+    locus_id = path[1:len(path) if segment_end < 0 else segment_end].rsplit(b"_", 1)[-1].decode()
+    return b"prefix" in path, b"suffix" in path, locus_id, path.count(b"repeat")
+
+
+def _parse_lines(mm, begin, end, alignments, min_identity, min_aligned_fraction, write_non_spanned, locus_names,
+                 graph_nodes, counts):
+    find = mm.find
+    size = len(mm)
+    previous = None
+    summaries = dict()
+    cached_bytes = 0
+    released = begin - begin % mmap.PAGESIZE
+    release = hasattr(mmap, "MADV_DONTNEED")
+    pos = begin
+    while pos < end:
+        if release and pos - released >= RELEASE_BYTES:
+            # the pages are still in the page cache, only this mapping drops them
+            release_end = pos - pos % mmap.PAGESIZE
+            mm.madvise(mmap.MADV_DONTNEED, released, release_end - released)
+            released = release_end
+        line_end = find(b"\n", pos)
+        if line_end < 0:
+            line_end = size
+        next_pos = line_end + 1
+
+        # the columns before the path are short, they are copied in one piece and split
+        fields = None
+        path_end = -1
+        path_begin = find(b"\t", pos, line_end)
+        for _ in range(PATH_FIELD - 1):
+            if path_begin < 0:
+                break
+            path_begin = find(b"\t", path_begin + 1, line_end)
+        if path_begin >= 0 and mm[line_end - 1] not in _WHITESPACE:
+            path_end = find(b"\t", path_begin + 1, line_end)
+        score = identity = None
+        if path_end >= 0:
+            score = _tag_value(find, mm, b"\tAS:", path_end, line_end)
+            identity = _tag_value(find, mm, b"\tid:", path_end, line_end)
+        if score is not None and identity is not None:
+            fields = mm[pos:path_begin].split(b"\t")
+        if fields is None:
+            ga = parse_gaf_record(mm[pos:line_end].decode(), locus_names, graph_nodes=graph_nodes)
+            if keep_alignment(ga, min_identity, min_aligned_fraction, write_non_spanned):
+                add_alignment(alignments, ga)
+        else:
+            query_af = float(int(fields[3]) - int(fields[2])) / float(int(fields[1]))
+            assert fields[4] == b"+"
+            identity = float(identity)
+            # the path, the longest column, is only copied for the alignments that pass the other filters
+            if identity >= min_identity and query_af >= min_aligned_fraction:
+                path = mm[path_begin + 1:path_end]
+                summary = summaries.get(path)
+                if summary is None:
+                    if graph_nodes is not None:
+                        summary = summarize_path(path.decode(), graph_nodes)
+                    else:
+                        summary = _summarize_path_by_names(path)
+                    if cached_bytes > MAX_CACHED_PATH_BYTES:
+                        summaries.clear()
+                        cached_bytes = 0
+                    summaries[path] = summary
+                    cached_bytes += len(path)
+                has_prefix, has_suffix, locus_id, count = summary
+                spanned = has_prefix and has_suffix
+                if spanned or write_non_spanned:
+                    # remove FASTQ metadata that GraphAligner emits
+                    read_name = fields[0].split(b" ", 1)[0].decode()
+                    locus = locus_names.get(locus_id, locus_id) if locus_names else locus_id
+                    add_alignment(alignments, GraphAlignment(read_name, "-" if path[:1] == b"<" else "+", spanned,
+                                                             count, float(score), identity, query_af, locus))
+        if counts is not None:
+            # the reads are told apart by the whole first column, like stage_metrics.count_records() does
+            tab = find(b"\t", pos, line_end)
+            record_name = mm[pos:line_end if tab < 0 else tab]
+            counts["alignments"] += 1
+            if record_name != previous:
+                counts["reads"] += 1
+                previous = record_name
+        pos = next_pos
+
+
+def parse_gaf_mmap(gaf_file,
+                   min_identity=0.50,
+                   min_aligned_fraction=0.8,
+                   write_non_spanned=False,
+                   locus_names=None,
+                   graph_nodes=None,
+                   begin=0,
+                   end=None,
+                   counts=None):
+    """Same as parse_gaf.parse_gaf() on the lines of the plain GAF file gaf_file, or on the lines that start in its
+    byte range begin to end, see parse_gaf.split_gaf_file(). With counts, a collections.Counter, the alignments and
+    the reads they are of are counted like stage_metrics.count_records() does."""
+    alignments = dict()
+    with open(gaf_file, "rb") as f:
+        # an empty file can not be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            return alignments
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            _parse_lines(mm, begin, len(mm) if end is None else min(end, len(mm)), alignments, min_identity,
+                         min_aligned_fraction, write_non_spanned, locus_names, graph_nodes, counts)
+    return alignments
@@ -0,0 +1,172 @@
+#! /usr/bin/env python
+"""Keep only the reads that share k-mers with the configured loci, so GraphAligner does not align the whole genome.
+
+The k-mers of the prefix, repeat and suffix of every locus are collected on both strands as 2-bit encoded integers.
+The k-mers of a read are computed with numpy and looked up in the sorted index, a read is kept if at least min_hits
+of them are in the index. The reads are read with pysam.FastxFile and checked in batches by a pool of processes.
+"""
+
+import argparse
+import collections
+import itertools
+import multiprocessing
+import sys
+
+import numpy as np
+import pysam
+
+from defaults import DEFAULT_K, MAX_K
+from genome_str_graph_generator import load_config
+
+BATCH_SIZE = 1000
+# the lowest bits of a k-mer that are looked up in a table before the sorted k-mers are searched
+TABLE_BITS = 22
+
+_CODES = np.full(256, 4, dtype=np.uint64)
+for _i, _base in enumerate(b"ACGT"):
+    _CODES[_base] = _i
+    _CODES[ord(chr(_base).lower())] = _i
+_COMPLEMENT = str.maketrans("ACGTacgt", "TGCAtgca")
+
+
+def encode_kmers(sequence, k=DEFAULT_K, positions=False):
+    """The k-mers of sequence as integers, k-mers with other bases than ACGT are left out. With positions the start
+    positions of the k-mers in sequence are returned as well."""
+    codes = _CODES[np.frombuffer(sequence.encode(), dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        kmers = np.zeros(0, dtype=np.uint64)
+        return (kmers, np.zeros(0, dtype=np.intp)) if positions else kmers
+    kmers = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        kmers = (kmers << np.uint64(2)) | (codes[j:j + n] & np.uint64(3))
+    unknown = np.concatenate(([0], np.cumsum(codes == 4)))
+    known = unknown[k:] == unknown[:-k]
+    if positions:
+        return kmers[known], np.flatnonzero(known)
+    return kmers[known]
+
+
+def reverse_complement(sequence):
+    return sequence.translate(_COMPLEMENT)[::-1]
+
+
+class KmerIndex:
+    """The sorted k-mers of the loci and a table of their lowest TABLE_BITS bits, most k-mers of a read that are not
+    in the index are ruled out by the table without searching the k-mers."""
+
+    def __init__(self, kmers, k):
+        self.kmers = kmers
+        self.k = k
+        self.table = np.zeros(1 << TABLE_BITS, dtype=bool)
+        self.table[(kmers & np.uint64((1 << TABLE_BITS) - 1)).astype(np.intp)] = True
+
+    def count_hits(self, sequence):
+        """The number of k-mers of sequence that are in the index."""
+        kmers = encode_kmers(sequence, self.k)
+        kmers = kmers[self.table[(kmers & np.uint64((1 << TABLE_BITS) - 1)).astype(np.intp)]]
+        if not len(kmers):
+            return 0
+        positions = np.minimum(np.searchsorted(self.kmers, kmers), len(self.kmers) - 1)
+        return int(np.count_nonzero(self.kmers[positions] == kmers))
+
+
+def build_kmer_index(loci, k=DEFAULT_K):
+    """The KmerIndex of the prefix, repeat and suffix of the loci, see load_config(), on both strands."""
+    if not 0 < k <= MAX_K:
+        raise ValueError(f"k has to be between 1 and {MAX_K}")
+    sequences = list()
+    for locus in loci:
+        repeat, prefix, suffix = locus[4], locus[5], locus[6]
+        # all k-mers of a tandem repeat of the motif
+        if repeat:
+            sequences.append(repeat * (k // len(repeat) + 2))
+        sequences += [prefix, suffix]
+    kmers = list()
+    for sequence in sequences:
+        kmers.append(encode_kmers(sequence, k))
+        kmers.append(encode_kmers(reverse_complement(sequence), k))
+    return KmerIndex(np.unique(np.concatenate(kmers)), k)
+
+
+_worker_args = None
+
+
+def _init_worker(index, min_hits):
+    global _worker_args
+    _worker_args = (index, min_hits)
+
+
+def _check_batch(sequences):
+    index, min_hits = _worker_args
+    return [index.count_hits(sequence) >= min_hits for sequence in sequences]
+
+
+def map_batches(function, batches, make_task, processes=1, initializer=None, initargs=()):
+    """Yield every batch with function(make_task(batch)), in the order of batches.
+
+    With several processes the tasks are run by a pool whose processes are set up with initializer(*initargs). Only
+    a few batches per process are in flight, so the input is not read into memory faster than it is processed.
+    """
+    if processes <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for batch in batches:
+            yield batch, function(make_task(batch))
+        return
+    with multiprocessing.Pool(processes, initializer=initializer, initargs=initargs) as pool:
+        pending = collections.deque()
+        for batch in batches:
+            pending.append((batch, pool.apply_async(function, (make_task(batch),))))
+            if len(pending) > 2 * processes:
+                batch, result = pending.popleft()
+                yield batch, result.get()
+        while pending:
+            batch, result = pending.popleft()
+            yield batch, result.get()
+
+
+def iter_read_batches(fastx):
+    """The records of an open pysam.FastxFile in lists of BATCH_SIZE."""
+    return iter(lambda: list(itertools.islice(fastx, BATCH_SIZE)), [])
+
+
+def prefilter_reads(reads, out_file, loci, k=DEFAULT_K, min_hits=1, processes=1):
+    """Write the reads of the FASTQ/FASTA file reads that have at least min_hits k-mers of the loci to out_file.
+    Returns the number of reads and the number of reads that were kept."""
+    index = build_kmer_index(loci, k)
+    n_reads = 0
+    n_kept = 0
+    with pysam.FastxFile(reads) as fastx, open(out_file, "w") as out:
+        for batch, keep in map_batches(_check_batch, iter_read_batches(fastx),
+                                       lambda batch: [record.sequence for record in batch], processes, _init_worker,
+                                       (index, min_hits)):
+            n_reads += len(batch)
+            for record, keep_record in zip(batch, keep):
+                if keep_record:
+                    out.write(str(record) + "\n")
+                    n_kept += 1
+    return n_reads, n_kept
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fastq', help='the reads in FASTQ or FASTA format, can be gzip compressed', required=True)
+    parser.add_argument('--config', help='the config file', required=True)
+    parser.add_argument('--output', help='the file the reads that hit a locus are written to', required=True)
+    parser.add_argument('-k', type=int, default=DEFAULT_K, help=f'the k-mer length (default: {DEFAULT_K})')
+    parser.add_argument('--min-hits', type=int, default=1,
+                        help='the number of k-mers a read has to share with the loci (default: 1)')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='the number of processes (default: 1)')
+    args = parser.parse_args()
+
+    if not 0 < args.k <= MAX_K:
+        sys.stderr.write(f"Error: -k has to be between 1 and {MAX_K}.\n")
+        sys.exit(1)
+    try:
+        loci = load_config(args.config)
+    except ValueError as e:
+        sys.stderr.write(f"Error: {e}.\n")
+        sys.exit(1)
+    n_reads, n_kept = prefilter_reads(args.fastq, args.output, loci, args.k, args.min_hits, args.threads)
+    sys.stderr.write(f"Kept {n_kept} of {n_reads} reads\n")
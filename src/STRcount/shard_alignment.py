@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+"""Align the reads with several GraphAligner processes at the same time, each aligning one shard of the reads.
+
+A single GraphAligner does not scale well to many threads, so the reads are split into shards: shard i gets every
+read whose position in the file modulo the number of shards is i. No copies of the reads are written, the reads file
+is parsed once by a single feeder that writes every read to the named pipe of its shard, which the GraphAligner of
+the shard aligns from. The GraphAligners of all shards run at the same time and share the thread budget, see
+plan_shards(). The alignments of the shards are written to GAF files and handed to the parser shard by shard, as soon
+as a shard and all shards before it are done.
+"""
+
+import concurrent.futures
+import os
+import subprocess
+import threading
+
+import pysam
+
+
+def plan_shards(shards, threads=None, cores=None):
+    """The number of threads of the GraphAligner of each shard.
+
+    threads is the total number of threads to use, at most the number of cores of the machine, and is split evenly
+    between the shards, which all run at the same time. Every shard gets at least one thread.
+    """
+    cores = cores or os.cpu_count() or 1
+    budget = min(threads, cores) if threads else cores
+    return max(1, budget // shards)
+
+
+def _close(out):
+    try:
+        out.close()
+    except BrokenPipeError:
+        # the buffered reads were not written, GraphAligner exited before it read them
+        pass
+
+
+def _feed_shards(reads, fifos, opened, errors):
+    """Write read i of the reads file to fifos[i % len(fifos)], opened[i] is set when fifos[i] is opened."""
+    outs = list()
+    try:
+        # opening a pipe blocks until GraphAligner opens it for reading. They are opened before the reads, so
+        # GraphAligner sees the end of the pipe also when the reads can not be read.
+        for fifo, fifo_opened in zip(fifos, opened):
+            outs.append(open(fifo, "w"))
+            fifo_opened.set()
+        with pysam.FastxFile(reads) as fastx:
+            for i, record in enumerate(fastx):
+                out = outs[i % len(outs)]
+                if out is None:
+                    continue
+                try:
+                    out.write(str(record) + "\n")
+                except BrokenPipeError:
+                    # GraphAligner exited before it read all reads of its shard, its exit code tells why. The other
+                    # shards are fed on.
+                    _close(out)
+                    outs[i % len(outs)] = None
+    except Exception as e:
+        # e.g. a truncated reads file, GraphAligner aligned only the reads before it and align_in_shards() raises it
+        errors.append(e)
+    finally:
+        for out in outs:
+            if out is not None:
+                _close(out)
+
+
+def align_shard(command, fifo, fifo_opened, feeder):
+    """Run the GraphAligner command of one shard that aligns the reads of the named pipe fifo, see align_in_shards().
+    Raises subprocess.CalledProcessError if GraphAligner fails."""
+    try:
+        process = subprocess.Popen(command)
+        process.wait()
+    finally:
+        # if GraphAligner exited, or did not start, before it opened the pipe the feeder waits for a reader forever,
+        # open and close the reading end until the feeder opened it, its writes then fail and it feeds the other
+        # shards on
+        while not fifo_opened.is_set() and feeder.is_alive():
+            os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+            fifo_opened.wait(0.01)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+
+def align_in_shards(get_command, reads, shard_dir, shards, threads=None, cores=None):
+    """Align the reads in shards and yield the GAF records shard by shard in the order of the shards.
+
+    get_command(reads, alignment_file, threads) returns the GraphAligner command of a shard with threads threads.
+    The GAF files are written to shard_dir. Raises subprocess.CalledProcessError if a GraphAligner fails and the
+    error of reading the reads if that failed, the shards that are still running are aligned to the end before.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    shard_threads = plan_shards(shards, threads, cores)
+    with pysam.FastxFile(reads) as fastx:
+        record = next(fastx, None)
+    # GraphAligner tells FASTA and FASTQ apart by the file extension
+    extension = ".fastq" if record is not None and record.quality else ".fasta"
+    fifos = [os.path.join(shard_dir, f"shard_{shard}{extension}") for shard in range(shards)]
+    gaf_files = [os.path.join(shard_dir, f"shard_{shard}.gaf") for shard in range(shards)]
+    for fifo in fifos:
+        if os.path.exists(fifo):
+            os.remove(fifo)
+        os.mkfifo(fifo)
+    opened = [threading.Event() for _ in range(shards)]
+    errors = list()
+    feeder = threading.Thread(target=_feed_shards, args=(reads, fifos, opened, errors), daemon=True)
+    feeder.start()
+    try:
+        # the feeder writes to the pipes in turn, so the GraphAligners of all shards have to run at the same time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=shards) as pool:
+            futures = [pool.submit(align_shard, get_command(fifo, gaf_file, shard_threads), fifo, fifo_opened, feeder)
+                       for fifo, gaf_file, fifo_opened in zip(fifos, gaf_files, opened)]
+            for future, gaf_file in zip(futures, gaf_files):
+                future.result()
+                # GraphAligner is done when the feeder closed its pipe, after it read all reads or failed
+                feeder.join()
+                if errors:
+                    raise errors[0]
+                with open(gaf_file) as f:
+                    yield from f
+    finally:
+        for fifo in fifos:
+            os.remove(fifo)
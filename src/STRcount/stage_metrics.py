@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+"""Timing, memory and throughput of the stages of STRcount, written as a JSON report.
+
+Every stage records its wall time, the CPU time of STRcount and of the processes it waited for (GraphAligner), the
+peak resident memory of both, the bytes STRcount read and wrote and the counts the stage reports, e.g. the number of
+alignments it parsed, with their rate per second of wall time.
+
+The CPU time, memory and bytes are the ones of the whole process, stages of samples that run at the same time, see
+STRcount.run_samples(), include each other. The peak memory of the child processes is the largest of all children
+that finished so far, bytes read and written by GraphAligner are not included.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+
+def _io_bytes():
+    # /proc is only there on Linux
+    try:
+        with open("/proc/self/io") as f:
+            io = dict(line.split(": ") for line in f.read().splitlines())
+        return int(io["rchar"]), int(io["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _max_rss_bytes(who):
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class _Snapshot:
+    def __init__(self):
+        self.wall_time = time.perf_counter()
+        times = os.times()
+        self.cpu_time = times.user + times.system
+        self.children_cpu_time = times.children_user + times.children_system
+        self.read_bytes, self.write_bytes = _io_bytes()
+
+
+class StageMetrics:
+    """The metrics of the stages that were run, in the order they finished."""
+
+    def __init__(self):
+        self.stages = list()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the stage name while the context is open, the context is a Counter the stage adds its counts to."""
+        counts = collections.Counter()
+        start = _Snapshot()
+        try:
+            yield counts
+        finally:
+            end = _Snapshot()
+            wall_time = end.wall_time - start.wall_time
+            stage = {
+                "stage": name,
+                "wall_time_s": wall_time,
+                "cpu_time_s": end.cpu_time - start.cpu_time,
+                "children_cpu_time_s": end.children_cpu_time - start.children_cpu_time,
+                "peak_rss_bytes": _max_rss_bytes(resource.RUSAGE_SELF),
+                "children_peak_rss_bytes": _max_rss_bytes(resource.RUSAGE_CHILDREN),
+                "read_bytes": None if start.read_bytes is None else end.read_bytes - start.read_bytes,
+                "write_bytes": None if start.write_bytes is None else end.write_bytes - start.write_bytes,
+                "counts": dict(counts),
+                "per_second": {key: value / wall_time if wall_time > 0 else None for key, value in counts.items()},
+            }
+            self.stages.append(stage)
+
+    def write(self, out):
+        """Write the report as JSON to the open file out."""
+        json.dump({"stages": self.stages}, out, indent=2)
+        out.write("\n")
+
+
+def count_records(records, counts):
+    """Yield the GAF records and count them as alignments in counts, and the reads they are of as reads. GraphAligner
+    writes the alignments of a read one after the other."""
+    previous = None
+    for record in records:
+        counts["alignments"] += 1
+        read_name = record.split("\t", 1)[0]
+        if read_name != previous:
+            counts["reads"] += 1
+            previous = read_name
+        yield record
@@ -1,8 +1,44 @@
+import asyncio
+import collections
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import tempfile
+import time
 import unittest
+from unittest import mock
+
+import numpy as np
+import pysam
 
 import sys
 sys.path.append('..')
-from genome_str_graph_generator import get_genome_str_graph
+from genome_str_graph_generator import get_genome_str_graph, iter_genome_str_graph, load_config, write_genome_str_graph
+from parse_gaf import add_alignment, get_locus_names, parse_gaf, parse_gaf_parallel, split_gaf_file, \
+    write_alignments, read_graph_nodes, split_path, summarize_path, count_repeats, PREFIX, REPEAT, SUFFIX, FLANK
+from parse_gaf_columnar import parse_gaf_columnar
+from parse_gaf_external import parse_gaf_external
+from parse_gaf_mmap import parse_gaf_mmap
+from STRcount import count_batch, count_with_engine, generate_graph, load_sample_sheet, run_pipeline, run_samples, \
+    store_key, stream_graphaligner, write_counts
+from stage_metrics import StageMetrics, count_records
+from graph_cache import GraphCache, graph_cache_key
+from read_prefilter import build_kmer_index, prefilter_reads, reverse_complement
+from shard_alignment import align_in_shards, plan_shards
+from fast_count import compare_counts, count_units, fast_count
+from compressed_io import GAF_COMPRESSIONS, EXTENSIONS, fetch_read, index_gaf, load_read_index, open_text, write_gaf
+from columnar_output import read_output, write_alignments_columnar
+from genotype import call_alleles, genotype_counts, genotype_files
+from alignment_store import AlignmentStore
+from job_server import DONE, FAILED, JobServer, WarmGraphs, start_server
+
+def io_write(write):
+    out = io.StringIO()
+    write(out)
+    return out.getvalue()
+
 
 class Test_get_genome_str_graph(unittest.TestCase):
     def test_get_genome_str_graph_browser_coods(self):
@@ -39,6 +75,914 @@ class Test_get_genome_str_graph(unittest.TestCase):
                     ["L", "ref_suffix_1", "+", "ref_after_suffix_1", "+", "0M"]]
       self.assertEqual(links["ref_1"], true_links)
 
+    def test_get_genome_str_graph_fixed_len_before_and_after_fixes(self):
+        segments, links = get_genome_str_graph(
+            "resources/config_db.tsv", "resources/ref.fa", "+", "+", "+", False, False, False, True, 5)
+        true_segments = [["S", "ref_before_prefix_1", "CCGGT"],
+                         ["S", "ref_prefix_1", "TAAACCCGGGTTT"],
+                         ["S", "repeat_1", "AA"],
+                         ["S", "ref_suffix_1", "CCCCGGGGT"],
+                         ["S", "ref_after_suffix_1", "TTT"]]
+        self.assertEqual(segments["ref_1"], true_segments)
+
+    def test_get_genome_str_graph_bgzip_reference(self):
+        self.assertEqual(
+            get_genome_str_graph("resources/config_db.tsv", "resources/ref.fa.gz", "+", "+", "+", False, False, False),
+            get_genome_str_graph("resources/config_db.tsv", "resources/ref.fa", "+", "+", "+", False, False, False))
+
+    def test_get_genome_str_graph_multiple_loci(self):
+        segments, links = get_genome_str_graph(
+            "resources/config_multi.tsv", "resources/ref.fa", "+", "+", "+", False, False, False)
+        # loci are numbered in config order and each one gets its own sub-graph
+        self.assertEqual(list(segments), ["ref_2", "ref_1"])
+        true_segments = [["S", "ref_before_prefix_2", "A"],
+                         ["S", "ref_prefix_2", "CGTAA"],
+                         ["S", "repeat_2", "CC"],
+                         ["S", "ref_suffix_2", "GGTTA"],
+                         ["S", "ref_after_suffix_2", "AACCCGGGTTTAAAACCCCGGGGTTTT"]]
+        self.assertEqual(segments["ref_2"], true_segments)
+        self.assertEqual(segments["ref_1"][2], ["S", "repeat_1", "AA"])
+        self.assertEqual(links["ref_2"][2], ["L", "repeat_2", "+", "repeat_2", "+", "0M"])
+
+    def test_write_genome_str_graph(self):
+        out = io.StringIO()
+        write_genome_str_graph(iter_genome_str_graph(
+            "resources/config_db.tsv", "resources/ref.fa", "+", "+", "+", False, False, False), out)
+        segments, links = get_genome_str_graph(
+            "resources/config_db.tsv", "resources/ref.fa", "+", "+", "+", False, False, False)
+        true_lines = ["H\tVN:Z:a.0"] + ["\t".join(entry) for entry in segments["ref_1"] + links["ref_1"]]
+        self.assertEqual(out.getvalue().splitlines(), true_lines)
+
+
+class Test_parse_gaf(unittest.TestCase):
+    def test_parse_gaf(self):
+        with open("resources/alignment.gaf") as f:
+            alignments = parse_gaf(f, 0.5, 0.8, False, get_locus_names("resources/config_multi.tsv"))
+        out = io.StringIO()
+        write_alignments(alignments, out)
+        true_lines = ["read_name\tstrand\tspanned\tcount\talign_score\tidentity\tquery_aligned_fraction\tlocus",
+                      "read1\t+\t1\t2\t25.5\t0.970\t1.000\tAA_repeat",
+                      "read1\t-\t1\t1\t20.0\t0.900\t1.000\tCC_repeat",
+                      "read3\t+\t1\t3\t12.0\t0.950\t1.000\tAA_repeat"]
+        self.assertEqual(out.getvalue().splitlines(), true_lines)
+
+    def test_parse_gaf_non_spanned(self):
+        with open("resources/alignment.gaf") as f:
+            alignments = parse_gaf(f, 0.5, 0.0, True)
+        self.assertEqual(list(alignments), [("read1", "1"), ("read1", "2"), ("read2", "1"), ("read3", "1")])
+        self.assertEqual(alignments[("read2", "1")].spanned, False)
+
+    def test_parse_gaf_columnar(self):
+        for args in [(0.5, 0.8, False, get_locus_names("resources/config_multi.tsv")), (0.5, 0.0, True, None)]:
+            with open("resources/alignment.gaf") as f:
+                true_out = io.StringIO()
+                write_alignments(parse_gaf(f, *args), true_out)
+            with open("resources/alignment.gaf") as f:
+                out = io.StringIO()
+                write_alignments(parse_gaf_columnar(f, *args, chunk_size=2), out)
+            self.assertEqual(out.getvalue(), true_out.getvalue())
+
+    def test_read_graph_nodes(self):
+        graph_nodes = read_graph_nodes("resources/graph_multi.gfa")
+        self.assertEqual(graph_nodes.names[:5], ["ref_before_prefix_2", "ref_prefix_2", "repeat_2", "ref_suffix_2",
+                                                 "ref_after_suffix_2"])
+        self.assertEqual(graph_nodes.roles[:5], [FLANK, PREFIX, REPEAT, SUFFIX, FLANK])
+        self.assertEqual(graph_nodes.loci, ["2"] * 5 + ["1"] * 5)
+        self.assertEqual(count_repeats([(6, 1), (7, 3), (8, 1)], graph_nodes), {"1": 3})
+        path = ">ref_prefix_1>repeat_1>repeat_1>repeat_1>ref_suffix_1"
+        self.assertEqual(summarize_path(path, graph_nodes), (True, True, "1", 3))
+        self.assertEqual(summarize_path(">repeat_1>repeat_1>ref_suffix_1", graph_nodes), (False, True, "1", 2))
+        with self.assertRaises(ValueError):
+            summarize_path(">ref_prefix_1>repeat_9", graph_nodes)
+
+    def test_parse_gaf_graph_nodes(self):
+        graph_nodes = read_graph_nodes("resources/graph_multi.gfa")
+        locus_names = get_locus_names("resources/config_multi.tsv")
+        for args in [(0.5, 0.8, False, locus_names), (0.5, 0.0, True, None)]:
+            with open("resources/alignment.gaf") as f:
+                true_out = io.StringIO()
+                write_alignments(parse_gaf(f, *args), true_out)
+            with open("resources/alignment.gaf") as f:
+                out = io.StringIO()
+                write_alignments(parse_gaf(f, *args, graph_nodes=graph_nodes), out)
+            self.assertEqual(out.getvalue(), true_out.getvalue())
+            with open("resources/alignment.gaf") as f:
+                out = io.StringIO()
+                write_alignments(parse_gaf_columnar(f, *args, graph_nodes=graph_nodes), out)
+            self.assertEqual(out.getvalue(), true_out.getvalue())
+
+    def test_parse_gaf_graph_nodes_chromosome_name(self):
+        # "suffix" in the chromosome name must not make the alignment look like it spans the suffix
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gfa_file = os.path.join(tmp_dir, "graph.gfa")
+            with open("resources/graph_multi.gfa") as f, open(gfa_file, "w") as out:
+                out.write(f.read().replace("ref_", "chrsuffix_"))
+            graph_nodes = read_graph_nodes(gfa_file)
+        record = "read1\t20\t0\t20\t+\t>chrsuffix_prefix_1>repeat_1>repeat_1\t30\t0\t20\t18\t20\t60" \
+                 "\tAS:f:10\tid:f:0.9\n"
+        self.assertEqual(list(parse_gaf([record], 0.5, 0.0, False)), [("read1", "1")])
+        alignments = parse_gaf([record], 0.5, 0.0, True, graph_nodes=graph_nodes)
+        self.assertEqual(alignments[("read1", "1")].spanned, False)
+        self.assertEqual(alignments[("read1", "1")].count, 2)
+        self.assertEqual(parse_gaf([record], 0.5, 0.0, False, graph_nodes=graph_nodes), {})
+
+    def test_parse_gaf_graph_nodes_mixed_orientation(self):
+        # with --repeat_orientation - the repeat node is visited in the other direction than the flanks
+        graph_nodes = read_graph_nodes("resources/graph_multi.gfa")
+        path = ">ref_prefix_1<repeat_1<repeat_1>ref_suffix_1"
+        self.assertEqual(split_path(path), ["ref_prefix_1", "repeat_1", "repeat_1", "ref_suffix_1"])
+        self.assertEqual(summarize_path(path, graph_nodes), (True, True, "1", 2))
+        record = f"read1\t20\t0\t20\t+\t{path}\t30\t0\t20\t18\t20\t60\tAS:f:10\tid:f:0.9\n"
+        alignments = parse_gaf([record], 0.5, 0.0, False, graph_nodes=graph_nodes)
+        self.assertEqual(alignments[("read1", "1")].spanned, True)
+        self.assertEqual(alignments[("read1", "1")].count, 2)
+
+    def test_parse_gaf_columnar_graph_nodes(self):
+        graph_nodes = read_graph_nodes("resources/graph_multi.gfa")
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        # the same paths in several chunks and a path with nodes visited in both directions
+        records += [record.replace("read", "other") for record in records]
+        records.append(records[0].replace("read1 meta", "read7").replace(">repeat_1>repeat_1", "<repeat_1<repeat_1"))
+        for args in [(0.5, 0.8, False, get_locus_names("resources/config_multi.tsv")), (0.5, 0.0, True, None)]:
+            true_out = io_write(lambda out: write_alignments(parse_gaf(records, *args, graph_nodes=graph_nodes), out))
+            for chunk_size, chunk_bytes in [(100, 10 ** 6), (100, 200), (3, 10 ** 6)]:
+                self.assertEqual(io_write(lambda out: write_alignments(parse_gaf_columnar(
+                    records, *args, chunk_size=chunk_size, graph_nodes=graph_nodes, chunk_bytes=chunk_bytes), out)),
+                    true_out)
+        with self.assertRaises(ValueError):
+            parse_gaf_columnar([records[0].replace(">ref_suffix_1", ">ref_suffix_9")], graph_nodes=graph_nodes)
+
+    def test_split_gaf_file(self):
+        with open("resources/alignment.gaf", "rb") as f:
+            data = f.read()
+        line_starts = {0} | {i + 1 for i, c in enumerate(data) if c == ord("\n")}
+        for n_ranges in range(1, 10):
+            ranges = split_gaf_file("resources/alignment.gaf", n_ranges)
+            self.assertLessEqual(len(ranges), n_ranges)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], len(data))
+            for (_, end), (begin, _) in zip(ranges[:-1], ranges[1:]):
+                self.assertEqual(end, begin)
+                self.assertIn(begin, line_starts)
+
+    def test_parse_gaf_parallel(self):
+        locus_names = get_locus_names("resources/config_multi.tsv")
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        # the same score as the alignment of read3 with 3 repeats, the earlier alignment has to be kept
+        records.append(records[4].replace(">repeat_1>ref_suffix_1", ">repeat_1>repeat_1>ref_suffix_1"))
+        true_out = io.StringIO()
+        write_alignments(parse_gaf(records, 0.5, 0.0, True, locus_names), true_out)
+        self.assertIn("read3\t+\t1\t3\t12.0", true_out.getvalue())
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gaf_file = os.path.join(tmp_dir, "alignment.gaf")
+            with open(gaf_file, "w") as f:
+                f.writelines(records)
+            for workers in (2, 3):
+                for columnar in (False, True):
+                    out = io.StringIO()
+                    write_alignments(parse_gaf_parallel(gaf_file, workers, 0.5, 0.0, True, locus_names, columnar), out)
+                    self.assertEqual(out.getvalue(), true_out.getvalue())
+
+    def test_parse_gaf_mmap(self):
+        graph_nodes = read_graph_nodes("resources/graph_multi.gfa")
+        locus_names = get_locus_names("resources/config_multi.tsv")
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        records.append(records[4].replace(">repeat_1>ref_suffix_1", ">repeat_1>repeat_1>ref_suffix_1"))
+        # records that are parsed by parse_gaf_record(): trailing whitespace and a last line without a newline
+        records.append(records[1].replace("read1", "read4").replace("\n", "\r\n"))
+        last_record = records[2].replace("read2", "read5").rstrip("\n")
+        # a segment with "repeat" twice, its nodes are not in the graph, and nodes visited in both directions
+        mixed_record = records[0].replace("read1 meta", "read7").replace(">repeat_1>repeat_1", "<repeat_1<repeat_1")
+        name_records = records + [records[0].replace("read1 meta", "read6").replace(">ref_suffix", ">repeatrepeat"),
+                                  mixed_record, last_record]
+        records.append(last_record)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            gaf_file = os.path.join(tmp_dir, "alignment.gaf")
+            with open(gaf_file, "w") as f:
+                f.writelines(name_records)
+            for args in [(0.5, 0.8, False, locus_names), (0.5, 0.0, True, None), (0.95, 0.0, True, None)]:
+                true_out = io_write(lambda out: write_alignments(parse_gaf(name_records, *args), out))
+                self.assertEqual(io_write(lambda out: write_alignments(parse_gaf_mmap(gaf_file, *args), out)),
+                                 true_out)
+
+            with open(gaf_file, "w") as f:
+                f.writelines(records)
+            for args in [(0.5, 0.8, False, locus_names), (0.5, 0.0, True, None)]:
+                true_out = io_write(lambda out: write_alignments(parse_gaf(records, *args), out))
+                counts = collections.Counter()
+                self.assertEqual(io_write(lambda out: write_alignments(
+                    parse_gaf_mmap(gaf_file, *args, graph_nodes=graph_nodes, counts=counts), out)), true_out)
+                true_counts = collections.Counter()
+                collections.deque(count_records(records, true_counts), 0)
+                self.assertEqual(counts, true_counts)
+                # the lines that start in a byte range
+                ranges = split_gaf_file(gaf_file, 3)
+                self.assertGreater(len(ranges), 1)
+                alignments = dict()
+                for begin, end in ranges:
+                    for ga in parse_gaf_mmap(gaf_file, *args, graph_nodes=graph_nodes, begin=begin, end=end).values():
+                        add_alignment(alignments, ga)
+                self.assertEqual(io_write(lambda out: write_alignments(alignments, out)), true_out)
+
+            with open(gaf_file, "w") as f:
+                f.write(mixed_record)
+            self.assertEqual(parse_gaf_mmap(gaf_file, graph_nodes=graph_nodes)[("read7", "1")].count, 2)
+
+            with open(gaf_file, "w") as f:
+                f.write(records[1].replace("\tid:f:0.9", ""))
+            with self.assertRaises(KeyError):
+                parse_gaf_mmap(gaf_file)
+            with open(gaf_file, "w"):
+                pass
+            self.assertEqual(parse_gaf_mmap(gaf_file), {})
+
+    def test_parse_gaf_external(self):
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        records.append(records[4].replace(">repeat_1>ref_suffix_1", ">repeat_1>repeat_1>ref_suffix_1"))
+        records.append(records[0].replace("AS:f:25.5", "AS:f:30"))
+        true_alignments = parse_gaf(records, 0.5, 0.0, True)
+        true_out = io.StringIO()
+        write_alignments(true_alignments, true_out)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for max_in_memory in (1, 2, 3, 100):
+                with parse_gaf_external(records, 0.5, 0.0, True, None, max_in_memory, tmp_dir) as alignments:
+                    out = io.StringIO()
+                    write_alignments(alignments, out)
+                    self.assertEqual(len(alignments), len(true_alignments))
+                self.assertEqual(out.getvalue(), true_out.getvalue())
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+
+@unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow is not installed")
+class Test_columnar_output(unittest.TestCase):
+    def test_write_alignments_columnar(self):
+        with open("resources/alignment.gaf") as f:
+            alignments = parse_gaf(f, 0.5, 0.0, True, get_locus_names("resources/config_multi.tsv"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for output_format, compression in [("parquet", "zstd"), ("parquet", "none"), ("arrow", "lz4")]:
+                output = os.path.join(tmp_dir, "out." + output_format)
+                write_alignments_columnar(alignments, output, output_format, compression, batch_size=3)
+                table = read_output(output, output_format)
+                self.assertEqual(table.column_names, ["read_name", "strand", "spanned", "count", "align_score",
+                                                      "identity", "query_aligned_fraction", "locus"])
+                self.assertEqual(table.to_pylist(), [
+                    {"read_name": ga.read_name, "strand": ga.strand, "spanned": ga.spanned, "count": ga.count,
+                     "align_score": ga.alignment_score, "identity": ga.identity,
+                     "query_aligned_fraction": ga.aligned_fraction, "locus": ga.locus}
+                    for ga in alignments.values()])
+
+    def test_write_counts_spilled(self):
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "out.parquet")
+            write_counts(parse_gaf_external(records, 0.5, 0.0, True, None, 1, tmp_dir), output,
+                         output_format="parquet")
+            self.assertEqual(read_output(output, "parquet").column("read_name").to_pylist(),
+                             [ga.read_name for ga in parse_gaf(records, 0.5, 0.0, True).values()])
+            self.assertEqual(os.listdir(tmp_dir), ["out.parquet"])
+
+
+class Test_genotype(unittest.TestCase):
+    def test_call_alleles(self):
+        counts = np.array([10, 10, 11, 10, 9, 30, 31, 30, 29, 30, 5, 5, 5, 6, 5, 5, 4, 7, 50])
+        groups = np.array([0] * 10 + [2] * 7 + [3] * 2)
+        genotypes = call_alleles(groups, counts, 4)
+        self.assertEqual(genotypes["depth"].tolist(), [10, 0, 7, 2])
+        self.assertEqual(genotypes["allele1"].tolist()[0], 10)
+        self.assertEqual(genotypes["allele2"].tolist()[0], 30)
+        self.assertEqual(genotypes["allele1_depth"].tolist(), [5, 0, 7, 2])
+        self.assertEqual(genotypes["allele2_depth"].tolist(), [5, 0, 0, 0])
+        self.assertEqual(genotypes["allele1_ci_low"][0], 9)
+        self.assertEqual(genotypes["allele1_ci_high"][0], 11)
+        # one allele, a single read of another count is not a second allele
+        self.assertEqual(genotypes["allele1"][2], 5)
+        self.assertTrue(np.isnan(genotypes["allele2"][2]))
+        # two reads are not enough for two alleles of min_allele_reads 2 each
+        self.assertEqual(genotypes["allele1"][3], 28.5)
+        self.assertTrue(np.isnan(genotypes["allele1"][1]))
+
+    def test_genotype_counts_filters(self):
+        columns = {"locus": np.array(["a", "a", "a", "b"]), "count": np.array([3, 3, 8, 4]),
+                   "spanned": np.array([True, True, False, True]), "identity": np.array([0.9, 0.9, 0.9, 0.4])}
+        genotypes = genotype_counts(columns, 0.5)
+        self.assertEqual(genotypes["locus"], ["a", "b"])
+        self.assertEqual(genotypes["depth"].tolist(), [2, 0])
+        self.assertEqual(genotypes["histogram"], ["3:2", ""])
+
+    def test_write_counts_genotype(self):
+        with open("resources/alignment.gaf") as f:
+            alignments = parse_gaf(f, 0.5, 0.0, True, get_locus_names("resources/config_multi.tsv"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            output = os.path.join(tmp_dir, "s1.tsv")
+            write_counts(alignments, output, genotype=True)
+            with open(os.path.join(tmp_dir, "s1.genotypes.tsv")) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines, [
+                "sample\tlocus\tdepth\tallele1\tallele1_ci_low\tallele1_ci_high\tallele1_depth\tallele2\t"
+                "allele2_ci_low\tallele2_ci_high\tallele2_depth\thistogram",
+                "s1\tAA_repeat\t2\t2.5\t2\t3\t2\tNA\tNA\tNA\t0\t2:1,3:1",
+                "s1\tCC_repeat\t1\t1\t1\t1\t1\tNA\tNA\tNA\t0\t1:1"])
+            if importlib.util.find_spec("pyarrow"):
+                write_alignments_columnar(alignments, os.path.join(tmp_dir, "s1.parquet"))
+                out = io.StringIO()
+                genotype_files([os.path.join(tmp_dir, "s1.parquet")], out)
+                self.assertEqual(out.getvalue().splitlines(), lines)
+
+
+class Test_graph_cache(unittest.TestCase):
+    def test_graph_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = GraphCache(cache_dir)
+            graph_file = cache.get_graph("resources/config_multi.tsv", "resources/ref.fa")
+            with open(graph_file) as f, open("resources/graph_multi.gfa") as true_f:
+                self.assertEqual(f.read(), true_f.read())
+            self.assertEqual(cache.get_graph("resources/config_multi.tsv", "resources/ref.fa"), graph_file)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            other_graph_file = cache.get_graph("resources/config_multi.tsv", "resources/ref.fa", "-")
+            self.assertNotEqual(other_graph_file, graph_file)
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+    def test_graph_cache_key(self):
+        key = graph_cache_key("resources/config_multi.tsv", "resources/ref.fa")
+        self.assertEqual(graph_cache_key("resources/config_multi.tsv", "resources/ref.fa"), key)
+        self.assertNotEqual(graph_cache_key("resources/config_multi.tsv", "resources/ref.fa",
+                                            use_fixed_len_before_and_after_fixes=True), key)
+        self.assertNotEqual(graph_cache_key("resources/config_db.tsv", "resources/ref.fa"), key)
+
+    def test_graph_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = GraphCache(cache_dir, max_bytes=1)
+            graph_file = cache.get_graph("resources/config_multi.tsv", "resources/ref.fa")
+            self.assertTrue(os.path.exists(graph_file))
+            other_graph_file = cache.get_graph("resources/config_db.tsv", "resources/ref.fa")
+            self.assertFalse(os.path.exists(graph_file))
+            self.assertTrue(os.path.exists(other_graph_file))
+
+
+class Test_read_prefilter(unittest.TestCase):
+    def test_build_kmer_index(self):
+        index = build_kmer_index(load_config("resources/config_multi.tsv"), 5)
+        # the 9 k-mers of the prefix of AA_repeat and of its reverse complement
+        self.assertEqual(index.count_hits("TAAACCCGGGTTT"), 9)
+        self.assertEqual(index.count_hits("AAACCCGGGTTTA"), 9)
+        self.assertEqual(index.count_hits("ATATATATATATATAT"), 0)
+        self.assertEqual(index.count_hits("ATATNAAAAATAT"), 1)
+
+    def test_prefilter_reads(self):
+        loci = load_config("resources/config_multi.tsv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fastq")
+            with open(reads, "w") as f:
+                f.write("@r1 runid=1\nATATATAAACCCGGGTTTATAT\n+\n" + "I" * 22 + "\n")
+                f.write("@r2\nATATATATATATATAT\n+\n" + "I" * 16 + "\n")
+                f.write("@r3\nATATTTTTTTATAT\n+\n" + "I" * 14 + "\n")
+            for processes in (1, 2):
+                out_file = os.path.join(tmp_dir, "filtered.fastq")
+                self.assertEqual(prefilter_reads(reads, out_file, loci, 5, processes=processes), (3, 2))
+                with open(out_file) as f:
+                    self.assertEqual(f.read(), "@r1 runid=1\nATATATAAACCCGGGTTTATAT\n+\n" + "I" * 22 + "\n"
+                                               "@r3\nATATTTTTTTATAT\n+\n" + "I" * 14 + "\n")
+
+
+class Test_fast_count(unittest.TestCase):
+    def test_count_units(self):
+        self.assertEqual(count_units("GGCCCC" * 10, "GGCCCC"), (10, 0))
+        # a deleted C and an inserted A
+        self.assertEqual(count_units("GGCCCCGGCCCGGCCCCAGGCCCC", "GGCCCC"), (4, 2))
+        self.assertEqual(count_units("", "CAG"), (0, 0))
+        # two copies with two substitutions or three with two deletions, deletions are more common
+        self.assertEqual(count_units("AATT", "AT"), (3, 2))
+
+    def write_reads(self, reads):
+        read = "GATTACAGATTACA" + "TAAACCCGGGTTT" + "AA" * 7 + "CCCCGGGGT" + "GATTACAGATTACA"
+        with open(reads, "w") as f:
+            f.write(f">r1\n{read}\n>r2\n{reverse_complement(read)}\n>r3\nGATTACAGATTACAGATTACA\n")
+
+    def test_fast_count(self):
+        loci = load_config("resources/config_multi.tsv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fa")
+            self.write_reads(reads)
+            for processes in (1, 2):
+                alignments = fast_count(reads, loci, k=5, processes=processes)
+                self.assertEqual(list(alignments), [("r1", "AA_repeat"), ("r2", "AA_repeat")])
+                self.assertEqual([(ga.strand, ga.count, ga.identity) for ga in alignments.values()],
+                                 [("+", 7, 1.0), ("-", 7, 1.0)])
+                self.assertAlmostEqual(alignments[("r1", "AA_repeat")].aligned_fraction, 36 / 64)
+
+    def test_compare_counts(self):
+        loci = load_config("resources/config_multi.tsv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fa")
+            self.write_reads(reads)
+            alignments = fast_count(reads, loci, k=5)
+            other = {key: ga for key, ga in alignments.items() if key[0] == "r1"}
+            out = io.StringIO()
+            self.assertEqual(compare_counts(other, alignments, out), (1, 1, 0, 1))
+            self.assertEqual(out.getvalue(), "read_name\tlocus\tcount\tfast_count\n"
+                                             "r1\tAA_repeat\t7\t7\nr2\tAA_repeat\tNA\t7\n")
+
+    def test_run_pipeline_fast_count(self):
+        # neither the graph nor GraphAligner are needed
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fa")
+            self.write_reads(reads)
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir}):
+                alignments = run_pipeline("resources/config_multi.tsv", "resources/missing.fa", reads, tmp_dir,
+                                          count_engine="fast", fast_count_k=5)
+            self.assertEqual([ga.count for ga in alignments.values()], [7, 7])
+
+    def test_validate_fast_count(self):
+        loci = load_config("resources/config_multi.tsv")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fa")
+            self.write_reads(reads)
+            graphaligner_alignments = fast_count(reads, loci, k=5)
+            del graphaligner_alignments[("r2", "AA_repeat")]
+            validation_file = os.path.join(tmp_dir, "validation.tsv")
+            for engine, n_reads in (("graphaligner", 1), ("fast", 2)):
+                alignments = count_with_engine(lambda: graphaligner_alignments, reads, loci, engine, True,
+                                               validation_file, fast_count_k=5)
+                self.assertEqual(len(alignments), n_reads)
+                with open(validation_file) as f:
+                    self.assertEqual(f.read().splitlines()[1:], ["r1\tAA_repeat\t7\t7", "r2\tAA_repeat\tNA\t7"])
+
+
+class Test_stream_graphaligner(unittest.TestCase):
+    def test_stream_graphaligner(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fifo = os.path.join(tmp_dir, "alignment.gaf")
+            records = list(stream_graphaligner(["sh", "-c", "cat resources/alignment.gaf > $0", fifo], fifo))
+            self.assertFalse(os.path.exists(fifo))
+        with open("resources/alignment.gaf") as f:
+            self.assertEqual(records, f.readlines())
+
+    def test_stream_graphaligner_failure(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fifo = os.path.join(tmp_dir, "alignment.gaf")
+            with self.assertRaises(subprocess.CalledProcessError):
+                list(stream_graphaligner(["sh", "-c", "exit 3"], fifo))
+
+
+def write_fake_graphaligner(tmp_dir):
+    """Write a GraphAligner to tmp_dir that writes the alignments of resources/alignment.gaf of the reads it is given
+    in FASTA format, logs the reads files it is run with to $ALIGNER_LOG and fails for the read named $FAIL_READ.
+    Returns the path of a FASTA file of the reads read1, read2 and read3."""
+    with open(os.path.join(tmp_dir, "GraphAligner"), "w") as f:
+        f.write('#!/bin/sh\nwhile [ $# -gt 0 ]; do case "$1" in -f) reads="$2"; shift;; -a) out="$2"; shift;; '
+                'esac; shift; done\necho "$reads" >> "$ALIGNER_LOG"\n'
+                'grep "^>" "$reads" > "$out.names"\n'
+                'grep -q "^>$FAIL_READ$" "$out.names" && exit 1\n'
+                'cut -c2- "$out.names" | while read name; do '
+                'grep "^$name\t" resources/alignment.gaf; done > "$out"\nrm "$out.names"\n')
+    os.chmod(os.path.join(tmp_dir, "GraphAligner"), 0o755)
+    reads = os.path.join(tmp_dir, "reads.fa")
+    with open(reads, "w") as f:
+        for name in ["read1", "read2", "read3"]:
+            f.write(f">{name}\nACGT\n")
+    return reads
+
+
+def parse_gaf_of_reads(reads):
+    with open("resources/alignment.gaf") as f:
+        return parse_gaf([line for line in f if line.split("\t")[0] in reads],
+                         locus_names=get_locus_names("resources/config_multi.tsv"))
+
+
+class Test_resume(unittest.TestCase):
+    def test_resume(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            log = os.path.join(tmp_dir, "aligner.log")
+            out_dir = os.path.join(tmp_dir, "out")
+
+            def run(fail_read):
+                with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                                  "ALIGNER_LOG": log, "FAIL_READ": fail_read}):
+                    return run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads, out_dir,
+                                        resume=True, chunk_reads=1)
+
+            with self.assertRaises(subprocess.CalledProcessError):
+                run("read3")
+            alignments = run("none")
+            with open(log) as f:
+                # the chunks of read1 and read2 are not aligned again
+                self.assertEqual([os.path.basename(line.strip()) for line in f],
+                                 ["chunk_0.fasta", "chunk_1.fasta", "chunk_2.fasta", "chunk_2.fasta"])
+            self.assertEqual(list(alignments), list(parse_gaf_of_reads(["read1", "read2", "read3"])))
+            # nothing is aligned again
+            run("none")
+            with open(log) as f:
+                self.assertEqual(len(f.readlines()), 4)
+
+    def test_mmap_parser(self):
+        true_out = io_write(lambda out: write_alignments(parse_gaf_of_reads(["read1", "read2", "read3"]), out))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": os.path.join(tmp_dir, "aligner.log")}):
+                for resume in (False, True):
+                    metrics = StageMetrics()
+                    alignments = run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads,
+                                              os.path.join(tmp_dir, f"out_{resume}"), resume=resume, chunk_reads=1,
+                                              mmap_parser=True, metrics=metrics)
+                    self.assertEqual(io_write(lambda out: write_alignments(alignments, out)), true_out)
+                    parse_stage = [stage for stage in metrics.stages if stage["stage"] == "parse"][0]
+                    self.assertEqual(parse_stage["counts"]["reads"], 3)
+        with self.assertRaises(ValueError):
+            run_pipeline("resources/config_multi.tsv", "resources/ref.fa", "reads.fa", mmap_parser=True,
+                         stream_alignments=True)
+
+
+class Test_compressed_io(unittest.TestCase):
+    def test_write_gaf(self):
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for compression in GAF_COMPRESSIONS:
+                gaf_file = os.path.join(tmp_dir, "alignment.gaf" + EXTENSIONS[compression])
+                try:
+                    write_gaf(records, gaf_file, compression, index=compression != "zstd")
+                except ValueError:
+                    # neither zstd nor zstandard are installed
+                    continue
+                for threads in (1, 2):
+                    with open_text(gaf_file, threads) as f:
+                        self.assertEqual(list(f), records)
+                if compression != "zstd":
+                    read_index = load_read_index(gaf_file)
+                    # read1 is also named with the FASTQ comment "read1 meta", like parse_gaf the index leaves it out
+                    self.assertEqual(list(read_index), ["read1", "read2", "read3"])
+                    self.assertEqual(fetch_read(gaf_file, "read1"), records[:2])
+                    self.assertEqual(fetch_read(gaf_file, "read3"), records[-3:])
+                    self.assertEqual(fetch_read(gaf_file, "read4"), [])
+                    index_gaf(gaf_file)
+                    self.assertEqual(load_read_index(gaf_file), read_index)
+            with self.assertRaises(ValueError):
+                parse_gaf_parallel(os.path.join(tmp_dir, "alignment.gaf.gz"), 2)
+
+    def test_run_pipeline_compressed_gaf(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            out_dir = os.path.join(tmp_dir, "out")
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": os.path.join(tmp_dir, "aligner.log")}):
+                alignments = run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads, out_dir,
+                                          gaf_compression="gzip", gaf_index=True)
+            self.assertEqual(io_write(lambda out: write_alignments(alignments, out)),
+                             io_write(lambda out: write_alignments(parse_gaf_of_reads(["read1", "read2", "read3"]),
+                                                                   out)))
+            gaf_file = os.path.join(out_dir, "tmp", "alignment.gaf.gz")
+            self.assertFalse(os.path.exists(os.path.join(out_dir, "tmp", "alignment.gaf")))
+            self.assertEqual(fetch_read(gaf_file, "read2"),
+                             [line for line in open("resources/alignment.gaf") if line.startswith("read2\t")])
+
+
+class Test_alignment_store(unittest.TestCase):
+    def test_merge(self):
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        # a better alignment of read1 at locus 1 in a later batch
+        records.append(records[0].replace("AS:f:25.5", "AS:f:30"))
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with AlignmentStore(os.path.join(tmp_dir, "store.sqlite")) as store:
+                self.assertEqual(store.merge(parse_gaf(records[:3]), "batch1"), (2, 0))
+                self.assertEqual(store.merge(parse_gaf(records[3:]), "batch2"), (1, 1))
+                self.assertTrue(store.has_batch("batch1"))
+                self.assertFalse(store.has_batch("batch3"))
+                self.assertEqual(io_write(lambda out: write_alignments(store, out)),
+                                 io_write(lambda out: write_alignments(parse_gaf(records), out)))
+            # the alignments are kept when the store is opened again
+            with AlignmentStore(os.path.join(tmp_dir, "store.sqlite")) as store:
+                self.assertEqual(len(store), 3)
+                store.check_inputs("key")
+                store.check_inputs("key")
+                with self.assertRaises(ValueError):
+                    store.check_inputs("other key")
+
+    def test_count_batch(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            with open(reads) as f:
+                lines = f.readlines()
+            batches = [os.path.join(tmp_dir, "batch1.fa"), os.path.join(tmp_dir, "batch2.fa")]
+            with open(batches[0], "w") as f:
+                f.writelines(lines[:4])
+            with open(batches[1], "w") as f:
+                f.writelines(lines[4:])
+            log = os.path.join(tmp_dir, "aligner.log")
+            out_dir = os.path.join(tmp_dir, "out")
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": log}):
+                with AlignmentStore(os.path.join(tmp_dir, "store.sqlite")) as store:
+                    for batch in batches:
+                        self.assertIsNotNone(count_batch(store, "resources/config_multi.tsv", "resources/ref.fa",
+                                                         batch, out_dir))
+                    # a batch is not aligned again
+                    self.assertIsNone(count_batch(store, "resources/config_multi.tsv", "resources/ref.fa",
+                                                  batches[0], out_dir))
+                    self.assertEqual(io_write(lambda out: write_alignments(store, out)),
+                                     io_write(lambda out: write_alignments(
+                                         parse_gaf_of_reads(["read1", "read2", "read3"]), out)))
+            with open(log) as f:
+                self.assertEqual(len(f.readlines()), 2)
+        # the options that only change the speed of the count do not change the key
+        self.assertEqual(store_key("resources/config_multi.tsv", "resources/ref.fa", {"threads": 1}),
+                         store_key("resources/config_multi.tsv", "resources/ref.fa", {"threads": 8}))
+        self.assertNotEqual(store_key("resources/config_multi.tsv", "resources/ref.fa", {"min_identity": 0.5}),
+                            store_key("resources/config_multi.tsv", "resources/ref.fa", {"min_identity": 0.9}))
+
+
+class Test_shard_alignment(unittest.TestCase):
+    def test_plan_shards(self):
+        self.assertEqual(plan_shards(4, 16, 8), 2)
+        self.assertEqual(plan_shards(4, 2, 8), 1)
+        self.assertEqual(plan_shards(2, None, 8), 4)
+        self.assertEqual(plan_shards(3, 1, 1), 1)
+
+    def test_sharded_alignment(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            out_dir = os.path.join(tmp_dir, "out")
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": os.path.join(tmp_dir, "aligner.log"),
+                                              "FAIL_READ": "none"}):
+                alignments = run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads, out_dir,
+                                          threads=2, shards=2)
+                # the shards are read1, read3 and read2
+                self.assertEqual(list(alignments), list(parse_gaf_of_reads(["read1", "read3"])) +
+                                 list(parse_gaf_of_reads(["read2"])))
+                os.environ["FAIL_READ"] = "read2"
+                with self.assertRaises(subprocess.CalledProcessError):
+                    run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads, out_dir, threads=2,
+                                 shards=2)
+            # the named pipes are removed
+            self.assertFalse([name for name in os.listdir(os.path.join(out_dir, "tmp", "shards"))
+                              if name.endswith(".fasta")])
+
+    def test_sharded_alignment_exits_early(self):
+        # a GraphAligner that never opens the reads does not block the shard
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            with self.assertRaises(subprocess.CalledProcessError):
+                list(align_in_shards(lambda reads, alignment_file, threads: ["sh", "-c", "exit 2"],
+                                     "resources/ref.fa", tmp_dir, 2))
+
+    def test_sharded_alignment_reads_parsed_once(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fq")
+            with open(reads, "w") as f:
+                f.writelines(f"@read{i}\nACGT\n+\nIIII\n" for i in range(5))
+            with mock.patch("shard_alignment.pysam.FastxFile", wraps=pysam.FastxFile) as fastx:
+                lines = list(align_in_shards(lambda reads, alignment_file, threads: ["cp", reads, alignment_file],
+                                             reads, tmp_dir, 3))
+            # once for the format and once by the feeder of all shards
+            self.assertEqual(fastx.call_count, 2)
+            self.assertEqual([line for line in lines if line.startswith("@")],
+                             [f"@read{i}\n" for i in (0, 3, 1, 4, 2)])
+
+    def test_sharded_alignment_truncated_reads(self):
+        # the shards of a truncated reads file fail instead of returning the alignments of the reads before the end
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = os.path.join(tmp_dir, "reads.fq")
+            with open(reads, "w") as f:
+                f.write("@read1\nACGT\n+\nIIII\n@read2\nACGT\n+\nII\n")
+            with self.assertRaises(ValueError):
+                list(align_in_shards(lambda reads, alignment_file, threads: ["cp", reads, alignment_file],
+                                     reads, tmp_dir, 2))
+
+
+class Test_stage_metrics(unittest.TestCase):
+    def test_stage_metrics(self):
+        metrics = StageMetrics()
+        with metrics.stage("sleep") as counts:
+            subprocess.run(["sleep", "0.05"], check=True)
+            counts["reads"] += 10
+        stage = metrics.stages[0]
+        self.assertEqual(stage["stage"], "sleep")
+        self.assertGreaterEqual(stage["wall_time_s"], 0.05)
+        self.assertGreater(stage["children_peak_rss_bytes"], 0)
+        self.assertEqual(stage["counts"], {"reads": 10})
+        self.assertAlmostEqual(stage["per_second"]["reads"], 10 / stage["wall_time_s"])
+        self.assertEqual(json.loads(io_write(metrics.write))["stages"][0]["stage"], "sleep")
+
+    def test_count_records(self):
+        counts = collections.Counter()
+        with open("resources/alignment.gaf") as f:
+            records = f.readlines()
+        self.assertEqual(list(count_records(records, counts)), records)
+        self.assertEqual(counts, {"alignments": 6, "reads": 4})
+
+    def test_run_pipeline_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            metrics = StageMetrics()
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": os.path.join(tmp_dir, "aligner.log"),
+                                              "FAIL_READ": "none"}):
+                alignments = run_pipeline("resources/config_multi.tsv", "resources/ref.fa", reads, tmp_dir,
+                                          metrics=metrics)
+            output = os.path.join(tmp_dir, "out.tsv")
+            write_counts(alignments, output, metrics=metrics)
+            with open(os.path.join(tmp_dir, "out.metrics.json")) as f:
+                stages = json.load(f)["stages"]
+            self.assertEqual([stage["stage"] for stage in stages], ["graph", "alignment", "parse", "write"])
+            self.assertEqual(stages[2]["counts"], {"alignments": 5, "reads": 3, "kept_alignments": 2})
+
+    def test_parse_gaf_metrics(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics_file = os.path.join(tmp_dir, "metrics.json")
+            for options in ([], ["--columnar"], ["--mmap"], ["--max-alignments-in-memory", "1"]):
+                subprocess.run([sys.executable, "../parse_gaf.py", "--input", "resources/alignment.gaf",
+                                "--metrics", metrics_file] + options, check=True, stdout=subprocess.DEVNULL)
+                with open(metrics_file) as f:
+                    stages = json.load(f)["stages"]
+                self.assertEqual([stage["stage"] for stage in stages], ["parse", "write"])
+                self.assertEqual(stages[0]["counts"], {"alignments": 6, "reads": 4, "kept_alignments": 3})
+                self.assertIn("alignments", stages[0]["per_second"])
+
+
+class Test_run_samples(unittest.TestCase):
+    def test_run_samples(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # a GraphAligner that takes the alignments from the file given as reads
+            with open(os.path.join(tmp_dir, "GraphAligner"), "w") as f:
+                f.write('#!/bin/sh\nwhile [ $# -gt 0 ]; do case "$1" in -f) reads="$2"; shift;; -a) out="$2"; shift;; '
+                        'esac; shift; done\ncat "$reads" > "$out"\n')
+            os.chmod(os.path.join(tmp_dir, "GraphAligner"), 0o755)
+            sample_sheet = os.path.join(tmp_dir, "samples.tsv")
+            with open(sample_sheet, "w") as f:
+                f.write("sample\tfastq\n")
+                f.write("s1\tresources/alignment.gaf\n")
+                f.write("s2\tresources/missing.gaf\n")
+                f.write("s3\tresources/alignment.gaf\n")
+            samples = load_sample_sheet(sample_sheet)
+            self.assertEqual([sample for sample, _ in samples], ["s1", "s2", "s3"])
+
+            out_dir = os.path.join(tmp_dir, "out")
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"]}):
+                outputs = run_samples("resources/config_multi.tsv", "resources/ref.fa", samples, out_dir, jobs=2)
+            self.assertEqual(outputs, {"s1": os.path.join(out_dir, "s1.tsv"), "s3": os.path.join(out_dir, "s3.tsv")})
+            with open("resources/alignment.gaf") as f:
+                true_out = io.StringIO()
+                write_alignments(parse_gaf(f, locus_names=get_locus_names("resources/config_multi.tsv")), true_out)
+            for output in outputs.values():
+                with open(output) as f:
+                    self.assertEqual(f.read(), true_out.getvalue())
+
+
+async def http_request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    data = json.dumps(body).encode() if body is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(data)}\r\n\r\n".encode()
+                 + data)
+    response = await reader.read()
+    writer.close()
+    head, _, response_body = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), response_body
+
+
+class Test_job_server(unittest.TestCase):
+    def test_job_server(self):
+        true_out = io_write(lambda out: write_alignments(parse_gaf_of_reads(["read1", "read2", "read3"]), out))
+
+        async def run(tmp_dir, reads):
+            job_server = JobServer(os.path.join(tmp_dir, "out"), workers=2, max_queued_jobs=4)
+            server = await start_server(job_server, port=0)
+            port = server.sockets[0].getsockname()[1]
+            job = {"config": "resources/config_multi.tsv", "reference": "resources/ref.fa", "fastq": reads}
+            job_ids = list()
+            for _ in range(3):
+                status, body = await http_request(port, "POST", "/jobs", job)
+                self.assertEqual(status, 202)
+                job_ids.append(json.loads(body)["id"])
+            status, _ = await http_request(port, "POST", "/jobs", dict(job, fastq="missing.fa"))
+            self.assertEqual(status, 400)
+            while True:
+                status, body = await http_request(port, "GET", "/jobs")
+                if all(job["status"] in ("done", "failed") for job in json.loads(body)):
+                    break
+                await asyncio.sleep(0.05)
+            for job_id in job_ids:
+                status, body = await http_request(port, "GET", f"/jobs/{job_id}")
+                self.assertEqual(json.loads(body)["status"], "done")
+                status, body = await http_request(port, "GET", f"/jobs/{job_id}/result")
+                self.assertEqual(status, 200)
+                self.assertEqual(body.decode(), true_out)
+            status, body = await http_request(port, "GET", "/status")
+            self.assertEqual(json.loads(body)["warm_graphs"], 1)
+            self.assertEqual((await http_request(port, "GET", "/jobs/unknown"))[0], 404)
+            server.close()
+            await server.wait_closed()
+            await job_server.stop()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            reads = write_fake_graphaligner(tmp_dir)
+            with mock.patch.dict(os.environ, {"PATH": tmp_dir + os.pathsep + os.environ["PATH"],
+                                              "ALIGNER_LOG": os.path.join(tmp_dir, "aligner.log")}), \
+                    mock.patch("job_server.generate_graph", wraps=generate_graph) as generate:
+                asyncio.run(run(tmp_dir, reads))
+            # the graph is generated once for all jobs
+            self.assertEqual(generate.call_count, 1)
+            with open(os.path.join(tmp_dir, "aligner.log")) as f:
+                self.assertEqual(len(f.readlines()), 3)
+            self.assertEqual(os.listdir(os.path.join(tmp_dir, "out", "tmp")), [])
+
+    def test_queue_full(self):
+        async def run():
+            job_server = JobServer(tmp_dir, max_queued_jobs=1)
+            # without the workers the jobs stay queued
+            job_server.queue = asyncio.Queue(1)
+            job_server.submit("resources/config_multi.tsv", "resources/ref.fa", "resources/ref.fa")
+            with self.assertRaises(asyncio.QueueFull):
+                job_server.submit("resources/config_multi.tsv", "resources/ref.fa", "resources/ref.fa")
+            status, headers, _ = await job_server.route("POST", "/jobs", json.dumps(
+                {"config": "resources/config_multi.tsv", "reference": "resources/ref.fa",
+                 "fastq": "resources/ref.fa"}).encode())
+            self.assertEqual(status, 503)
+            self.assertIn("Retry-After", headers)
+            self.assertEqual(job_server.status()["queued"], 1)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            asyncio.run(run())
+
+    def test_malformed_config(self):
+        async def run():
+            job_server = JobServer(tmp_dir, max_queued_jobs=2)
+            job_server.queue = asyncio.Queue(2)
+            status, _, body = await job_server.route("POST", "/jobs", json.dumps(
+                {"config": config, "reference": "resources/ref.fa", "fastq": "resources/ref.fa"}).encode())
+            self.assertEqual(status, 400)
+            self.assertIn("error in config file", json.loads(body)["error"])
+            # a job that makes a library function exit fails without stopping the worker
+            job = job_server.submit("resources/config_multi.tsv", "resources/ref.fa", "resources/ref.fa")
+            with mock.patch.object(job_server, "count", side_effect=SystemExit(1)):
+                worker = asyncio.create_task(job_server._work())
+                await job_server.queue.join()
+            self.assertEqual(job.status, FAILED)
+            self.assertFalse(worker.done())
+            worker.cancel()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config = os.path.join(tmp_dir, "config.tsv")
+            with open(config, "w") as f:
+                f.write("chr\tbegin\tend\tname\trepeat\tprefix\tsuffix\nref\tsix\t8\tCC_repeat\tCC\tCGTAA\tGGTTA\n")
+            with self.assertRaises(ValueError):
+                load_config(config)
+            asyncio.run(run())
+
+    def test_expire_jobs(self):
+        async def run():
+            job_server = JobServer(tmp_dir, job_ttl=60)
+            job_server.queue = asyncio.Queue()
+            old, new = [job_server.submit("resources/config_multi.tsv", "resources/ref.fa", "resources/ref.fa")
+                        for _ in range(2)]
+            for job, finished in ((old, time.time() - 120), (new, time.time())):
+                job.status, job.finished = DONE, finished
+                job_server.finished_jobs.append(job)
+            self.assertEqual((await job_server.route("GET", f"/jobs/{old.id}", b""))[0], 404)
+            self.assertEqual((await job_server.route("GET", f"/jobs/{new.id}", b""))[0], 200)
+            self.assertEqual(list(job_server.jobs), [new.id])
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            asyncio.run(run())
+
+    def test_warm_graph_evicted(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                mock.patch("job_server.generate_graph", wraps=generate_graph) as generate:
+            warm_graphs = WarmGraphs(tmp_dir)
+            graph_file, _, _ = warm_graphs.get("resources/config_multi.tsv", "resources/ref.fa")
+            os.utime(graph_file, (0, 0))
+            self.assertEqual(warm_graphs.get("resources/config_multi.tsv", "resources/ref.fa")[0], graph_file)
+            self.assertEqual(generate.call_count, 1)
+            # a hit marks the graph as used in the cache
+            self.assertGreater(os.path.getmtime(graph_file), 0)
+            # a graph evicted from the cache is generated again
+            os.remove(graph_file)
+            self.assertEqual(warm_graphs.get("resources/config_multi.tsv", "resources/ref.fa")[0], graph_file)
+            self.assertEqual(generate.call_count, 2)
+            self.assertTrue(os.path.exists(graph_file))
+
+
+class Test_lazy_imports(unittest.TestCase):
+    def test_import_without_heavy_dependencies(self):
+        # a new interpreter, this one imported pandas, numpy and pysam for the other tests
+        imported = subprocess.run([sys.executable, "-c", "import sys; sys.path.append('..'); "
+                                   "import STRcount, parse_gaf, genome_str_graph_generator; "
+                                   "print([module in sys.modules for module in ('pandas', 'numpy', 'pysam')])"],
+                                  check=True, capture_output=True, text=True).stdout
+        self.assertEqual(imported.strip(), "[False, False, False]")
+
+    def test_verbose_graph(self):
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            get_genome_str_graph("resources/config_db.tsv", "resources/ref.fa", "+", "+", "+", False, False, True)
+        self.assertIn("RecordType", stderr.getvalue())
+        self.assertIn("ref_prefix_1", stderr.getvalue())
+
 
 if __name__ == '__main__':
     unittest.main()